@@ -1,7 +1,6 @@
 import os
-import subprocess
+import sys
 
-from concurrent.futures import ProcessPoolExecutor # Parallelize comparisons
 from pathlib import Path
 
 k_P_pairs = [
@@ -25,54 +24,53 @@ ALGORITHMS = [
     'kapra'
 ]
 
+SEED = 0 # Same draws in every cell, so that cached cells are reproducible
+
 DATA_DIR = 'data'
-SRC = 'k_P_anonymity.py'
 
 abs_data_dir = Path(os.path.dirname(os.path.abspath('__file__'))).parent / DATA_DIR
-abs_src_path = abs_data_dir.parent / SRC
-
-def run_experiment(dataset):
-    abs_data_path = str(abs_data_dir / dataset)
-    errs = []
 
-    for algo in ALGORITHMS:
-        for k_P in k_P_pairs:
-            k, P = k_P
+RES_DIR = abs_data_dir.parent / 'results'
+CACHE_DIR = RES_DIR / 'cache'
 
-            cmd = 'python {} {} {} {} {} {} {}'.format('"' + str(abs_src_path) + '"',
-                    algo, k, P, PAA, l, '"' + abs_data_path + '"')
+sys.path.append(str(abs_data_dir.parent))
 
-            try:
-                subprocess.run(cmd, shell=True, check=True)
-            except subprocess.CalledProcessError as e:
-                errs.append(str(e))
+from includes.grid import run_grid
+from includes.io import load_dataset
 
-    if len(errs) == 0:
-        print('No errors found with dataset {}'.format(dataset))
-
-    return errs
+def print_experiment_errs(errs):
+    for cell, err in errs:
+        print('Found error with cell {}'.format(cell))
+        print(err)
+        print('\n')
 
-def print_experiment_errs(res):
-    exper_errs = list(res)
+if __name__ == '__main__':
+    cells = [ (dataset, algo, k, P, PAA, l) for dataset in DATASETS
+            for algo in ALGORITHMS for k, P in k_P_pairs ]
 
-    for exper in exper_errs:
-        dataset, errs = exper
+    # Each dataset is loaded only once. The cells of
+    # a dataset which fails to load are reported as errors
+    datasets = dict()
+    errs = list()
 
-        if len(errs) == 0:
-            continue
+    for dataset in DATASETS:
+        try:
+            datasets[dataset] = load_dataset(abs_data_dir / dataset)
+        except (ValueError, FileNotFoundError) as e:
+            errs.extend((cell, str(e)) for cell in cells if cell[0] == dataset)
 
-        print('Found {} errors with dataset {}'.format(len(errs), dataset))
+    cells = [ cell for cell in cells if cell[0] in datasets ]
 
-        for err in errs:
-            print(err)
+    results_df, grid_errs = run_grid(datasets, cells, RES_DIR, CACHE_DIR, SEED,
+            max_workers=min(16, os.cpu_count()))
 
-        print('\n')
+    errs.extend(grid_errs)
 
-    return exper_errs
+    # Store experiment results in a single table
+    results_df.to_csv(RES_DIR / 'experiments.csv', sep=',', index=False)
 
-if __name__ == '__main__':
-    with ProcessPoolExecutor(max_workers=16) as pool:
-        res = zip(DATASETS, list(pool.map(run_experiment, DATASETS))) # Store experiment results
+    if len(errs) == 0:
+        print('No errors found')
 
     # Print experiment errors
-    exper_errs = print_experiment_errs(res)
+    print_experiment_errs(errs)
@@ -0,0 +1,322 @@
+"""
+Library entry point of the (k, P)-anonymity algorithms, which keeps the whole anonymization in memory, instead of
+writing the anonymized dataset to file and loading it back again to compute its metrics
+"""
+
+import random
+import time
+
+import numpy as np
+
+from functools import cached_property
+from loguru import logger
+
+# Custom imports #
+from .dataset import Dataset
+from .group_envelope import GroupEnvelope
+from .io import load_dataset
+from .io import save_anonymized_dataset
+from .kapra import kapra_create_tree
+from .kapra import kapra_group_formation
+from .metric import global_value_loss
+from .naive import naive_anonymize
+from .pattern_loss import global_pattern_loss
+
+ALGORITHMS = [ 'naive', 'kapra' ]
+
+
+class AnonymizationResult:
+    """
+    Outcome of a (k, P)-anonymity run, see `anonymize()`. Pattern and value losses are only computed the first
+    time they are accessed, straight from the groups and patterns in memory.
+
+    Parameters
+    ----------
+    :param algorithm: str
+        "naive" or "kapra"
+
+    :param params: dict
+        k, P, paa and l values, and seed, of the run
+
+    :param dataset: Dataset
+        Original dataset, whose rows the groups index into, with its sensitive attribute perturbed by l-diversity
+
+    :param k_groups: list of np.ndarray of int
+        k-groups, as index arrays of rows
+
+    :param patterns: dict
+        Dict of per-record pattern representations, keyed by row
+
+    :param suppressed: list of np.ndarray of int
+        Groups of suppressed records (KAPRA-only), as index arrays of rows
+
+    :param perturbated: dict
+        Rounds of the +/- 1 increment fallback of l-diversity, keyed by row, see `enforce_l_diversity()`
+
+    :param timings: dict
+        Elapsed time of each phase of the run, in seconds, by phase name
+    """
+
+    def __init__(self, algorithm, params, dataset, k_groups, patterns, suppressed, perturbated, timings):
+        self.algorithm = algorithm
+        self.params = params
+        self.dataset = dataset
+        self.k_groups = k_groups
+        self.patterns = patterns
+        self.suppressed = suppressed
+        self.perturbated = perturbated
+        self.timings = timings
+        self.outpath = None # Path of the anonymized dataset on disk, if saved
+
+    @property
+    def eta(self):
+        """
+        Elapsed time of the whole run, in seconds
+        """
+
+        return sum(self.timings.values())
+
+    @cached_property
+    def envelopes(self):
+        return [ GroupEnvelope(self.dataset.QI[k_group]) for k_group in self.k_groups ]
+
+    @cached_property
+    def pattern_loss(self):
+        """
+        Global and average pattern loss, see `global_pattern_loss()`
+        """
+
+        return global_pattern_loss(None, self.algorithm, self.dataset, self.patterns, self.params['paa'])
+
+    @cached_property
+    def value_loss(self):
+        """
+        Global and average instant value loss, see `global_value_loss()`
+        """
+
+        return global_value_loss(self.envelopes, len(self.dataset))
+
+    def results(self):
+        """
+        Metrics of the run, in the same order and rounding as the results files, see `RESULTS_COLUMNS`
+        """
+
+        tot_pattern_loss, avg_pattern_loss = self.pattern_loss
+        tot_value_loss, avg_value_loss = self.value_loss
+
+        return [ round(float(metric), 3) for metric in (self.eta, tot_pattern_loss, avg_pattern_loss,
+                tot_value_loss, avg_value_loss) ]
+
+    def save(self, data_path, normalized=False):
+        """
+        Save the anonymized dataset to file, next to the original one at `data_path`,
+        see `save_anonymized_dataset()`
+
+        Returns
+        -------
+        :return outpath: Path
+            Path of the anonymized dataset
+        """
+
+        start = time.time()
+
+        self.outpath = save_anonymized_dataset(data_path, self.algorithm, self.dataset, self.patterns,
+                self.k_groups, suppressed=self.suppressed, normalized=normalized)
+
+        self.timings['save'] = self.timings.get('save', 0.) + time.time() - start
+
+        logger.info('Saved anonymized dataset at: ' + str(self.outpath))
+
+        return self.outpath
+
+def anonymize(data, algorithm, k_value, P_value, paa_value, l_value, save=False, normalized=False,
+        max_workers=1, seed=None):
+    """
+    Run a (k, P)-anonymity algorithm with l-diversity, and keep its outcome in memory
+
+    Parameters
+    ----------
+    :param data: str or Dataset
+        Path of the dataset to be anonymized on disk, or the dataset itself. A dataset given in memory is not
+        modified, as l-diversity perturbs a copy of its sensitive attribute.
+
+    :param algorithm: str
+        "naive" or "kapra", case insensitive
+
+    :param k_value: int
+        K-requirement for (k, P) anonymity, no less than `P_value`
+
+    :param P_value: int
+        P-requirement for (k, P) anonymity
+
+    :param paa_value: int
+        Size of the PAA representation of each time series
+
+    :param l_value: int
+        l-requirement for l-diversity
+
+    :param save: bool
+        Also save the anonymized dataset to file, next to the original one. Requires `data` to be a path.
+
+    :param normalized: bool
+        Save the anonymized dataset as a normalized pair of group and record tables, see `save_anonymized_dataset()`
+
+    :param max_workers: int
+        Number of worker processes, see `Naive()` and `KAPRA()`
+
+    :param seed: int - None
+        Seed of all random draws of the run, which is then reproducible. The global `random` generator is reseeded
+        with it, as clustering draws from it. Draws are not reproducible if None.
+
+    Returns
+    -------
+    :return result: AnonymizationResult
+        Groups, patterns, suppressed records, timings and metrics of the run
+
+    Raises
+    ------
+    ValueError
+        If the algorithm is unknown, or the parameters are not consistent with each other or with the dataset
+
+    FileNotFoundError
+        If the dataset is not found on disk
+    """
+
+    algorithm = algorithm.lower()
+
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Cannot interpret ' + algorithm
+                + ' as a (k, P)-anonymity algorithm: only naive and KAPRA are supported')
+
+    if k_value < P_value:
+        raise ValueError('<k_value> must be greater or equal than <P_value>')
+
+    if save and isinstance(data, Dataset):
+        raise ValueError('Saving the anonymized dataset requires the path of the original one')
+
+    rng = None # l-diversity generator
+
+    if seed is not None:
+        random.seed(seed)
+        rng = np.random.default_rng(seed)
+
+    timings = dict()
+
+    start = time.time()
+
+    if isinstance(data, Dataset):
+        dataset = Dataset(data.ids, data.QI, data.A_s.copy(), data.col_names,
+                data.QI_min_vals, data.QI_max_vals)
+    else:
+        dataset = load_dataset(data)
+
+    timings['load'] = time.time() - start
+
+    start = time.time()
+
+    if algorithm == 'naive':
+        k_groups, patterns, perturbated = naive_anonymize(dataset, k_value, P_value, paa_value, l_value,
+                max_workers, rng, seed)
+        suppressed = list()
+    else:
+        P_subgroups, suppressed, patterns = kapra_create_tree(dataset, P_value, paa_value, max_workers)
+
+        k_groups, perturbated = kapra_group_formation(dataset, P_subgroups, patterns, dataset.A_s,
+                k_value, P_value, l_value, rng, max_workers)
+
+    timings['anonymize'] = time.time() - start
+
+    result = AnonymizationResult(algorithm, { 'k': k_value, 'P': P_value, 'paa': paa_value, 'l': l_value,
+            'seed': seed },
+            dataset, k_groups, patterns, suppressed, perturbated, timings)
+
+    if save:
+        result.save(data, normalized)
+
+    return result
+
+def anonymize_kapra_sweep(data, K_l_values, P_value, paa_value, max_workers=1, seed=None):
+    """
+    Run KAPRA with l-diversity over many (k, l)-requirements for the same P-requirement and PAA size, and keep the
+    outcome of each run in memory. The P-subgroup forest is built by the create-tree phase only once, as it only
+    depends on P and paa; then each (k, l) pair only runs the group formation and l-diversity phases, on its own copy
+    of the sensitive attribute. Each run matches the one of `anonymize()` with the same parameters and seed.
+
+    Parameters
+    ----------
+    :param data: str or Dataset
+        Path of the dataset to be anonymized on disk, or the dataset itself, which is not modified
+
+    :param K_l_values: list of tuple
+        (k, l) pairs of requirements, each k no less than `P_value`
+
+    :param seed: int - None
+        Seed of all random draws, see `anonymize()`. The l-diversity generator is reseeded for each run.
+
+    Returns
+    -------
+    :return results: list of AnonymizationResult
+        Outcome of each (k, l) pair, in order. The ETA of each run includes the shared create-tree phase, and its
+        pattern loss, which only depends on the P-subgroups' patterns, is computed once for all runs.
+
+    Raises
+    ------
+    ValueError
+        If any k-requirement is less than the P-requirement
+
+    FileNotFoundError
+        If the dataset is not found on disk
+    """
+
+    for K_value, _ in K_l_values:
+        if K_value < P_value:
+            raise ValueError('<k_value> must be greater or equal than <P_value>')
+
+    if seed is not None:
+        random.seed(seed)
+
+    start = time.time()
+
+    dataset = data if isinstance(data, Dataset) else load_dataset(data)
+
+    load_eta = time.time() - start
+
+    start = time.time()
+
+    P_subgroups, suppressed, patterns = kapra_create_tree(dataset, P_value, paa_value, max_workers)
+
+    create_tree_eta = time.time() - start
+
+    # Group formation draws from the global generator as well, when splitting
+    # large P-subgroups; each seeded run starts from the state it would have
+    # after the create-tree phase of `anonymize()`
+    random_state = random.getstate()
+
+    results = list()
+
+    for K_value, l_value in K_l_values:
+        start = time.time()
+
+        if seed is not None:
+            random.setstate(random_state)
+
+        run_dataset = Dataset(dataset.ids, dataset.QI, dataset.A_s.copy(), dataset.col_names,
+                dataset.QI_min_vals, dataset.QI_max_vals)
+
+        rng = np.random.default_rng(seed) if seed is not None else None
+
+        k_groups, perturbated = kapra_group_formation(run_dataset, P_subgroups, patterns, run_dataset.A_s,
+                K_value, P_value, l_value, rng, max_workers)
+
+        timings = { 'load': load_eta, 'anonymize': create_tree_eta + time.time() - start }
+
+        results.append(AnonymizationResult('kapra', { 'k': K_value, 'P': P_value, 'paa': paa_value,
+                'l': l_value, 'seed': seed }, run_dataset, k_groups, patterns, suppressed, perturbated, timings))
+
+    if len(results) > 0:
+        pattern_loss = results[0].pattern_loss
+
+        for result in results[1:]:
+            result.pattern_loss = pattern_loss
+
+    return results
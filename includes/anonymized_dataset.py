@@ -2,58 +2,158 @@ import numpy as np
 from loguru import logger
 from pathlib import Path
 
+# Custom imports #
+from .group_envelope import GroupEnvelope
+
+GROUP_LABEL_PREFIX = "Group: "
+
+def format_envelope_row(envelope):
+    """
+    Format the envelope of a k-group as the "[min|max]" QI columns of its records in a flat anonymized dataset
+    """
+
+    return ",".join("[{}|{}]".format(min_value, max_value)
+            for min_value, max_value in zip(envelope.r_minus.tolist(), envelope.r_plus.tolist()))
+
+def format_group_label(index):
+    return GROUP_LABEL_PREFIX + str(index)
 
 class AnonymizedDataset:
-    def __init__(self, anonymized_data: list = list(), pattern_anonymized_data: dict = dict(),
-                 suppressed_data: list = list(), sensitive: dict = {}):
-        self.anonymized_data = anonymized_data 
-        self.pattern_anonymized_data = pattern_anonymized_data 
+    """
+    Streaming writer of an anonymized dataset. Each k-group is written as soon as it is formatted, so that
+    at most one group's worth of output rows is held in memory, rather than the full output table.
+    All records in a k-group share one envelope, hence its "[min|max]" row is formatted once per group
+    and reused for every member.
+
+    The release is either a single flat table, see `save()`, or a normalized pair of tables, see
+    `save_normalized()`, where each envelope is stored only once in a group table, and each record only
+    references its group in a record table.
+    """
+
+    def __init__(self, dataset, anonymized_data: list = list(), pattern_anonymized_data: dict = dict(),
+                 suppressed_data: list = list()):
+        self.dataset = dataset # Original columnar dataset
+        self.anonymized_data = anonymized_data
+        self.pattern_anonymized_data = pattern_anonymized_data
         self.suppressed_data = suppressed_data
-        self.final_data_anonymized = dict()
-        self.sensitive = sensitive
-
-
-    def construct(self):
-        """
-        Create dataset ready to be anonymized
-        :return:
-        """
-        logger.info("Start creation dataset anonymized")
-        logger.info("Added {} anonymized group".format(len(self.anonymized_data)))
-        for index in range(0, len(self.anonymized_data)): 
-
-            k_group = self.anonymized_data[index]
-                        
-            max_value = np.amax(np.array(list(k_group.values())), 0)
-            min_value = np.amin(np.array(list(k_group.values())), 0)
-
-            for key in k_group.keys():
-                # key = row product
-                self.final_data_anonymized[key] = list()
-                value_row = list()
-                for column_index in range(0, len(max_value)):
-                    value_row.append("[{}|{}]".format(min_value[column_index], max_value[column_index]))
-                
-                value_row.append(self.pattern_anonymized_data[key]) 
-                value_row.append(str(self.sensitive[key]))
-                value_row.append("Group: {}".format(index))
-
-                self.final_data_anonymized[key] = value_row
-        
-        logger.info("Added {} suppressed group".format(len(self.suppressed_data)))
-        for index in range(0, len(self.suppressed_data)):
-            group = self.suppressed_data[index]
-            for key in group.keys():
-                value_row = [" - "]*len(group[key])
-                value_row.append(" - ") # pattern rapresentation
-                value_row.append(" - ") # group
-                self.final_data_anonymized[key] = value_row
+        self.sensitive = dataset.A_s
+        self.envelopes = list() # Envelopes of the anonymized k-groups, see global_value_loss()
+
+    def write_group(self, file_to_write, index, k_group):
+        """
+        Write all records of the `index`-th k-group, and keep track of its envelope
+
+        Parameters
+        ----------
+        :param file_to_write: file
+            Anonymized dataset open in text mode
+
+        :param index: int
+            Index of the k-group, as shown in the group column
+
+        :param k_group: np.ndarray of int
+            Index array of the rows in the k-group
+        """
+
+        k_group = np.asarray(k_group)
+
+        envelope = GroupEnvelope(self.dataset.QI[k_group])
+        self.envelopes.append(envelope)
+
+        # Shared by all records in the group
+        envelope_row = format_envelope_row(envelope)
+        group_label  = format_group_label(index)
+
+        keys = self.dataset.ids[k_group].tolist() # key = row product
+        sensitive = self.sensitive[k_group].tolist()
+
+        lines = [ "{},{},{},{},{}\n".format(key, envelope_row, self.pattern_anonymized_data[row], A_s, group_label)
+                for key, row, A_s in zip(keys, k_group.tolist(), sensitive) ]
+
+        file_to_write.write("".join(lines))
+
+    def write_suppressed(self, file_to_write, group):
+        """
+        Write all records of a suppressed P-group, with every column replaced by a " - " placeholder
+        """
+
+        # QI attributes, pattern rapresentation and group
+        placeholder_row = ",".join([" - "]*(self.dataset.QI.shape[1] + 2))
+
+        keys = self.dataset.ids[np.asarray(group, dtype=np.int64)].tolist()
+
+        file_to_write.write("".join("{},{}\n".format(key, placeholder_row) for key in keys))
+
+    def write_normalized_group(self, groups_file, records_file, index, k_group):
+        """
+        Write the envelope of the `index`-th k-group as a single row of the group table, and all of its
+        records as rows of the record table referencing it, and keep track of its envelope
+        """
+
+        k_group = np.asarray(k_group)
+
+        envelope = GroupEnvelope(self.dataset.QI[k_group])
+        self.envelopes.append(envelope)
+
+        # min and max of each QI attribute, side by side
+        bounds = np.stack((envelope.r_minus, envelope.r_plus), axis=1).ravel().tolist()
+        groups_file.write("{},{},{}\n".format(index, envelope.size, ",".join(map(str, bounds))))
+
+        keys = self.dataset.ids[k_group].tolist()
+        sensitive = self.sensitive[k_group].tolist()
+
+        records_file.write("".join("{},{},{},{},0\n".format(key, index, self.pattern_anonymized_data[row], A_s)
+                for key, row, A_s in zip(keys, k_group.tolist(), sensitive)))
+
+    def write_normalized_suppressed(self, records_file, group):
+        """
+        Write all records of a suppressed P-group as rows of the record table, with no group,
+        pattern representation nor sensitive value
+        """
+
+        keys = self.dataset.ids[np.asarray(group, dtype=np.int64)].tolist()
+
+        records_file.write("".join("{},,,,1\n".format(key) for key in keys))
+
+    def save_normalized(self, groups_path, records_path, col_names):
+        """
+        Stream the anonymized dataset to file as a normalized pair of tables, one group at a time:
+        a group table (group, size, min and max of each QI attribute), and
+        a record table (Id, group, sax, as, suppressed)
+        """
+
+        logger.info("Saving on file normalized dataset anonymized")
+        self.envelopes = list()
+
+        id_col, QI_cols = col_names[0], col_names[1:]
+
+        with open(groups_path, "w") as groups_file, open(records_path, "w") as records_file:
+            groups_file.write("group,size," + ",".join("{0}_min,{0}_max".format(col) for col in QI_cols) + "\n")
+            records_file.write(id_col + ",group,sax,as,suppressed" + "\n")
+
+            logger.info("Added {} anonymized group".format(len(self.anonymized_data)))
+            for index, k_group in enumerate(self.anonymized_data):
+                self.write_normalized_group(groups_file, records_file, index, k_group)
+
+            logger.info("Added {} suppressed group".format(len(self.suppressed_data)))
+            for group in self.suppressed_data:
+                self.write_normalized_suppressed(records_file, group)
 
     def save(self, output_path, col_names):
+        """
+        Stream the anonymized dataset to file, one group at a time
+        """
+
         logger.info("Saving on file dataset anonymized")
+        self.envelopes = list()
+
         with open(output_path, "w") as file_to_write:
             file_to_write.write(",".join(col_names) + ',sax,as,group' + "\n")
-            value_to_print_on_file = ""
-            for key, value in self.final_data_anonymized.items():
-                value_to_print_on_file = "{},{}".format(key, ",".join(value))
-                file_to_write.write(value_to_print_on_file+"\n")
\ No newline at end of file
+
+            logger.info("Added {} anonymized group".format(len(self.anonymized_data)))
+            for index, k_group in enumerate(self.anonymized_data):
+                self.write_group(file_to_write, index, k_group)
+
+            logger.info("Added {} suppressed group".format(len(self.suppressed_data)))
+            for group in self.suppressed_data:
+                self.write_suppressed(file_to_write, group)
@@ -0,0 +1,218 @@
+"""
+Binary dataset formats, which are loaded with no parsing at all, mapping the QI matrix straight from disk whenever
+possible, and the binary sidecars of CSV datasets, which are parsed only once and then reused on later loads.
+
+All table-shaped formats (.npy, Parquet, Arrow) follow the same column layout as CSV datasets: the Id column first,
+then the QI attributes, and the sensitive attribute last.
+"""
+
+import hashlib
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+from loguru import logger
+from pathlib import Path
+
+# Custom imports #
+from .dataset import Dataset
+
+DATA_CACHE_DIR = '__datacache__' # Sidecars of CSV datasets, next to them
+
+NPZ_SUFFIXES = [ '.npz' ]
+NPY_SUFFIXES = [ '.npy' ]
+PARQUET_SUFFIXES = [ '.parquet', '.pq' ]
+ARROW_SUFFIXES = [ '.arrow', '.feather', '.ipc' ]
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    Hash of the contents of a file, read in chunks
+    """
+
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def generate_sidecar_path(data_path):
+    """
+    Generate the path of the binary sidecar of a CSV dataset, named after a hash of its contents,
+    so that any change to the CSV file makes its stale sidecar unreachable
+    """
+
+    data_path = Path(data_path).absolute()
+
+    return data_path.parent / DATA_CACHE_DIR / '{}.{}.npz'.format(data_path.stem, file_digest(data_path)[:16])
+
+def save_npz_dataset(dataset, path):
+    """
+    Save a dataset as an uncompressed .npz archive (ids, QI, A_s, col_names, QI_min_vals, QI_max_vals), whose QI
+    matrix can then be mapped from disk, see `load_npz_dataset()`
+    """
+
+    path = Path(path)
+    os.makedirs(path.parent, exist_ok=True)
+
+    ids = dataset.ids.astype(str) if dataset.ids.dtype == object else dataset.ids
+
+    # Written to a temporary file first, so that concurrent
+    # loaders never see a partially written archive
+    tmp_path = path.with_suffix('.tmp.npz')
+
+    np.savez(tmp_path, ids=ids, QI=dataset.QI, A_s=dataset.A_s, col_names=np.array(dataset.col_names, dtype=str),
+            QI_min_vals=dataset.QI_min_vals, QI_max_vals=dataset.QI_max_vals)
+
+    os.replace(tmp_path, path)
+
+def map_npz_member(path, name):
+    """
+    Map an array stored in an .npz archive straight from disk, read-only. Only uncompressed, C-ordered members
+    with no Python objects can be mapped.
+
+    Returns
+    -------
+    :return array: np.memmap
+        Mapped array, or None if it cannot be mapped
+    """
+
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(name + '.npy')
+
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    with open(path, 'rb') as file:
+        # The local file header is 30 bytes long, followed by the
+        # member name and extra field, whose lengths end the header
+        file.seek(info.header_offset)
+        name_length, extra_length = struct.unpack('<HH', file.read(30)[26:30])
+        file.seek(info.header_offset + 30 + name_length + extra_length)
+
+        version = np.lib.format.read_magic(file)
+
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+
+        offset = file.tell()
+
+    if fortran_order or dtype.hasobject:
+        return None
+
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape, offset=offset)
+
+def load_npz_dataset(path):
+    """
+    Load a dataset from an .npz archive, see `save_npz_dataset()`, mapping its QI matrix from disk if uncompressed.
+    Only the QI matrix and the sensitive attribute are required; Ids default to row indexes, column names to
+    generic ones, and QI boundaries are computed if missing.
+    """
+
+    with np.load(path, allow_pickle=False) as archive:
+        members = set(archive.files)
+
+        A_s = archive['A_s']
+
+        QI = map_npz_member(path, 'QI')
+
+        if QI is None:
+            QI = archive['QI']
+
+        ids = archive['ids'] if 'ids' in members else np.arange(len(QI))
+
+        col_names = archive['col_names'].tolist() if 'col_names' in members \
+                else generic_col_names(QI.shape[1])
+
+        QI_min_vals = archive['QI_min_vals'] if 'QI_min_vals' in members else None
+        QI_max_vals = archive['QI_max_vals'] if 'QI_max_vals' in members else None
+
+    return Dataset(ids, QI, A_s, col_names, QI_min_vals, QI_max_vals)
+
+def generic_col_names(num_QI_cols):
+    """
+    Column names of a table with no header: the Id column, followed by the QI attributes
+    """
+
+    return [ 'Id' ] + [ 'A{}'.format(col) for col in range(num_QI_cols) ]
+
+def load_npy_dataset(path):
+    """
+    Load a dataset from a 2-D numeric .npy table, with integer Ids in the first column, mapped from disk.
+    As the QI attributes are interleaved with the Ids and the sensitive attribute in each row, they are copied
+    out of the mapped table into a contiguous QI matrix.
+    """
+
+    table = np.load(path, mmap_mode='r')
+
+    if table.ndim != 2 or table.shape[1] < 3:
+        raise ValueError(str(path) + ' is not a table of Ids, QI attributes and sensitive attribute')
+
+    return Dataset(table[:, 0].astype(np.int64), table[:, 1:-1], np.array(table[:, -1]),
+            generic_col_names(table.shape[1] - 2))
+
+def arrow_table_to_dataset(table):
+    """
+    Convert an Arrow table to a dataset. Each column is read from the Arrow buffers with no copies, then the
+    QI attributes are gathered into a contiguous QI matrix. The sensitive attribute is copied as well, as zero-copy
+    columns are read-only, while l-diversity perturbs it in place.
+    """
+
+    cols = table.column_names
+
+    columns = [ table.column(col).to_numpy() for col in cols ]
+
+    logger.info('Extracted attribute ' + cols[-1] +
+            ' as sensitive data')
+
+    return Dataset(columns[0], np.column_stack(columns[1:-1]), np.array(columns[-1]), cols[:-1])
+
+def load_arrow_dataset(path):
+    """
+    Load a dataset from an Arrow IPC (Feather v2) file, mapped from disk. Requires pyarrow.
+    """
+
+    import pyarrow as pa
+
+    # Left open, as the columns of the table still point into the map
+    source = pa.memory_map(str(path), 'r')
+    table = pa.ipc.open_file(source).read_all()
+
+    return arrow_table_to_dataset(table)
+
+def load_parquet_dataset(path):
+    """
+    Load a dataset from a Parquet file, mapped from disk. Requires pyarrow.
+    """
+
+    import pyarrow.parquet as pq
+
+    return arrow_table_to_dataset(pq.read_table(str(path), memory_map=True))
+
+def load_binary_dataset(path):
+    """
+    Load a dataset from any of the binary formats, by file suffix
+
+    Returns
+    -------
+    :return dataset: Dataset
+        Loaded dataset, or None if `path` has no binary format suffix
+    """
+
+    suffix = Path(path).suffix.lower()
+
+    if suffix in NPZ_SUFFIXES:
+        return load_npz_dataset(path)
+    elif suffix in NPY_SUFFIXES:
+        return load_npy_dataset(path)
+    elif suffix in PARQUET_SUFFIXES:
+        return load_parquet_dataset(path)
+    elif suffix in ARROW_SUFFIXES:
+        return load_arrow_dataset(path)
+
+    return None
@@ -0,0 +1,273 @@
+"""
+Content-addressed cache of (k, P)-anonymity runs. Each run is keyed by a hash of the dataset contents, the algorithm
+and its parameters, the RNG seed, and the version of the code, i.e., a hash of the sources of this package; hence a
+cached run is only ever served for the very same inputs, and any change to the code invalidates the whole cache.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from functools import lru_cache
+from loguru import logger
+from pathlib import Path
+
+# Custom imports #
+from .anonymize import anonymize
+from .anonymize import anonymize_kapra_sweep
+from .anonymize import AnonymizationResult
+from .dataset import Dataset
+from .io import load_dataset
+
+CACHE_DIR = 'cache'
+
+@lru_cache(maxsize=None)
+def code_version():
+    """
+    Hash of the sources of this package
+    """
+
+    digest = hashlib.sha256()
+
+    for src_path in sorted(Path(__file__).parent.glob('*.py')):
+        digest.update(src_path.name.encode())
+        digest.update(src_path.read_bytes())
+
+    return digest.hexdigest()
+
+def dataset_digest(dataset):
+    """
+    Hash of the contents of a dataset in memory, i.e., its column names, Ids, QI matrix and sensitive attribute,
+    so that the same table gets the same hash, whatever file it was loaded from
+    """
+
+    digest = hashlib.sha256()
+
+    digest.update(json.dumps(dataset.col_names).encode())
+    digest.update("\n".join(map(str, dataset.ids.tolist())).encode())
+
+    for array in (dataset.QI, dataset.A_s):
+        digest.update(str((array.dtype.str, array.shape)).encode())
+        digest.update(np.ascontiguousarray(array).tobytes())
+
+    return digest.hexdigest()
+
+def cache_key(dataset, algorithm, k_value, P_value, paa_value, l_value, seed=None):
+    """
+    Key of a run in the cache, see `ResultCache`. The number of worker processes is left out, as seeded runs
+    draw the same values whatever their scheduling, see `naive_anonymize()`.
+    """
+
+    params = { 'dataset': dataset_digest(dataset), 'algorithm': algorithm.lower(), 'k': k_value, 'P': P_value,
+            'paa': paa_value, 'l': l_value, 'seed': seed, 'code': code_version() }
+
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def pack_groups(groups):
+    """
+    Concatenate a list of index arrays of rows, along with the offsets splitting them back, see `unpack_groups()`
+    """
+
+    sizes = [ len(group) for group in groups ]
+
+    rows = np.concatenate(groups).astype(np.int64) if len(groups) > 0 else np.zeros(0, dtype=np.int64)
+
+    return rows, np.cumsum(sizes[:-1], dtype=np.int64)
+
+def unpack_groups(rows, offsets, num_groups):
+    if num_groups == 0:
+        return list()
+
+    return np.split(rows, offsets)
+
+class ResultCache:
+    """
+    Cache of (k, P)-anonymity runs on disk. Each run is stored as a pair of files named after its key, see
+    `cache_key()`: an .npz archive holding the anonymized output (k-groups, suppressed groups, patterns and
+    perturbed sensitive attribute), and a .json file holding its parameters, timings and pattern/value losses.
+
+    Parameters
+    ----------
+    :param cache_dir: str
+        Directory of the cache, created if non-existent
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def paths(self, key):
+        return self.cache_dir / (key + '.npz'), self.cache_dir / (key + '.json')
+
+    def __contains__(self, key):
+        return all(path.is_file() for path in self.paths(key))
+
+    def get(self, key, dataset):
+        """
+        Rebuild a cached run on `dataset`, with its pattern and value losses already computed,
+        or None if the run is not cached
+
+        Returns
+        -------
+        :return result: AnonymizationResult
+            Cached run, whose dataset holds the perturbed sensitive attribute
+        """
+
+        if key not in self:
+            return None
+
+        output_path, meta_path = self.paths(key)
+
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+
+        with np.load(output_path, allow_pickle=False) as output:
+            k_groups = unpack_groups(output['k_rows'], output['k_offsets'], meta['num_k_groups'])
+            suppressed = unpack_groups(output['suppressed_rows'], output['suppressed_offsets'],
+                    meta['num_suppressed'])
+
+            patterns = dict(zip(output['pattern_rows'].tolist(), output['pattern_words'].tolist()))
+            perturbated = dict(zip(output['perturbated_rows'].tolist(), output['perturbated_rounds'].tolist()))
+
+            A_s = output['A_s']
+
+        dataset = Dataset(dataset.ids, dataset.QI, A_s, dataset.col_names,
+                dataset.QI_min_vals, dataset.QI_max_vals)
+
+        result = AnonymizationResult(meta['algorithm'], meta['params'], dataset, k_groups, patterns,
+                suppressed, perturbated, meta['timings'])
+
+        # Served as they were computed
+        result.pattern_loss = tuple(meta['pattern_loss'])
+        result.value_loss = tuple(meta['value_loss'])
+
+        return result
+
+    def put(self, key, result):
+        """
+        Store a run, along with its pattern and value losses, which are computed if not yet available
+        """
+
+        output_path, meta_path = self.paths(key)
+
+        k_rows, k_offsets = pack_groups(result.k_groups)
+        suppressed_rows, suppressed_offsets = pack_groups(result.suppressed)
+
+        meta = { 'algorithm': result.algorithm, 'params': result.params, 'timings': result.timings,
+                'num_k_groups': len(result.k_groups), 'num_suppressed': len(result.suppressed),
+                'pattern_loss': [ float(loss) for loss in result.pattern_loss ],
+                'value_loss': [ float(loss) for loss in result.value_loss ] }
+
+        # Written to temporary files first, so that concurrent
+        # readers never see a partially written run
+        tmp_output_path = output_path.with_suffix('.tmp.npz')
+        tmp_meta_path = meta_path.with_suffix('.tmp.json')
+
+        np.savez(tmp_output_path, k_rows=k_rows, k_offsets=k_offsets,
+                suppressed_rows=suppressed_rows, suppressed_offsets=suppressed_offsets,
+                pattern_rows=np.fromiter(result.patterns.keys(), dtype=np.int64, count=len(result.patterns)),
+                pattern_words=np.array(list(result.patterns.values()), dtype=str),
+                perturbated_rows=np.fromiter(result.perturbated.keys(), dtype=np.int64,
+                        count=len(result.perturbated)),
+                perturbated_rounds=np.fromiter(result.perturbated.values(), dtype=np.int64,
+                        count=len(result.perturbated)),
+                A_s=result.dataset.A_s)
+
+        with open(tmp_meta_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+        os.replace(tmp_output_path, output_path)
+        os.replace(tmp_meta_path, meta_path)
+
+    def anonymize(self, data, algorithm, k_value, P_value, paa_value, l_value, save=False, normalized=False,
+            max_workers=1, seed=None):
+        """
+        Cached version of `anonymize()`: a run already in the cache is served from it, and a missing one is
+        computed, along with its pattern and value losses, and stored. Unseeded runs are neither served from nor
+        stored in the cache, as their random draws are not meant to be reproduced.
+
+        Returns
+        -------
+        :return result: AnonymizationResult
+            Groups, patterns, suppressed records, timings and metrics of the run. Timings of a cached run are
+            the ones of its original computation.
+
+        :return cached: bool
+            Whether the run was served from the cache
+        """
+
+        if save and isinstance(data, Dataset):
+            raise ValueError('Saving the anonymized dataset requires the path of the original one')
+
+        start = time.time()
+
+        dataset = data if isinstance(data, Dataset) else load_dataset(data)
+
+        load_eta = time.time() - start
+
+        key = cache_key(dataset, algorithm, k_value, P_value, paa_value, l_value, seed) \
+                if seed is not None else None
+
+        result = self.get(key, dataset) if key is not None else None
+        cached = result is not None
+
+        if cached:
+            logger.info('Serving {} (k={}, P={}, paa={}, l={}) from cache entry {}'.format(algorithm, k_value,
+                    P_value, paa_value, l_value, key))
+        else:
+            result = anonymize(dataset, algorithm, k_value, P_value, paa_value, l_value,
+                    max_workers=max_workers, seed=seed)
+            result.timings['load'] += load_eta
+
+            if key is not None:
+                self.put(key, result)
+
+        if save:
+            result.save(data, normalized)
+
+        return result, cached
+
+    def anonymize_kapra_sweep(self, data, K_l_values, P_value, paa_value, max_workers=1, seed=None):
+        """
+        Cached version of `anonymize_kapra_sweep()`: each (k, l) pair is cached on its own, under the same key as
+        the corresponding run of `anonymize()`, and the create-tree phase is only run if any pair is missing from
+        the cache. Unseeded sweeps are neither served from nor stored in the cache.
+
+        Returns
+        -------
+        :return outcomes: list of tuple
+            (result, cached) pairs of each (k, l) pair, in order, see `ResultCache.anonymize()`
+        """
+
+        start = time.time()
+
+        dataset = data if isinstance(data, Dataset) else load_dataset(data)
+
+        load_eta = time.time() - start
+
+        keys = [ cache_key(dataset, 'kapra', K_value, P_value, paa_value, l_value, seed)
+                if seed is not None else None for K_value, l_value in K_l_values ]
+
+        outcomes = [ (self.get(key, dataset), True) if key is not None else (None, False) for key in keys ]
+
+        missing = [ idx for idx, (result, _) in enumerate(outcomes) if result is None ]
+
+        logger.info('Serving {} of {} KAPRA (P={}, paa={}) runs from cache'.format(len(K_l_values) - len(missing),
+                len(K_l_values), P_value, paa_value))
+
+        if len(missing) > 0:
+            results = anonymize_kapra_sweep(dataset, [ K_l_values[idx] for idx in missing ], P_value, paa_value,
+                    max_workers=max_workers, seed=seed)
+
+            for idx, result in zip(missing, results):
+                result.timings['load'] += load_eta
+
+                if keys[idx] is not None:
+                    self.put(keys[idx], result)
+
+                outcomes[idx] = (result, False)
+
+        return outcomes
@@ -2,97 +2,100 @@ import os
 import random
 import sys
 import math
+import heapq
 import numpy as np
 
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import wait
+
 ROUNDS = 6 # # of NCP maximization rounds. By up to 6 rounds,
            # we can achieve more than 98.75% of the maximal penalty
 
 MAX_LEVEL = 5 # Maximum # of different chars in SAX pattern representations
 
+BOUND_SLACK = 1e-9 # Relative slack of the lower bounds used to prune candidate groups in postprocessing
+
 # Custom imports #
-from .metric import instant_value_loss
-from .metric import normalized_certainty_penalty
+from .metric import normalize_QI
+from .metric import pairwise_instant_value_loss
+from .metric import pairwise_normalized_certainty_penalty
+
+from .group_envelope import GroupEnvelope
+from .group_envelope import certainty_penalty
+from .group_envelope import envelope_matrices
+from .group_envelope import value_loss
 
 from .node import Node
 
-def find_tuple_with_max_ncp(base, T, key, T_max_vals, T_min_vals):
+from .parallel import SharedArrays
+from .parallel import worker_array
+from .parallel import worker_constant
+
+def find_tuple_with_max_ncp(base, QI_norm, T, key):
     """
     Scan through the whole table T, and find the i-th tuple that maximizes NCP(base, i).
+    All tuples are scored at once against `base` on the normalized QI matrix.
     
     Parameters
     ----------
-    :param base: list of int
-        Tuple to compare T's tuples against
+    :param base: np.ndarray
+        Normalized tuple to compare T's tuples against
 
-    :param key: T
-        the table
+    :param QI_norm: np.ndarray
+        QI matrix the rows in `T` index into, normalized by `normalize_QI()`
 
-    :param key: int
-        Unique Id of `base`
+    :param T: list of int
+        the table, as rows of `QI_norm`
 
-    :param T_max_vals
-        the maximums
-    
-    :param T_min_vals
-        the minimums
+    :param key: int
+        Row of `base`
         
     Returns
     -------
     :return best: int
-        Unique Id of the found tuple
+        Row of the found tuple
     """
 
-    max_ncp = 0
-    best = None
-
-    for k in T.keys():
-        if k != key:
-            ncp = normalized_certainty_penalty([base, T[k]],
-                    T_max_vals, T_min_vals)
+    T = np.asarray(T, dtype=np.int64)
+    T = T[T != key]
 
-            if ncp >= max_ncp: # Update the best tuple Id
-                max_ncp = ncp
-                best = k
+    ncps = pairwise_normalized_certainty_penalty(base, QI_norm[T])
 
-    return best
+    return _last_argmax(T, ncps)
 
-def find_tuple_with_max_vl(base, T, key):
+def find_tuple_with_max_vl(base, QI, T, key):
     """
     Scan through the whole table T, and find the i-th tuple that maximizes VL(base, i).
+    All tuples are scored at once against `base`.
 
     Returns
     -------
     :return best: int
-        Unique Id of the found tuple
+        Row of the found tuple
     """
 
-    max_vl = 0
-    best = None
+    T = np.asarray(T, dtype=np.int64)
+    T = T[T != key]
+
+    vls = pairwise_instant_value_loss(base, QI[T])
+
+    return _last_argmax(T, vls)
 
-    for k in T.keys():
-        if k != key:
-            vl = instant_value_loss([base, T[k]])
+def _last_argmax(T, metrics):
+    """
+    Row of `T` with the max metric. Ties are broken in favour of the last row in `T`,
+    as a sequential scan updating the best row on >= would do.
+    """
 
-            if vl >= max_vl: # Update the best tuple Id
-                max_vl = vl
-                best = k
+    if len(T) == 0:
+        return None
 
-    return best
+    return int(T[len(T) - 1 - np.argmax(metrics[::-1])])
     
-def find_group_with_min_vl(group_to_search=None, group_to_merge=dict(), index_ignored=list()):
-    min_p_group = {"group" : dict(), "index" : None, "vl" : float("inf")} 
-    for index, group in enumerate(group_to_search):
-        if index not in index_ignored: 
-            vl = instant_value_loss(list(group.values()) + list(group_to_merge.values()))
-            if vl < min_p_group["vl"]:
-                min_p_group["vl"] = vl
-                min_p_group["group"] = group
-                min_p_group["index"] = index
-
-    return min_p_group["group"], min_p_group["index"]
-
-def top_down_greedy_clustering(algorithm, T, size, T_clustered,
-        T_structure, label='o', T_max_vals=None, T_min_vals=None):
+def top_down_greedy_clustering(algorithm, QI, T, size, T_clustered,
+        T_structure, label='o', T_max_vals=None, T_min_vals=None, QI_norm=None,
+        seed=None, max_workers=1):
     """
     Top down greedy search implementation, from Xu et al. 2006,
     Utility-based Anonymization for Privacy Preservation with Less Information Loss, 4.2
@@ -101,129 +104,269 @@ def top_down_greedy_clustering(algorithm, T, size, T_clustered,
     in two smaller groups, each minimizing the intra-NCP (naive) or -VL (KAPRA) among its records. Each bipartite group is marked
     with a unique label, which extends the label of its larger parent group, in order to track its path from root to tip.
 
+    The tree is visited depth-first through an explicit work-stack of index arrays over the shared `QI` matrix, so that no row data
+    is ever copied, and no recursion limit is hit on large tables. Leaves are stored in the same order as a recursive visit would.
+
+    Once split, the two subtrees are independent, hence they can be visited by a pool of worker processes, see `max_workers`.
+    Then each split draws from its own generator, seeded by `seed` and its label, so that results do not depend on scheduling.
+
     Parameters
     ----------
     :param algorithm: str
         (k, P)-anonymity implementation: naive or KAPRA
 
-    :param T: dict of list of int
-        Dict of time-series records on QI attributes
+    :param QI: np.ndarray
+        2-D matrix of time-series records on QI attributes
+
+    :param T: np.ndarray of int
+        Index array of the rows of `QI` to cluster
 
     :param size: int
         Cluster size
 
-    :param T_clustered: list of dict of list of int
-        List of `size`-large clustered groups from `T`
+    :param T_clustered: list of np.ndarray of int
+        List of `size`-large clustered groups from `T`, as index arrays of rows
 
     :param T_structure: list of str
         List of unique alphabetic labels identifying clustered groups in `T_clustered`
 
     :param label: str - 'o'
-        Alphabetic label mapping the current clustering level
+        Alphabetic label mapping the root clustering level
 
     :param T_max_vals: list of int - None
         List of max values for each QI attribute
 
     :param T_min_vals: list of int - None
         List of min values for each QI attribute
+
+    :param QI_norm: np.ndarray - None
+        `QI` normalized by the QI attribute ranges, used to seed the groups (naive-only). Computed from
+        `T_max_vals` and `T_min_vals` if not given
+
+    :param seed: int - None
+        Seed of the per-split generators. If None, splits draw from the global `random` generator in visit order,
+        unless `max_workers` > 1, in which case a seed is drawn from it
+
+    :param max_workers: int - 1
+        # of worker processes visiting subtrees in parallel, sharing `QI` through shared memory
     """
 
-    # If there are less than 2*size records in T, there is no way
-    # to produce two valid cuts >= size. The recursion can then stop.
-    if len(T) < 2*size:
-        T_clustered.append(T)
-        T_structure.append(label)
+    if algorithm == 'naive' and QI_norm is None:
+        QI_norm = normalize_QI(QI, T_max_vals, T_min_vals)
+
+    if max_workers > 1 and len(T) >= 2*size:
+        if seed is None:
+            seed = random.getrandbits(64)
+
+        leaves = parallel_top_down_greedy_clustering(algorithm, QI, T, size, label,
+                T_max_vals, T_min_vals, QI_norm, seed, max_workers)
+
+        for leaf_label, leaf in leaves:
+            T_clustered.append(leaf)
+            T_structure.append(leaf_label)
+
         return
 
-    ids = list(T.keys())
+    stack = [ (T, label) ] # Groups left to visit, along with their labels
+
+    while stack:
+        T, label = stack.pop()
+
+        # If there are less than 2*size records in T, there is no way
+        # to produce two valid cuts >= size. The visit can then stop.
+        if len(T) < 2*size:
+            T_clustered.append(T)
+            T_structure.append(label)
+            continue
+
+        group_u, group_v = greedy_bisection(algorithm, QI, T,
+                T_max_vals, T_min_vals, QI_norm, split_rng(seed, label))
+
+        # 2. Visit both groups next, extending the label with 'a' and 'b' respectively. Groups smaller than
+        # 2*size are stored as they are popped, and 'b' is pushed first, so that leaves keep depth-first order
+        stack.append((group_v, label + 'b'))
+        stack.append((group_u, label + 'a'))
+
+def split_rng(seed, label):
+    """
+    Generator of the random draws of the split at `label`: the global `random` generator if `seed` is None,
+    otherwise a generator of its own, seeded by both `seed` and `label`
+    """
+
+    if seed is None:
+        return random
+
+    return random.Random('{}/{}'.format(seed, label))
+
+def parallel_top_down_greedy_clustering(algorithm, QI, T, size, label,
+        T_max_vals, T_min_vals, QI_norm, seed, max_workers):
+    """
+    Visit the top down greedy clustering tree with a pool of worker processes. Groups large enough are split one
+    at a time, as soon as their parent split completes, so that the pool fills up after a few levels; smaller
+    subtrees are visited as a whole by a single worker.
+
+    Returns
+    -------
+    :return leaves: list of (str, np.ndarray of int)
+        Labels and index arrays of the clustered groups, in depth-first order
+    """
+
+    leaves = list()
+
+    # Below this many records, subtrees are not worth
+    # being split across more than one worker
+    subtree_size = max(2*size, len(T) // (4*max_workers))
+
+    shared = SharedArrays({ 'QI': QI, 'QI_norm': QI_norm })
+
+    with shared, shared.pool(max_workers, { 'algorithm': algorithm, 'size': size, 'seed': seed,
+            'T_max_vals': T_max_vals, 'T_min_vals': T_min_vals }) as pool:
+        pending = dict() # Tasks running, along with the label of their group
+
+        def visit(T, label):
+            if len(T) < 2*size:
+                leaves.append((label, T))
+            elif len(T) <= subtree_size:
+                pending[pool.submit(cluster_subtree_task, T, label)] = label
+            else:
+                pending[pool.submit(bisection_task, T, label)] = None
+
+        visit(T, label)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for task in done:
+                subtree_label = pending.pop(task)
+
+                if subtree_label is None:
+                    (group_u, label_u), (group_v, label_v) = task.result()
+
+                    visit(group_u, label_u)
+                    visit(group_v, label_v)
+                else:
+                    leaves += task.result()
+
+    # Leaf labels are unique and none is a prefix of another, and 'a' < 'b',
+    # hence their lexicographic order is the depth-first order
+    leaves.sort(key=lambda leaf: leaf[0])
+
+    return leaves
+
+def bisection_task(T, label):
+    """
+    Split the group at `label` in a worker process, see `greedy_bisection()`
+    """
+
+    group_u, group_v = greedy_bisection(worker_constant('algorithm'), worker_array('QI'), T,
+            worker_constant('T_max_vals'), worker_constant('T_min_vals'), worker_array('QI_norm'),
+            split_rng(worker_constant('seed'), label))
+
+    return (group_u, label + 'a'), (group_v, label + 'b')
+
+def cluster_subtree_task(T, label):
+    """
+    Visit the whole subtree at `label` in a worker process, see `top_down_greedy_clustering()`
+    """
+
+    T_clustered = list()
+    T_structure = list()
+
+    top_down_greedy_clustering(worker_constant('algorithm'), worker_array('QI'), T, worker_constant('size'),
+            T_clustered, T_structure, label, worker_constant('T_max_vals'), worker_constant('T_min_vals'),
+            worker_array('QI_norm'), worker_constant('seed'))
+
+    return list(zip(T_structure, T_clustered))
+
+def greedy_bisection(algorithm, QI, T, T_max_vals=None, T_min_vals=None, QI_norm=None, rng=random):
+    """
+    Split the rows in `T` in two groups, each minimizing the intra-NCP (naive) or -VL (KAPRA) among its records,
+    i.e., a single step of `top_down_greedy_clustering()`. Random draws are taken from `rng`, the global `random`
+    generator by default.
+
+    Returns
+    -------
+    :return group_u: np.ndarray of int
+        Index array of the rows in the first group, labelled 'a'
+
+    :return group_v: np.ndarray of int
+        Index array of the rows in the second group, labelled 'b'
+    """
+
+    ids = T.tolist() # Rows not yet assigned to either group
 
     # 1. Initialize groups via a NCP maximization-based heuristic
-    group_u = dict()
-    group_v = dict()
+    group_u = list()
+    group_v = list()
+
+    seed = ids[rng.randint(0, len(ids) - 1)] # Draw a random row
+    group_u.append(seed)
 
-    seed = ids[random.randint(0, len(ids) - 1)] # Draw a random row Id
-    group_u[seed] = T[seed]
+    env_u = GroupEnvelope(QI[[ seed ]]) # Running envelopes of the two groups
+    env_v = None
 
     old = seed # Last visited record
 
     # to avoid this row to end up in two different groups
-    del T[seed]
     ids.remove(seed)
 
     # 1.a Fill the two groups alternately for # of ROUNDS
     # while maximiziming the respective NCP (naive) or IVL (KAPRA) metric
-    rounds = ROUNDS if len(T) >= ROUNDS else len(T)
+    rounds = ROUNDS if len(ids) >= ROUNDS else len(ids)
 
     for rnd in range(rounds):
         if rnd % 2 == 0:
-            source = group_u
             target = group_v
         else:
-            source = group_v
             target = group_u
 
         if algorithm == 'naive':
-            r = find_tuple_with_max_ncp(source[old], T, old, \
-                    T_max_vals, T_min_vals)
+            r = find_tuple_with_max_ncp(QI_norm[old], QI_norm, ids, old)
         elif algorithm == 'kapra':
-            r = find_tuple_with_max_vl(source[old], T, old)
+            r = find_tuple_with_max_vl(QI[old], QI, ids, old)
 
-        target[r] = T[r]
+        target.append(r)
         old = r
 
+        if env_v is None:
+            env_v = GroupEnvelope(QI[[ r ]])
+        elif rnd % 2 == 0:
+            env_v.add(QI[r])
+        else:
+            env_u.add(QI[r])
+
         # Update data structures
-        del T[r]
         ids.remove(r)
 
     # 1.b Assign each record to the group with lower NCP
-    random.shuffle(ids) # Shuffle leftover Ids
+    rng.shuffle(ids) # Shuffle leftover rows
 
     for i in ids:
-        row = T[i]
+        row = QI[i]
 
-        # Copy values to check what would happen
+        # Check what would happen
         # if row was added to either one separately
-        group_u_vals = list(group_u.values())
-        group_v_vals = list(group_v.values())
-
-        group_u_vals.append(row)
-        group_v_vals.append(row)
-
         if algorithm == 'naive':
-            metric_u = normalized_certainty_penalty(group_u_vals, \
-                    T_max_vals, T_min_vals)
-            metric_v = normalized_certainty_penalty(group_v_vals, \
-                    T_max_vals, T_min_vals)
+            metric_u = env_u.ncp_if_add(row, T_max_vals, T_min_vals)
+            metric_v = env_v.ncp_if_add(row, T_max_vals, T_min_vals)
         elif algorithm == 'kapra':
-            metric_u = instant_value_loss(group_u_vals)
-            metric_v = instant_value_loss(group_v_vals)
+            metric_u = env_u.vl_if_add(row)
+            metric_v = env_v.vl_if_add(row)
 
         if metric_v < metric_u:
-            group_v[i] = row
-            del group_u_vals[-1]
+            group_v.append(i)
+            env_v.add(row)
         else:
-            group_u[i] = row
-            del group_v_vals[-1]
-
-        del T[i]
+            group_u.append(i)
+            env_u.add(row)
 
-    # 2. Iterate recursively, or store groups if base case
-    if len(group_u) >= size:
-        top_down_greedy_clustering(algorithm, group_u, size, T_clustered, \
-                T_structure, label + 'a', T_max_vals, T_min_vals) # Extend label with 'a'
-    else:
-        T_clustered.append(group_u)
-        T_structure.append(label + 'a')
+    group_u = np.array(group_u, dtype=np.int64)
+    group_v = np.array(group_v, dtype=np.int64)
 
-    if len(group_v) >= size:
-        top_down_greedy_clustering(algorithm, group_v, size, T_clustered, \
-                T_structure, label + 'b', T_max_vals, T_min_vals) # Extend label with 'b'
-    else:
-        T_clustered.append(group_v)
-        T_structure.append(label + 'b')
+    return group_u, group_v
 
 
-def postprocessing(algorithm, size, T_clustered, T_structure,
+def postprocessing(algorithm, QI, size, T_clustered, T_structure,
         T_postprocessed, T_max_vals=None, T_min_vals=None):
     """
     Top down greedy search postprocessing, from Xu et al. 2006,
@@ -234,205 +377,241 @@ def postprocessing(algorithm, size, T_clustered, T_structure,
         - with its nearest neighbour, that is, the group with the most similar label in `T_structure`;
         - with the group at least large (2*`size` - |G|) that minimizes the metric.
 
+    Groups are processed in rounds over a worklist, until no bad groups are left, or none of them can be merged any further.
+    Each group is merged at most once per round, and the groups resulting from a round only take part in the next one.
+
     Parameters
     ----------
-    :param T_postprocessed: list of dict of list of int
-        List of good groups merged from `T_clustered`
+    :param QI: np.ndarray
+        2-D matrix of time-series records on QI attributes, which the groups index into
+
+    :param T_postprocessed: list of np.ndarray of int
+        List of good groups merged from `T_clustered`, as index arrays of rows
     """
 
-    idxs_merged = list()      # Already visited groups
-    groups_merged = list()    # Resulting merged groups
-    structure_merged = list() # Updated group labels
+    # Current groups and labels, by unique group Id. Dicts
+    # preserve insertion order, i.e., the order of the tree leaves
+    groups = dict(enumerate(T_clustered))
+    labels = dict(enumerate(T_structure))
+
+    next_id = len(groups)
+
+    while True:
+        bad_ids = [ group_id for (group_id, group) in groups.items() if len(group) < size ]
+
+        if not bad_ids:
+            break
 
+        # Per label construction, if the two labels bar the last char are equal, it means the two groups
+        # come from the same parent; hence they are the respective NN. Map each parent label to its children
+        # groups; groups with an empty label, i.e., merged with a large group, have no siblings
+        children = defaultdict(dict)
 
-    # 1. Find the two candidate groups
-    # print("T clustered is ", T_clustered)
-    """ print("T_structure is ", T_structure) """
-    for idx, bad_group in enumerate(T_clustered):
-        bad_g_size = len(bad_group)
-        if bad_g_size < size: # For any bad group
-            bad_group_vals = list(bad_group.values())
-            """ print("idx is ", idx) """
-            label = T_structure[idx]
+        for group_id, label in labels.items():
+            if label:
+                children[label[:-1]][group_id] = None
+
+        order = list(groups) # Group Ids in leaf order
+        position = { group_id: pos for (pos, group_id) in enumerate(order) }
+
+        # Envelopes of all groups in leaf order, to bound the
+        # metric of merging with any of them at once
+        R_plus, R_minus, sizes = envelope_matrices(QI, [ groups[group_id] for group_id in order ])
+
+        ids_merged = set()    # Groups already merged in this round
+        merged_mask = np.zeros(len(order), dtype=bool) # Same, by position in leaf order
+        groups_merged = list() # Resulting merged groups, along with their labels
+
+        # 1. Find the two candidate groups
+        for bad_id in bad_ids:
+            if bad_id in ids_merged:
+                continue # Already merged as another group's candidate
+
+            bad_group = groups[bad_id]
+            bad_g_size = len(bad_group)
+            label = labels[bad_id]
 
             # 1.a Find its nearest neighbour (NN) - 1st candidate group
 
             # Search the group's NN as the one
-            # with the most similar label
-            idx_nn = -1
-            found_nn = False
-            metric_nn = float('inf')
+            # with the most similar label, which
+            # hasn't already been merged with another group
+            id_nn = None
+
+            if label:
+                for other_id in children[label[:-1]]:
+                    if other_id != bad_id and other_id not in ids_merged:
+                        id_nn = other_id
+                        break
+
+            # Otherwise fall back to the closest group in leaf order,
+            # preferably the previous one
+            if id_nn is None:
+                pos = position[bad_id]
 
-            # print("T_structure is ", T_structure)
-            # print("Bad group label is ", label)
-            for other_idx, other_label in enumerate(T_structure):
-                # Per label construction, if the two labels
-                # bar the last char are equal, it means the two groups
-                # come from the same parent; hence they are the respective NN
-                # print("other label ", other_label)
-                if label[:-1] == other_label[:-1]: 
-                    if idx == other_idx:
-                        continue
-
-                    # If the group hasn't already been merged
-                    # with another group, mark it as a valid NN
-                    if other_idx not in idxs_merged:
-                        found_nn = True
-                        idx_nn = other_idx
+                for other_pos in list(range(pos - 1, -1, -1)) + list(range(pos + 1, len(order))):
+                    if order[other_pos] not in ids_merged:
+                        id_nn = order[other_pos]
                         break
-            # print("bad group index ", idx)
-            # print("indexes merged ", idxs_merged)
-
-            merge_with_other_group = False
-            if found_nn:
-                group_nn = T_clustered[idx_nn]
-            elif idx_nn !=idx:
-                if idx - 1 > 0:
-                    idx_nn = idx - 1
-                elif idx + 1 < len(T_structure) - 1:
-                    idx_nn = idx + 1 
-                group_nn = T_clustered[idx_nn]
-                merge_with_other_group = True
-
-            if found_nn or merge_with_other_group:
-                group_merged_nn = bad_group_vals
 
-                
-                group_merged_nn = group_merged_nn  \
-                            + list(group_nn.values())
+            env_bad = GroupEnvelope(QI[bad_group])
+            metric_nn = float('inf')
+
+            if id_nn is not None:
+                group_nn = groups[id_nn]
+                group_merged_nn = np.concatenate((bad_group, group_nn))
+                env_nn = GroupEnvelope(QI[group_nn])
                 
                 if algorithm == 'naive':
-                    metric_nn = normalized_certainty_penalty(group_merged_nn,
+                    metric_nn = env_bad.ncp_if_merge(env_nn,
                             T_max_vals, T_min_vals)
                 elif algorithm == 'kapra':
-                    metric_nn = instant_value_loss(group_merged_nn)
-
-                    # Redefine group_merged_nn as dict
-                group_merged_nn = dict()
-                group_merged_nn.update(bad_group)
-                group_merged_nn.update(group_nn)
+                    metric_nn = env_bad.vl_if_merge(env_nn)
 
             # 1.b Find the most appropriate large group (>= 2*size -|G|) - 2nd candidate group
             metric_large_g = float('inf')
-            idx_large_g = -1
-
-            for other_idx, other_group in enumerate(T_clustered):
-                # If the group is large enough
-                if len(other_group) >= 2*size - bad_g_size: # 2*size - |G|
-                    # print("dentro if large group metric")
-                    if other_idx not in idxs_merged:
-                        group_merged_large_g = bad_group.copy()
-                        group_large_g_vals = list(group_merged_large_g.values())
-
-                        # Select the size - |G| records from the large group that minimize
-                        # the intra-NCP or VL metric with the original group
-                        for j in range(size - bad_g_size): # size - |G|
-                            tmp_metric = float('inf')
-
-                            best_record = {}
-                            best_row = []
-
-                            # Select the best record to merge
-                            # at the j-th iteration
-                            for ridx, row in other_group.items():
-                                if ridx not in group_merged_large_g.keys():
-                                    if algorithm == 'naive':
-                                        metric = normalized_certainty_penalty(group_large_g_vals + [ row ],
-                                                T_max_vals, T_min_vals)
-                                    elif algorithm == 'kapra':
-                                        metric = instant_value_loss(group_large_g_vals + [ row ])
-
-                                    if metric < tmp_metric: # Update min metric
-                                        best_record = { ridx : row }
-                                        tmp_metric = metric
-                                        best_row = row
-            
-                            group_merged_large_g.update(best_record)
-                            group_large_g_vals.append(best_row)
-
-                        # Check if the current candidate large group
-                        # is better than any previous ones
-                        if tmp_metric < metric_large_g:
-                            metric_large_g = tmp_metric
-                            idx_large_g = other_idx
-
-                            # Isolate the records that are kept from
-                            # the original (2*size - |G|) large group
-                            leftover_group_large_g = { k : val for (k, val)
-                                    in other_group.items()
-                                    if k not in group_merged_large_g.keys() }
-            # print("group_merged_large_g \n\n", group_merged_large_g)
-            """ print("Metric nn: ", str(metric_nn))
-            print("Metric large group: ", str(metric_large_g))
-            print("Found nn: ", str(found_nn))
-            # print("group merged nn ", group_merged_nn)
-            print("Bad group label: ", label)
-            print("Bad group: ", bad_group) """
+            id_large_g = None
+
+            # Large enough groups, which haven't already been merged, in leaf order
+            large_pos = np.flatnonzero((sizes >= 2*size - bad_g_size) & ~merged_mask) # 2*size - |G|
+
+            # Lower bound of the metric of G merged with size - |G| records from each large group, as each
+            # attribute spans at least the envelope of G extended to the closest value of the large group's range
+            lb_r_plus  = np.maximum(env_bad.r_plus, R_minus[large_pos])
+            lb_r_minus = np.minimum(env_bad.r_minus, R_plus[large_pos])
+
+            if algorithm == 'naive':
+                lbs = certainty_penalty(size, lb_r_plus, lb_r_minus, T_max_vals, T_min_vals)
+            elif algorithm == 'kapra':
+                lbs = value_loss(size, lb_r_plus, lb_r_minus)
+
+            # Visit large groups by increasing lower bound, ties broken by leaf order
+            visit = np.argsort(lbs, kind='stable')
+
+            for lb, pos in zip(lbs[visit].tolist(), large_pos[visit].tolist()):
+                # No large group left can beat either candidate
+                if lb > min(metric_nn, metric_large_g):
+                    break
+
+                other_id = order[pos]
+                other_group = groups[other_id]
+
+                env_merged_large_g = env_bad.copy()
+                candidates = other_group # Records of the large group not merged yet
+                pruned = False
+
+                # Select the size - |G| records from the large group that minimize
+                # the intra-NCP or VL metric with the original group
+                for j in range(size - bad_g_size): # size - |G|
+                    candidates_vals = QI[candidates]
+
+                    # Score every candidate record
+                    # at the j-th iteration at once
+                    if algorithm == 'naive':
+                        metrics = env_merged_large_g.ncp_if_add(candidates_vals,
+                                T_max_vals, T_min_vals)
+                    elif algorithm == 'kapra':
+                        metrics = env_merged_large_g.vl_if_add(candidates_vals)
+
+                    # Select the best record to merge
+                    best_record = np.argmin(metrics)
+                    tmp_metric = metrics[best_record]
+
+                    env_merged_large_g.add(candidates_vals[best_record])
+                    candidates = np.delete(candidates, best_record)
+
+                    # The envelope can only widen with further records, hence the metric at full size
+                    # is at least the current one rescaled. Abandon the large group early if it cannot
+                    # beat either candidate, with some slack against round-off
+                    if tmp_metric*size/(bad_g_size + j + 1) > min(metric_nn, metric_large_g)*(1 + BOUND_SLACK):
+                        pruned = True
+                        break
+
+                if pruned:
+                    continue
+
+                # Check if the current candidate large group is better than any previous
+                # ones, or as good but earlier in leaf order, as in a sequential scan
+                if tmp_metric < metric_large_g or (tmp_metric == metric_large_g and pos < position[id_large_g]):
+                    metric_large_g = tmp_metric
+                    id_large_g = other_id
+
+                    # Isolate the records that are kept from
+                    # the original (2*size - |G|) large group
+                    leftover_group_large_g = candidates
+                    best_merged_large_g = np.concatenate((bad_group,
+                            np.setdiff1d(other_group, candidates, assume_unique=True)))
+
             # 1.c Choose which of the two candidate
             # groups is best to merge with
-            """ if math.isinf(metric_nn) and math.isinf(metric_large_g):
-                continue  """
-            if metric_nn < metric_large_g: 
-                idxs_merged.append(idx_nn)
-                groups_merged.append(group_merged_nn)
-                structure_merged.append(label[:-1]) 
-                # print("NN CASE")
+            if id_nn is None and id_large_g is None:
+                continue # No group left to merge with
+
+            if metric_nn < metric_large_g or id_large_g is None:
+                ids_merged.add(id_nn)
+                merged_mask[position[id_nn]] = True
+                groups_merged.append((group_merged_nn, label[:-1]))
             else:
-                # print("dentro else")
-                idxs_merged.append(idx_large_g)
-                # Add both groups to merge
-                groups_merged.append(group_merged_large_g)
-                groups_merged.append(leftover_group_large_g)
-                # print("LARGE GROUP CASE")
-                structure_merged.append('') # Add empty label for new group
+                ids_merged.add(id_large_g)
+                merged_mask[position[id_large_g]] = True
+                # Add both groups to merge: the leftover large group keeps its label,
+                # while the new group gets an empty one
+                groups_merged.append((best_merged_large_g, ''))
+                groups_merged.append((leftover_group_large_g, labels[id_large_g]))
 
             # Add the currently processed group Id
             # to already visited groups Ids
-            idxs_merged.append(idx)
-
-    # 2. Re-assest outer data structures
-    T_clustered = [ group for (idx, group)
-            in enumerate(T_clustered)
-            if idx not in idxs_merged ]
-    T_clustered += groups_merged 
-
-    T_structure = [ label for (idx, label)
-            in enumerate(T_structure)
-            if idx not in idxs_merged]
-    T_structure += structure_merged
+            ids_merged.add(bad_id)
+            merged_mask[position[bad_id]] = True
 
-    T_postprocessed += T_clustered
+        if not ids_merged:
+            break # The bad groups left cannot be merged any further
 
-    # 3. Check if there are any more bad groups
-    bad_groups_cnt = 0
+        # 2. Re-assest data structures for the next round
+        for group_id in ids_merged:
+            del groups[group_id]
+            del labels[group_id]
 
-    for group in T_clustered:
-        if len(group) < size:
-            bad_groups_cnt +=1
+        for group, label in groups_merged:
+            groups[next_id] = group
+            labels[next_id] = label
+            next_id += 1
 
-    # print("Number of bad groups before a possible recursive call: ", str(bad_groups_cnt))
+    T_postprocessed += list(groups.values())
 
-# def postprocessing(algorithm, size, T_clustered, T_structure, T_postprocessed, T_max_vals=None, T_min_vals=None):
-    if bad_groups_cnt > 0: # Call recursively if any left
-        postprocessing(algorithm, size, T_clustered, T_structure,
-                T_postprocessed, T_max_vals, T_min_vals)
-
-def create_tree(algorithm, T, PR, P_value, paa_value, max_level=MAX_LEVEL):
+def create_tree(algorithm, words, T, PR, P_value, paa_value, max_level=MAX_LEVEL, max_workers=1):
     """
     Split a group of records into sub-groups of at least `P_value` records with the same pattern. This procedure applies to both naive
     and KAPRA (k, P)-anonymity, starting from a k-group or from the whole time series data, respectively.
 
     Parameters
     ----------
+    :param words: np.ndarray of str
+        Per-level SAX code matrix of the whole table, from `sax_code_matrix()`, covering at least up to `max_level`
+
+    :param T: np.ndarray of int
+        Index array of the rows of `words` to split
+
     :param PR: dict
-        Dict of per-record pattern representations from `T`
+        Dict of per-record pattern representations from `T`, keyed by row
+
+    :param max_workers: int - 1
+        # of worker processes growing the tree, see `grow_tree()`
+
+    Returns
+    -------
+    :return P_groups: list of np.ndarray of int
+        P-subgroups, as index arrays of rows
+
+    :return suppressed_groups: list of np.ndarray of int
+        Groups of records to suppress (KAPRA-only), as index arrays of rows
     """
     # P-groups leaf nodes
     bad_leaf_nodes  = list()
     good_leaf_nodes = list()
 
-    node = Node(level=1, group=T, paa_value=paa_value)
-    node.start_splitting(P_value, max_level, good_leaf_nodes, bad_leaf_nodes)
+    node = Node(level=1, group=T, paa_value=paa_value, words=words)
+    grow_tree(node, P_value, max_level, good_leaf_nodes, bad_leaf_nodes, max_workers)
 
     suppressed_nodes = list()
         
@@ -453,7 +632,137 @@ def create_tree(algorithm, T, PR, P_value, paa_value, max_level=MAX_LEVEL):
         P_groups.append(node.group)
         pr = node.pattern_representation
 
-        for key in node.group:
-            PR[key] = pr
+        for row in node.group.tolist():
+            PR[row] = pr
 
     return P_groups, suppressed_groups
+
+def grow_tree(node, P_value, max_level, good_leaf_nodes, bad_leaf_nodes, max_workers=1):
+    """
+    Run the node splitting procedure from `node`, optionally partitioned over a pool of worker processes sharing
+    the SAX code matrix. The tree is split in the current process down to its first real split, i.e., records are
+    partitioned by their coarse SAX word; then each partition's subtree is grown by a worker. Leaves are collected
+    in the same order as a serial visit, so that the bad leaves can be recycled globally afterwards.
+    """
+
+    if max_workers <= 1:
+        node.start_splitting(P_value, max_level, good_leaf_nodes, bad_leaf_nodes)
+        return
+
+    children = node.split_children(P_value, max_level, good_leaf_nodes, bad_leaf_nodes)
+
+    # A single child is no real split
+    while len(children) == 1:
+        children = children[0].split_children(P_value, max_level, good_leaf_nodes, bad_leaf_nodes)
+
+    if not children:
+        return
+
+    shared = SharedArrays({ 'words': node.words })
+
+    with shared, shared.pool(max_workers, { 'P_value': P_value, 'max_level': max_level,
+            'paa_value': node.paa_value }) as pool:
+        # Submit largest partitions first, but collect them in order
+        tasks = [ None ]*len(children)
+
+        for child_idx in sorted(range(len(children)), key=lambda child_idx: -children[child_idx].size):
+            child = children[child_idx]
+            tasks[child_idx] = pool.submit(grow_subtree_task, child.level, child.pattern_representation,
+                    child.label, child.group)
+
+        for task in tasks:
+            good_leaves, bad_leaves = task.result()
+
+            for leaves, leaf_nodes in ((good_leaves, good_leaf_nodes), (bad_leaves, bad_leaf_nodes)):
+                for level, pr, label, group in leaves:
+                    leaf_nodes.append(Node(level=level, pattern_representation=pr, label=label,
+                            group=group, paa_value=node.paa_value, words=node.words))
+
+def grow_subtree_task(level, pattern_representation, label, group):
+    """
+    Grow the subtree of a single partition in a worker process, see `grow_tree()`. Leaves are returned as
+    (level, pattern representation, label, group) tuples, as nodes refer to the shared SAX code matrix.
+    """
+
+    good_leaf_nodes = list()
+    bad_leaf_nodes  = list()
+
+    node = Node(level=level, pattern_representation=pattern_representation, label=label, group=group,
+            paa_value=worker_constant('paa_value'), words=worker_array('words'))
+    node.start_splitting(worker_constant('P_value'), worker_constant('max_level'), good_leaf_nodes, bad_leaf_nodes)
+
+    return [ [ (leaf.level, leaf.pattern_representation, leaf.label, leaf.group) for leaf in leaf_nodes ]
+            for leaf_nodes in (good_leaf_nodes, bad_leaf_nodes) ]
+
+def create_tree_forest(algorithm, words, groups, PR, P_value, paa_value, max_level=MAX_LEVEL, max_workers=1):
+    """
+    Run `create_tree()` on each of many independent groups of records, e.g., all k-groups in naive (k, P)-anonymity,
+    optionally spread over a pool of worker processes sharing `words`. Groups are packed into tasks of similar total
+    size, largest first, so that workers are evenly loaded. Since `create_tree()` is deterministic, results are the same
+    as running it on each group in turn.
+
+    Parameters
+    ----------
+    :param groups: list of np.ndarray of int
+        Index arrays of the rows of each group to split
+
+    :param PR: dict
+        Dict of per-record pattern representations from all groups, keyed by row
+
+    :param max_workers: int - 1
+        # of worker processes. Groups are split in the current process if 1
+
+    Returns
+    -------
+    :return forest: list of (list of np.ndarray of int, list of np.ndarray of int)
+        P-subgroups and groups of records to suppress of each group, see `create_tree()`
+    """
+
+    if max_workers <= 1 or len(groups) < 2:
+        return [ create_tree(algorithm, words, T, PR, P_value, paa_value, max_level) for T in groups ]
+
+    # Longest processing time first: assign each group,
+    # largest first, to the least loaded task so far
+    tasks = [ list() for _ in range(min(len(groups), 4*max_workers)) ]
+    loads = [ (0, task_idx) for task_idx in range(len(tasks)) ]
+
+    for group_idx in sorted(range(len(groups)), key=lambda group_idx: -len(groups[group_idx])):
+        load, task_idx = heapq.heappop(loads)
+        tasks[task_idx].append(group_idx)
+        heapq.heappush(loads, (load + len(groups[group_idx]), task_idx))
+
+    forest = [ None ]*len(groups)
+
+    shared = SharedArrays({ 'words': words })
+
+    with shared, shared.pool(max_workers, { 'algorithm': algorithm, 'P_value': P_value,
+            'paa_value': paa_value, 'max_level': max_level }) as pool:
+        results = pool.map(create_tree_task, [ [ groups[group_idx] for group_idx in task ] for task in tasks ])
+
+        for task, task_results in zip(tasks, results):
+            for group_idx, (P_groups, suppressed_groups, prs) in zip(task, task_results):
+                forest[group_idx] = (P_groups, suppressed_groups)
+
+                # Merge the returned pattern representations
+                for P_group, pr in zip(P_groups, prs):
+                    PR.update(dict.fromkeys(P_group.tolist(), pr))
+
+    return forest
+
+def create_tree_task(groups):
+    """
+    Run `create_tree()` on each group in a worker process. Pattern representations are returned once per P-subgroup,
+    rather than once per record.
+    """
+
+    results = list()
+
+    for T in groups:
+        PR = dict()
+
+        P_groups, suppressed_groups = create_tree(worker_constant('algorithm'), worker_array('words'), T, PR,
+                worker_constant('P_value'), worker_constant('paa_value'), worker_constant('max_level'))
+
+        results.append((P_groups, suppressed_groups, [ PR[P_group[0]] for P_group in P_groups ]))
+
+    return results
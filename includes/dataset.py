@@ -0,0 +1,76 @@
+import numpy as np
+
+
+class Dataset:
+    """
+    Columnar representation of a time-series table.
+
+    QI attributes are kept in a single contiguous 2-D matrix, with one row per record, next to a vector of sensitive
+    attribute (A_s) values and an index from record Ids to rows. Every group of records produced along the pipeline
+    (k-groups, P-subgroups, suppressed groups) is expressed as an index array of rows into `QI`, so that no row data
+    is ever copied around.
+
+    Parameters
+    ----------
+    :param ids: np.ndarray
+        Unique Ids of the records, in table order
+
+    :param QI: np.ndarray
+        2-D matrix of QI attributes, shaped (# of records, # of QI attributes)
+
+    :param A_s: np.ndarray
+        Vector of sensitive attribute values, aligned with `ids`
+
+    :param col_names: list of str
+        Id column name followed by the QI attributes column names
+
+    :param QI_min_vals: np.ndarray - None
+        Min value for each QI attribute, computed from `QI` if not given
+
+    :param QI_max_vals: np.ndarray - None
+        Max value for each QI attribute, computed from `QI` if not given
+    """
+
+    def __init__(self, ids, QI, A_s, col_names, QI_min_vals=None, QI_max_vals=None):
+        self.ids = np.asarray(ids)
+        self.QI = np.ascontiguousarray(QI)
+        self.A_s = np.asarray(A_s)
+        self.col_names = list(col_names)
+
+        # Boundaries only make sense on numeric tables,
+        # i.e., not on anonymized "[min|max]" envelopes
+        numeric = self.QI.dtype != object and len(self.QI) > 0
+
+        if QI_min_vals is None and numeric:
+            QI_min_vals = self.QI.min(axis=0)
+
+        if QI_max_vals is None and numeric:
+            QI_max_vals = self.QI.max(axis=0)
+
+        self.QI_min_vals = QI_min_vals
+        self.QI_max_vals = QI_max_vals
+
+        self.id_to_row = { key : row for row, key in enumerate(self.ids.tolist()) }
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, keys=None):
+        """
+        Index array of the rows matching the given record Ids, or of all rows if no Ids are given.
+
+        Parameters
+        ----------
+        :param keys: iterable of Ids - None
+            Record Ids to look up
+
+        Returns
+        -------
+        :return rows: np.ndarray of int
+            Row indexes into `QI`
+        """
+
+        if keys is None:
+            return np.arange(len(self), dtype=np.int64)
+
+        return np.fromiter((self.id_to_row[key] for key in keys), dtype=np.int64)
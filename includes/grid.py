@@ -0,0 +1,226 @@
+"""
+In-process runner of a grid of (k, P)-anonymity experiments. Each dataset is loaded once, and its QI matrix shared
+with worker processes, which then run the (dataset, algorithm, k, P, paa, l) cells as tasks, longest-expected first.
+Naive cells are run one by one, while KAPRA cells sharing the same dataset, P and paa are run as a single sweep, which
+builds their P-subgroup forest only once.
+"""
+
+import math
+
+import pandas as pd
+
+from concurrent.futures import as_completed
+from loguru import logger
+
+# Custom imports #
+from .anonymize import anonymize
+from .anonymize import anonymize_kapra_sweep
+from .cache import ResultCache
+from .dataset import Dataset
+from .io import RESULTS_COLUMNS
+from .io import save_results
+from .parallel import SharedArrays
+from .parallel import worker_array
+from .parallel import worker_constant
+
+GRID_COLUMNS = [ 'dataset', 'algorithm', 'k', 'P', 'paa', 'l' ]
+
+WORKER_DATASETS = dict() # Datasets rebuilt by the current worker process from the shared matrices, by name
+
+def expected_cost(algorithm, num_records, num_attributes, k_values, P_value):
+    """
+    Rough relative running time of a task, only meant to rank tasks against each other. The naive algorithm is
+    dominated by the top down greedy clustering of the whole table, whose bisections cost O(n^2 d / k) overall,
+    while KAPRA by the bottom-up merging of its O(n / P) P-subgroups into O(n / k) k-groups, after a single
+    create-tree phase shared by all the k-requirements of the task.
+    """
+
+    n, d = num_records, num_attributes
+
+    if algorithm == 'naive':
+        return sum(n*n*d / k_value for k_value in k_values)
+
+    return n*d*math.log2(max(n, 2)) + sum((n / P_value)*(n / k_value)*d for k_value in k_values)
+
+def group_cells(cells):
+    """
+    Group the cells of a grid into tasks: a KAPRA task per (dataset, P, paa), and a naive task per cell
+
+    Returns
+    -------
+    :return tasks: list of list of int
+        Indexes of the cells of each task, in order
+    """
+
+    tasks = dict()
+
+    for idx, cell in enumerate(cells):
+        dataset_name, algorithm, _, P_value, paa_value, _ = cell
+
+        if algorithm.lower() == 'kapra':
+            tasks.setdefault((dataset_name, P_value, paa_value), list()).append(idx)
+        else:
+            tasks[idx] = [ idx ]
+
+    return list(tasks.values())
+
+def run_cell(dataset, cell, cache_dir=None, seed=None):
+    """
+    Run a single cell of the grid on its dataset in memory, unless already cached in `cache_dir`
+
+    Returns
+    -------
+    :return results: list of float
+        Metrics of the run, see `RESULTS_COLUMNS`
+
+    :return cached: bool
+        Whether the run was served from the cache
+    """
+
+    _, algorithm, k_value, P_value, paa_value, l_value = cell
+
+    if cache_dir is None:
+        result = anonymize(dataset, algorithm, k_value, P_value, paa_value, l_value, seed=seed)
+        cached = False
+    else:
+        result, cached = ResultCache(cache_dir).anonymize(dataset, algorithm, k_value, P_value, paa_value,
+                l_value, seed=seed)
+
+    return result.results(), cached
+
+def run_task(dataset, task_cells, cache_dir=None, seed=None):
+    """
+    Run a task of the grid on its dataset in memory, see `group_cells()`. The cells of a KAPRA task are run as a
+    single sweep, see `anonymize_kapra_sweep()`, each (k, l) pair still being cached on its own.
+
+    Returns
+    -------
+    :return outcomes: list of tuple
+        (results, cached) pairs of each cell of the task, in order, see `run_cell()`
+    """
+
+    if task_cells[0][1].lower() != 'kapra':
+        return [ run_cell(dataset, cell, cache_dir, seed) for cell in task_cells ]
+
+    _, _, _, P_value, paa_value, _ = task_cells[0]
+
+    K_l_values = [ (k_value, l_value) for _, _, k_value, _, _, l_value in task_cells ]
+
+    if cache_dir is None:
+        outcomes = [ (result, False) for result in anonymize_kapra_sweep(dataset, K_l_values, P_value,
+                paa_value, seed=seed) ]
+    else:
+        outcomes = ResultCache(cache_dir).anonymize_kapra_sweep(dataset, K_l_values, P_value, paa_value,
+                seed=seed)
+
+    return [ (result.results(), cached) for result, cached in outcomes ]
+
+def worker_dataset(name):
+    """
+    Dataset `name`, rebuilt once per worker process on top of its shared QI matrix
+    """
+
+    if name not in WORKER_DATASETS:
+        ids, A_s, col_names, QI_min_vals, QI_max_vals = worker_constant(name)
+
+        WORKER_DATASETS[name] = Dataset(ids, worker_array(name), A_s, col_names,
+                QI_min_vals, QI_max_vals)
+
+    return WORKER_DATASETS[name]
+
+def grid_task(task_cells):
+    """
+    Worker task of the grid, see `run_task()`
+    """
+
+    return run_task(worker_dataset(task_cells[0][0]), task_cells, worker_constant('cache_dir'),
+            worker_constant('seed'))
+
+def run_grid(datasets, cells, results_dir=None, cache_dir=None, seed=None, max_workers=1):
+    """
+    Run a grid of (k, P)-anonymity experiments in process, as tasks, see `group_cells()`, longest-expected first,
+    see `expected_cost()`
+
+    Parameters
+    ----------
+    :param datasets: dict of Dataset
+        Datasets already in memory, by name, e.g., their file name
+
+    :param cells: list of tuple
+        (dataset name, algorithm, k, P, paa, l) cells of the grid
+
+    :param results_dir: str - None
+        Directory to also save the results of each cell into, with the same file names and format as
+        `k_P_anonymity.py`. Nothing is saved if None.
+
+    :param cache_dir: str - None
+        Directory of the result cache, see `ResultCache`, so that only cells missing from it are computed.
+        Nothing is cached if None.
+
+    :param seed: int - None
+        Seed of every cell, see `anonymize()`
+
+    :param max_workers: int
+        Number of worker processes running tasks. Tasks are run serially if 1.
+
+    Returns
+    -------
+    :return results_df: pd.DataFrame
+        Results of all cells, in the given order, with the grid columns, see `GRID_COLUMNS`, followed by the same
+        metrics as `k_P_anonymity.py` and by whether each cell was served from the cache
+
+    :return errs: list of tuple
+        (cell, error message) pairs of the cells which failed, and are left out of `results_df`. A failure of a
+        KAPRA task fails all of its cells.
+    """
+
+    # Longest-expected tasks first, so that the
+    # shortest ones fill the pool at the end
+    tasks = sorted(group_cells(cells), key=lambda task: -expected_cost(cells[task[0]][1].lower(),
+            len(datasets[cells[task[0]][0]]), datasets[cells[task[0]][0]].QI.shape[1],
+            [ cells[idx][2] for idx in task ], cells[task[0]][3]))
+
+    outcomes = dict()
+    errs = list()
+
+    if max_workers > 1 and len(tasks) > 1:
+        arrays = { name: dataset.QI for name, dataset in datasets.items() }
+
+        constants = { name: (dataset.ids, dataset.A_s, dataset.col_names, dataset.QI_min_vals,
+                dataset.QI_max_vals) for name, dataset in datasets.items() }
+        constants.update({ 'cache_dir': cache_dir, 'seed': seed })
+
+        with SharedArrays(arrays) as shared, shared.pool(max_workers, constants) as pool:
+            futures = { pool.submit(grid_task, [ cells[idx] for idx in task ]): task for task in tasks }
+
+            for future in as_completed(futures):
+                task = futures[future]
+
+                try:
+                    outcomes.update(zip(task, future.result()))
+                except Exception as e:
+                    errs.extend((cells[idx], str(e)) for idx in task)
+    else:
+        for task in tasks:
+            try:
+                outcomes.update(zip(task, run_task(datasets[cells[task[0]][0]], [ cells[idx] for idx in task ],
+                        cache_dir, seed)))
+            except Exception as e:
+                errs.extend((cells[idx], str(e)) for idx in task)
+
+    rows = list()
+
+    for idx, cell in enumerate(cells):
+        if idx not in outcomes:
+            continue
+
+        results, cached = outcomes[idx]
+        rows.append(list(cell) + results + [ cached ])
+
+        if results_dir is not None:
+            save_results(results_dir, *cell, results)
+
+    logger.info('Ran {} cells, {} from cache, {} failed'.format(len(cells),
+            sum(row[-1] for row in rows), len(errs)))
+
+    return pd.DataFrame(rows, columns=GRID_COLUMNS + RESULTS_COLUMNS + [ 'cached' ]), errs
@@ -0,0 +1,271 @@
+import numpy as np
+
+
+class GroupEnvelope:
+    """
+    Running envelope of a group of records, that is, the per-QI-attribute max (r+) and min (r-) values over the group,
+    along with the group size. Both NCP and VL only depend on the envelope, so adding a record or merging another group
+    costs O(d) instead of O(|group|*d), and so does evaluating what the metric would be after either operation.
+
+    Parameters
+    ----------
+    :param values: np.ndarray
+        2-D matrix of the QI attributes of the group records, shaped (# of records, # of QI attributes)
+    """
+
+    def __init__(self, values):
+        values = np.asarray(values)
+
+        self.r_plus  = values.max(axis=0)
+        self.r_minus = values.min(axis=0)
+        self.size = len(values)
+
+    @classmethod
+    def from_bounds(cls, r_plus, r_minus, size):
+        """
+        Build the envelope of a group of `size` records straight from its r+ and r- vectors,
+        e.g., as read back from an anonymized table
+        """
+
+        envelope = cls.__new__(cls)
+
+        envelope.r_plus  = np.array(r_plus)
+        envelope.r_minus = np.array(r_minus)
+        envelope.size = size
+
+        return envelope
+
+    def copy(self):
+        return GroupEnvelope.from_bounds(self.r_plus, self.r_minus, self.size)
+
+    def add(self, row):
+        """
+        Add a single record to the group
+        """
+
+        np.maximum(self.r_plus, row, out=self.r_plus)
+        np.minimum(self.r_minus, row, out=self.r_minus)
+        self.size += 1
+
+    def merge(self, other):
+        """
+        Merge another group into this one
+        """
+
+        np.maximum(self.r_plus, other.r_plus, out=self.r_plus)
+        np.minimum(self.r_minus, other.r_minus, out=self.r_minus)
+        self.size += other.size
+
+    def vl(self):
+        """
+        Instant value loss, VL(G), of the group
+        """
+
+        return value_loss(self.size, self.r_plus, self.r_minus)
+
+    def ncp(self, T_max_vals, T_min_vals):
+        """
+        Normalized certainty penalty, NCP(G), of the group
+        """
+
+        return certainty_penalty(self.size, self.r_plus, self.r_minus, T_max_vals, T_min_vals)
+
+    def vl_if_add(self, values):
+        """
+        VL of the group if a record were added to it. If `values` is a 2-D matrix of records, it returns the
+        vector of what-if metrics for each record separately.
+        """
+
+        return value_loss(self.size + 1, np.maximum(self.r_plus, values),
+                np.minimum(self.r_minus, values))
+
+    def ncp_if_add(self, values, T_max_vals, T_min_vals):
+        """
+        NCP of the group if a record were added to it. If `values` is a 2-D matrix of records, it returns the
+        vector of what-if metrics for each record separately.
+        """
+
+        return certainty_penalty(self.size + 1, np.maximum(self.r_plus, values),
+                np.minimum(self.r_minus, values), T_max_vals, T_min_vals)
+
+    def vl_if_merge(self, other):
+        """
+        VL of the group if another group were merged into it
+        """
+
+        return value_loss(self.size + other.size, np.maximum(self.r_plus, other.r_plus),
+                np.minimum(self.r_minus, other.r_minus))
+
+    def ncp_if_merge(self, other, T_max_vals, T_min_vals):
+        """
+        NCP of the group if another group were merged into it
+        """
+
+        return certainty_penalty(self.size + other.size, np.maximum(self.r_plus, other.r_plus),
+                np.minimum(self.r_minus, other.r_minus), T_max_vals, T_min_vals)
+
+
+class EnvelopeIndex:
+    """
+    Nearest-neighbour index over the envelopes of many groups, which finds the group whose merge with a given one
+    yields the least instant value loss, without evaluating the merge with every group. As the range of the merged
+    envelope on each QI attribute is no less than the distance of the two centers plus the two half ranges, so is
+    its RMS over all attributes than the distance of the mean centers plus the mean half ranges. Groups are thus
+    sorted by the mean of their centers, and only the ones in a window around the given group are evaluated, whose
+    width is bounded by a few nearby merges first. Groups can be removed from the index, but not added to it.
+
+    Parameters
+    ----------
+    :param r_plus: np.ndarray
+        Matrix of the r+ vectors of each group, shaped (# of groups, # of QI attributes)
+
+    :param r_minus: np.ndarray
+        Matrix of the r- vectors of each group, shaped (# of groups, # of QI attributes)
+
+    :param sizes: np.ndarray of int
+        Size of each group
+    """
+
+    WINDOW = 16 # Nearby groups evaluated first, on either side
+    SLACK = 1e-9 # Relative slack on the window, against round-off
+
+    def __init__(self, r_plus, r_minus, sizes):
+        self.r_plus = r_plus
+        self.r_minus = r_minus
+        self.sizes = sizes
+
+        centers = (np.mean(r_plus, axis=1, dtype=float) + np.mean(r_minus, axis=1, dtype=float)) / 2
+        half_ranges = np.mean(np.subtract(r_plus, r_minus, dtype=float), axis=1) / 2
+
+        self.order = np.argsort(centers, kind='stable')
+        self.centers = centers[self.order]
+
+        # Lower bounds over all groups, removed ones included
+        self.min_size = sizes.min(initial=0)
+        self.min_half_range = half_ranges.min(initial=0.)
+
+        self.alive = np.ones(len(sizes), dtype=bool)
+        self.num_alive = len(sizes)
+
+    def remove(self, idx):
+        self.alive[idx] = False
+        self.num_alive -= 1
+
+        # Removed groups are dropped from the sorted order once they make up
+        # half of it, so that windows span twice the groups left at most
+        if 2*self.num_alive <= len(self.order):
+            alive = self.alive[self.order]
+
+            self.order = self.order[alive]
+            self.centers = self.centers[alive]
+
+    def vls_if_merge(self, envelope, idxs):
+        """
+        VL of the envelope if each of the groups at `idxs` were merged into it
+        """
+
+        return value_loss(envelope.size + self.sizes[idxs], np.maximum(self.r_plus[idxs], envelope.r_plus),
+                np.minimum(self.r_minus[idxs], envelope.r_minus))
+
+    def window(self, lo, hi):
+        """
+        Indexes of the groups left between sorted positions `lo` and `hi`
+        """
+
+        idxs = self.order[max(lo, 0):min(hi, len(self.order))]
+
+        return idxs[self.alive[idxs]]
+
+    def best_merge(self, envelope):
+        """
+        Index of the group left whose merge into the envelope yields the least instant value loss, the lower index
+        first among ties, or None if no group is left
+        """
+
+        if self.num_alive == 0:
+            return None
+
+        center = (np.mean(envelope.r_plus, dtype=float) + np.mean(envelope.r_minus, dtype=float)) / 2
+        half_range = np.mean(np.subtract(envelope.r_plus, envelope.r_minus, dtype=float)) / 2
+
+        pos = int(np.searchsorted(self.centers, center))
+
+        # 1. Bound the least VL by the nearby groups, widening
+        # the window until it holds any group left
+        width = self.WINDOW
+        idxs = self.window(pos - width, pos + width)
+
+        while len(idxs) == 0:
+            width *= 2
+            idxs = self.window(pos - width, pos + width)
+
+        best_vl = self.vls_if_merge(envelope, idxs).min()
+
+        # 2. Only groups whose mean centers are close enough can do
+        # no worse, and they are all evaluated
+        radius = best_vl*(1 + self.SLACK) / (envelope.size + self.min_size) - half_range - self.min_half_range
+
+        lo = int(np.searchsorted(self.centers, center - radius, side='left'))
+        hi = int(np.searchsorted(self.centers, center + radius, side='right'))
+
+        idxs = self.window(min(lo, pos - width), max(hi, pos + width))
+        vls = self.vls_if_merge(envelope, idxs)
+
+        return int(idxs[vls == vls.min()].min())
+
+def envelope_matrices(QI, groups):
+    """
+    Envelopes of many groups of records at once, in a single reduction over their concatenated rows
+
+    Parameters
+    ----------
+    :param QI: np.ndarray
+        2-D matrix of the QI attributes of all records
+
+    :param groups: list of np.ndarray of int
+        Non-empty index arrays of the rows of each group
+
+    Returns
+    -------
+    :return R_plus: np.ndarray
+        Matrix of the r+ vectors of each group, shaped (# of groups, # of QI attributes)
+
+    :return R_minus: np.ndarray
+        Matrix of the r- vectors of each group, shaped (# of groups, # of QI attributes)
+
+    :return sizes: np.ndarray of int
+        Size of each group
+    """
+
+    sizes = np.array([ len(group) for group in groups ], dtype=np.int64)
+
+    if len(groups) == 0:
+        return np.empty((0, QI.shape[1]), QI.dtype), np.empty((0, QI.shape[1]), QI.dtype), sizes
+
+    values = QI[np.concatenate(groups)]
+    offsets = np.concatenate(([ 0 ], np.cumsum(sizes)[:-1]))
+
+    return np.maximum.reduceat(values, offsets), np.minimum.reduceat(values, offsets), sizes
+
+def value_loss(size, r_plus, r_minus):
+    """
+    VL(T) = |T| * sqrt(sum_i (r+_i - r-_i)^2 / n), over one or more envelopes (last axis)
+    """
+
+    n = np.shape(r_plus)[-1] # # of QI attributes
+    vl_t = np.sum(np.subtract(r_plus, r_minus, dtype=float)**2, axis=-1) / n
+
+    return size*np.sqrt(vl_t)
+
+def certainty_penalty(size, r_plus, r_minus, T_max_vals, T_min_vals):
+    """
+    NCP(T) = |T| * sum_i (z_i - y_i) / |A_i|, over one or more envelopes (last axis). Attributes spanning
+    a single value across the whole table (|A_i| = 0) carry no penalty.
+    """
+
+    A = np.abs(np.asarray(T_max_vals, dtype=float) - np.asarray(T_min_vals, dtype=float))
+    A_inv = np.divide(1., A, out=np.zeros_like(A), where=A != 0)
+
+    ncp_t = np.sum(np.subtract(r_plus, r_minus, dtype=float)*A_inv, axis=-1)
+
+    return size*ncp_t
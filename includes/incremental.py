@@ -0,0 +1,544 @@
+"""
+Incremental (k, P)-anonymity, which appends a batch of new records to an existing anonymized release, instead of
+anonymizing the whole history again. New records join the existing P-subgroups by pattern, and k-groups by minimum
+increase of the instant value loss, whose envelopes are updated in place; only records matching no P-subgroup are
+anonymized from scratch, and only the k-groups which received new records are checked again for l-diversity.
+
+Hence no released record is ever anonymized again, and the anonymization work of a batch grows with the batch and
+the # of k-groups. Each batch still takes time linear in the # of released records, though. The release is parsed
+and rewritten as a whole, as each row of a flat release holds the envelope of its k-group, and as l-diversity may
+perturb released records of the k-groups which grew. Indexing the released P-subgroups, and checking the batch Ids
+against the released ones, also scan all records.
+"""
+
+import os
+import random
+
+import numpy as np
+import pandas as pd
+
+from loguru import logger
+from pathlib import Path
+
+# Custom imports #
+from .anonymized_dataset import format_envelope_row
+from .anonymized_dataset import format_group_label
+from .anonymized_dataset import GROUP_LABEL_PREFIX
+from .common import create_tree
+from .common import MAX_LEVEL
+from .dataset import Dataset
+from .group_envelope import envelope_matrices
+from .group_envelope import GroupEnvelope
+from .group_envelope import value_loss
+from .io import generate_output_path
+from .io import generate_release_paths
+from .io import is_normalized_release
+from .io import load_dataset
+from .io import load_normalized_release
+from .k_anonymity import k_anonymity_bottom_up
+from .l_diversity import enforce_l_diversity
+from .sax_codes import pattern_level
+from .sax_codes import sax_code_matrix
+
+class Release:
+    """
+    Anonymized release, flat or normalized, loaded back as the state of incremental anonymization, see
+    `append_batch()`: the envelope and size of each k-group, and the Id, k-group, pattern representation and
+    (perturbed) sensitive value of each record. The original QI attributes of released records are never needed,
+    hence the release itself is all that has to be kept between batches.
+
+    Parameters
+    ----------
+    :param col_names: list of str
+        Column names, the Id column followed by the QI attributes
+
+    :param ids: np.ndarray of str
+        Id of each record
+
+    :param group_of: np.ndarray of int
+        k-group of each record, or -1 if suppressed
+
+    :param patterns: np.ndarray of str
+        Pattern representation of each record, empty if suppressed
+
+    :param A_s: np.ndarray
+        Sensitive value of each record, meaningless if suppressed
+
+    :param r_plus: np.ndarray
+        Matrix of the r+ vectors of each k-group, shaped (# of k-groups, # of QI attributes)
+
+    :param r_minus: np.ndarray
+        Matrix of the r- vectors of each k-group, shaped (# of k-groups, # of QI attributes)
+
+    :param sizes: np.ndarray of int
+        Size of each k-group
+
+    :param normalized: bool
+        Whether the release is saved as a normalized pair of group and record tables
+    """
+
+    def __init__(self, col_names, ids, group_of, patterns, A_s, r_plus, r_minus, sizes, normalized=False):
+        self.col_names = col_names
+        self.ids = ids
+        self.group_of = group_of
+        self.patterns = patterns
+        self.A_s = A_s
+        self.r_plus = r_plus
+        self.r_minus = r_minus
+        self.sizes = sizes
+        self.normalized = normalized
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, anonym_path):
+        """
+        Load a release from the anonymized dataset at `anonym_path`, or from its normalized pair of tables.
+        Every record is parsed, in time linear in the size of the release.
+        """
+
+        if is_normalized_release(anonym_path):
+            groups, records = load_normalized_release(anonym_path)
+
+            col_names = [ records.columns[0] ] + [ col[:-len('_min')] for col in groups.columns[2::2] ]
+
+            grouped = ~records['suppressed'].to_numpy()
+            labels = records['group'].to_numpy(dtype=np.int64, na_value=-1)
+
+            # QI attributes (min and max) alternate after group and size
+            bounds = groups.iloc[:, 2:].to_numpy().reshape(len(groups), -1, 2)
+            group_labels = groups['group'].to_numpy()
+            sizes = groups['size'].to_numpy(dtype=np.int64)
+        else:
+            records = pd.read_csv(anonym_path, dtype=str)
+
+            # Ids, followed by QI attributes, sensitive data, sax and group
+            col_names = list(records.columns)[:-3]
+
+            grouped = records['group'].notna().to_numpy()
+            labels = np.full(len(records), -1, dtype=np.int64)
+            labels[grouped] = records.loc[grouped, 'group'].str[len(GROUP_LABEL_PREFIX):].astype(np.int64)
+
+            # All records in a k-group share its envelope, hence only the first one is parsed
+            heads = records.loc[records.loc[grouped, 'group'].drop_duplicates().index]
+
+            # remove "[" and "]", then get min and max
+            bounds = pd.Series(heads[col_names[1:]].to_numpy().ravel()).str[1:-1] \
+                    .str.split("|", expand=True).apply(pd.to_numeric).to_numpy()
+            bounds = bounds.reshape(len(heads), len(col_names) - 1, 2)
+
+            group_labels = labels[heads.index.to_numpy()]
+            sizes = None
+
+        # Group labels are remapped to 0, ..., # of k-groups - 1, in the order of the group table
+        order = np.argsort(group_labels, kind='stable')
+        group_of = np.full(len(records), -1, dtype=np.int64)
+        group_of[grouped] = order[np.searchsorted(group_labels[order], labels[grouped])]
+
+        if sizes is None:
+            sizes = np.bincount(group_of[grouped], minlength=len(group_labels)).astype(np.int64)
+
+        patterns = np.full(len(records), '', dtype=object)
+        patterns[grouped] = records.loc[grouped, 'sax'].to_numpy()
+
+        A_s_grouped = pd.to_numeric(records.loc[grouped, 'as']).to_numpy()
+        A_s = np.zeros(len(records), dtype=A_s_grouped.dtype)
+        A_s[grouped] = A_s_grouped
+
+        logger.info('Loaded release of {} records in {} k-groups'.format(len(records), len(group_labels)))
+
+        return cls(col_names, records.iloc[:, 0].astype(str).to_numpy(), group_of, patterns.astype(str), A_s,
+                bounds[:, :, 1], bounds[:, :, 0], sizes, normalized=is_normalized_release(anonym_path))
+
+    def envelopes(self):
+        return [ GroupEnvelope.from_bounds(r_plus, r_minus, size)
+                for r_plus, r_minus, size in zip(self.r_plus, self.r_minus, self.sizes.tolist()) ]
+
+    def value_loss(self):
+        """
+        Global and average instant value loss, straight from the envelopes, see `global_value_loss()`
+        """
+
+        tot_value_loss = float(value_loss(self.sizes, self.r_plus, self.r_minus).sum())
+
+        return tot_value_loss, tot_value_loss/len(self)
+
+    def save(self, anonym_path):
+        """
+        Save the release in the same format it was loaded from, one k-group after the other, followed by the
+        suppressed records. Every record is written again, not only the appended ones, in time linear in the size
+        of the release. Files are written to temporary ones first, so that the previous release is only replaced
+        once the new one is complete.
+        """
+
+        anonym_path = Path(anonym_path)
+        os.makedirs(anonym_path.parent, exist_ok=True)
+
+        # Records of each k-group together, in release order
+        grouped = np.flatnonzero(self.group_of >= 0)
+        grouped = grouped[np.argsort(self.group_of[grouped], kind='stable')]
+        bounds = np.cumsum(self.sizes)[:-1]
+
+        suppressed = np.flatnonzero(self.group_of < 0)
+
+        keys, patterns, sensitive = self.ids.tolist(), self.patterns.tolist(), self.A_s.tolist()
+
+        if self.normalized:
+            groups_path, records_path = generate_release_paths(anonym_path)
+            id_col, QI_cols = self.col_names[0], self.col_names[1:]
+
+            with open(groups_path.with_suffix('.tmp'), "w") as groups_file, \
+                    open(records_path.with_suffix('.tmp'), "w") as records_file:
+                groups_file.write("group,size," + ",".join("{0}_min,{0}_max".format(col) for col in QI_cols) + "\n")
+                records_file.write(id_col + ",group,sax,as,suppressed" + "\n")
+
+                for index, k_group in enumerate(np.split(grouped, bounds)):
+                    # min and max of each QI attribute, side by side
+                    group_bounds = np.stack((self.r_minus[index], self.r_plus[index]), axis=1).ravel().tolist()
+                    groups_file.write("{},{},{}\n".format(index, self.sizes[index], ",".join(map(str, group_bounds))))
+
+                    records_file.write("".join("{},{},{},{},0\n".format(keys[row], index, patterns[row],
+                            sensitive[row]) for row in k_group.tolist()))
+
+                records_file.write("".join("{},,,,1\n".format(keys[row]) for row in suppressed.tolist()))
+
+            os.replace(groups_path.with_suffix('.tmp'), groups_path)
+            os.replace(records_path.with_suffix('.tmp'), records_path)
+        else:
+            tmp_path = anonym_path.with_suffix('.tmp')
+
+            # QI attributes, pattern rapresentation and group
+            placeholder_row = ",".join([" - "]*(len(self.col_names) + 1))
+
+            with open(tmp_path, "w") as file_to_write:
+                file_to_write.write(",".join(self.col_names) + ',sax,as,group' + "\n")
+
+                for index, (k_group, envelope) in enumerate(zip(np.split(grouped, bounds), self.envelopes())):
+                    # Shared by all records in the group
+                    envelope_row = format_envelope_row(envelope)
+                    group_label  = format_group_label(index)
+
+                    file_to_write.write("".join("{},{},{},{},{}\n".format(keys[row], envelope_row, patterns[row],
+                            sensitive[row], group_label) for row in k_group.tolist()))
+
+                file_to_write.write("".join("{},{}\n".format(keys[row], placeholder_row)
+                        for row in suppressed.tolist()))
+
+            os.replace(tmp_path, anonym_path)
+
+def min_value_loss_increase(r_plus, r_minus, sizes, values):
+    """
+    Index of the k-group, among the ones whose envelopes are given, which the records of `values` would increase
+    the instant value loss of the least, along with its envelope after they join it
+    """
+
+    envelope = GroupEnvelope(values)
+
+    joined_r_plus  = np.maximum(r_plus, envelope.r_plus)
+    joined_r_minus = np.minimum(r_minus, envelope.r_minus)
+
+    increase = value_loss(sizes + envelope.size, joined_r_plus, joined_r_minus) \
+            - value_loss(sizes, r_plus, r_minus)
+
+    index = int(np.argmin(increase))
+
+    return index, joined_r_plus[index], joined_r_minus[index]
+
+def P_subgroup_index(group_of, patterns):
+    """
+    Index of the P-subgroups, i.e., the records of a k-group sharing a pattern representation, by pattern
+
+    Parameters
+    ----------
+    :param group_of: np.ndarray of int
+        k-group of each record, or -1 if suppressed
+
+    :param patterns: np.ndarray of str
+        Pattern representation of each record
+
+    Returns
+    -------
+    :return index: dict of np.ndarray of int
+        k-groups holding a P-subgroup of each pattern
+    """
+
+    grouped = np.flatnonzero(group_of >= 0)
+    num_groups = group_of.max(initial=0) + 1
+
+    prs, pattern_of = np.unique(patterns[grouped], return_inverse=True)
+    pairs = np.unique(pattern_of*num_groups + group_of[grouped])
+
+    index = dict()
+
+    for pr, group_idx in zip(prs[pairs // num_groups].tolist(), (pairs % num_groups).tolist()):
+        index.setdefault(pr, list()).append(group_idx)
+
+    return { pr: np.array(group_idxs, dtype=np.int64) for pr, group_idxs in index.items() }
+
+def join_P_subgroups(words, QI, rows, index, r_plus, r_minus, sizes, min_level=1):
+    """
+    Join each of the given records to a P-subgroup whose pattern it matches at the level the pattern is read at, see
+    `pattern_level()`, the finest first. Among the k-groups holding such a P-subgroup, see `P_subgroup_index()`, it joins the one whose instant value
+    loss increases the least, whose envelope and size are updated in place.
+
+    Parameters
+    ----------
+    :param words: np.ndarray of str
+        Per-level SAX code matrix, see `sax_code_matrix()`, indexed by record row
+
+    :param QI: np.ndarray
+        2-D matrix of the QI attributes, indexed by record row
+
+    :param rows: np.ndarray of int
+        Rows of the records to join
+
+    :param min_level: int
+        Coarsest level of the SAX words matched
+
+    Returns
+    -------
+    :return group_of: np.ndarray of int
+        k-group joined by each record, or -1 if none
+
+    :return patterns: list of str
+        Pattern representation of the P-subgroup joined by each record, empty if none
+    """
+
+    group_of = np.full(len(rows), -1, dtype=np.int64)
+    patterns = [ '' ]*len(rows)
+
+    for pos, row in enumerate(rows.tolist()):
+        for level in range(MAX_LEVEL, min_level - 1, -1):
+            word = str(words[level, row])
+            group_idxs = index.get(word) if pattern_level(word) == level else None
+
+            if group_idxs is not None:
+                break
+        else:
+            continue
+
+        best, best_r_plus, best_r_minus = min_value_loss_increase(r_plus[group_idxs], r_minus[group_idxs],
+                sizes[group_idxs], QI[row:row + 1])
+        group_idx = group_idxs[best]
+
+        r_plus[group_idx], r_minus[group_idx] = best_r_plus, best_r_minus
+        sizes[group_idx] += 1
+
+        group_of[pos] = group_idx
+        patterns[pos] = str(words[level, row])
+
+    return group_of, patterns
+
+def append_batch(release, batch, algorithm, K_value, P_value, paa_value, l_value, rng=None):
+    """
+    Append a batch of new records to a release, in place
+
+    1. Each new record joins an existing P-subgroup, i.e., the records of a k-group sharing a pattern representation,
+       whose pattern it matches, see `join_P_subgroups()`. Among the k-groups holding such
+       a P-subgroup, it joins the one whose instant value loss increases the least, and whose envelope is updated.
+       k-groups which reach 2k records are dissolved back into their released records, whose envelope is restored,
+       and into the new records which joined them, which are then handled as unmatched ones.
+    2. New records matching no P-subgroup go through the create-tree phase on their own, see `create_tree()`. Their
+       P-subgroups then form new k-groups, if at least k records in total, or else each one joins the existing k-group
+       whose instant value loss increases the least, among the ones staying under 2k records, if any.
+    3. l-diversity is enforced again on the k-groups which received new records only, see `enforce_l_diversity()`.
+
+    As k-groups and P-subgroups only ever grow, neither the k- nor the P-requirement can break for released records.
+
+    Parameters
+    ----------
+    :param release: Release
+        Release to append to
+
+    :param batch: Dataset
+        New records, with the same columns as the release
+
+    :param algorithm: str
+        "naive" or "kapra", which anonymized the release, see `create_tree()`
+
+    :param rng: np.random.Generator - None
+        Random generator of l-diversity, see `enforce_l_diversity()`
+
+    Returns
+    -------
+    :return perturbated: dict
+        Rounds of the +/- 1 increment fallback of l-diversity, keyed by release row, see `enforce_l_diversity()`
+    """
+
+    if batch.col_names != release.col_names:
+        raise ValueError('The batch columns do not match the ones of the release')
+
+    if np.any(np.char.str_len(release.patterns[release.group_of >= 0]) != paa_value):
+        raise ValueError('<paa_value> does not match the size of the released pattern representations')
+
+    batch_ids = batch.ids.astype(str)
+
+    if np.isin(batch_ids, release.ids).any():
+        raise ValueError('The batch holds records already in the release')
+
+    num_groups = len(release.sizes)
+
+    # Envelopes may turn from integer to float ones
+    dtype = np.result_type(release.r_plus.dtype, batch.QI.dtype)
+    release.r_plus = release.r_plus.astype(dtype)
+    release.r_minus = release.r_minus.astype(dtype)
+
+    # Released envelopes, restored for the k-groups which grow too large
+    released_r_plus, released_r_minus = release.r_plus.copy(), release.r_minus.copy()
+    released_sizes = release.sizes.copy()
+
+    # 1. Join released P-subgroups
+    words = sax_code_matrix(batch.QI, paa_value, MAX_LEVEL)
+
+    group_of, patterns = join_P_subgroups(words, batch.QI, np.arange(len(batch)),
+            P_subgroup_index(release.group_of, release.patterns), release.r_plus, release.r_minus, release.sizes)
+
+    patterns = np.array(patterns, dtype='U{}'.format(paa_value))
+
+    # k-groups which reached 2k are dissolved back into their released records,
+    # and the new records which joined them are formed into new k-groups instead
+    overfull = np.flatnonzero((release.sizes >= 2*K_value) & (release.sizes > released_sizes))
+
+    release.r_plus[overfull] = released_r_plus[overfull]
+    release.r_minus[overfull] = released_r_minus[overfull]
+    release.sizes[overfull] = released_sizes[overfull]
+
+    dissolved = np.isin(group_of, overfull)
+    group_of[dissolved] = -1
+    patterns[dissolved] = ''
+
+    unmatched = np.flatnonzero(group_of < 0)
+
+    logger.info('{} out of {} new records joined released P-subgroups, {} k-groups dissolved'.format(
+            len(batch) - len(unmatched), len(batch), len(overfull)))
+
+    # 2. Anonymize the rest from scratch
+    if len(unmatched) > 0:
+        PR = dict()
+        new_P_subgroups, suppressed_groups = create_tree(algorithm, words, unmatched, PR, P_value, paa_value)
+
+        for row, pr in PR.items():
+            patterns[row] = pr
+
+        if sum(len(P_subgroup) for P_subgroup in new_P_subgroups) >= K_value:
+            K_groups = list()
+            k_anonymity_bottom_up(batch.QI, new_P_subgroups, P_value, K_value, K_groups)
+
+            r_plus, r_minus, sizes = envelope_matrices(batch.QI, K_groups)
+
+            release.r_plus = np.concatenate((release.r_plus, r_plus.astype(dtype)))
+            release.r_minus = np.concatenate((release.r_minus, r_minus.astype(dtype)))
+            release.sizes = np.concatenate((release.sizes, sizes))
+
+            for group_idx, K_group in enumerate(K_groups, start=num_groups):
+                group_of[K_group] = group_idx
+
+            logger.info('Formed {} new k-groups'.format(len(K_groups)))
+        elif len(new_P_subgroups) > 0:
+            if num_groups == 0:
+                raise ValueError('Too few new records to form any k-group, and no released k-group to join')
+
+            for P_subgroup in new_P_subgroups:
+                # k-groups staying under 2k, if any
+                group_idxs = np.flatnonzero(release.sizes + len(P_subgroup) < 2*K_value)
+
+                if len(group_idxs) == 0:
+                    group_idxs = np.arange(num_groups)
+
+                best, r_plus, r_minus = min_value_loss_increase(release.r_plus[group_idxs],
+                        release.r_minus[group_idxs], release.sizes[group_idxs], batch.QI[P_subgroup])
+                group_idx = group_idxs[best]
+
+                release.r_plus[group_idx], release.r_minus[group_idx] = r_plus, r_minus
+                release.sizes[group_idx] += len(P_subgroup)
+
+                group_of[P_subgroup] = group_idx
+
+            logger.info('{} new P-subgroups joined released k-groups'.format(len(new_P_subgroups)))
+
+        logger.info('Suppressed {} new records'.format(sum(len(group) for group in suppressed_groups)))
+
+    # 3. Enforce l-diversity on the k-groups which grew only
+    release.ids = np.concatenate((release.ids, batch_ids))
+    release.group_of = np.concatenate((release.group_of, group_of))
+    release.patterns = np.concatenate((release.patterns, patterns))
+    release.A_s = np.concatenate((release.A_s, batch.A_s))
+
+    touched = np.unique(group_of[group_of >= 0])
+    rows = np.flatnonzero(np.isin(release.group_of, touched))
+
+    # Local rows of each touched k-group
+    _, local_group_of = np.unique(release.group_of[rows], return_inverse=True)
+    order = np.argsort(local_group_of, kind='stable')
+    K_groups = np.split(order, np.cumsum(np.bincount(local_group_of))[:-1])
+
+    A_s = release.A_s[rows]
+    PR = dict(enumerate(release.patterns[rows].tolist()))
+
+    perturbated = enforce_l_diversity(PR, A_s, K_groups, l_value, rng=rng)
+
+    release.A_s[rows] = A_s
+
+    logger.info('Appended {} records to the release, now of {} records in {} k-groups'.format(len(batch),
+            len(release), len(release.sizes)))
+
+    return { int(rows[row]): rnd for row, rnd in perturbated.items() }
+
+def anonymize_incremental(data, data_path, algorithm, K_value, P_value, paa_value, l_value, seed=None):
+    """
+    Append a batch of new records to the release of the dataset at `data_path`, as saved by `k_P_anonymity.py`,
+    see `append_batch()`. The release is updated in place, in the same format, flat or normalized.
+
+    Parameters
+    ----------
+    :param data: str or Dataset
+        Path of the batch of new records on disk, or the batch itself
+
+    :param data_path: str
+        Path of the original dataset, whose release is located by `generate_output_path()`
+
+    :param seed: int - None
+        Seed of all random draws, see `anonymize()`
+
+    Returns
+    -------
+    :return release: Release
+        Updated release
+
+    Raises
+    ------
+    ValueError
+        If the parameters are not consistent with each other or with the release
+
+    FileNotFoundError
+        If the batch or the release is not found on disk
+    """
+
+    if K_value < P_value:
+        raise ValueError('<k_value> must be greater or equal than <P_value>')
+
+    rng = None # l-diversity generator
+
+    if seed is not None:
+        random.seed(seed)
+        rng = np.random.default_rng(seed)
+
+    anonym_path = generate_output_path(data_path, algorithm.lower())
+
+    if not anonym_path.is_file() and not is_normalized_release(anonym_path):
+        logger.error(str(anonym_path.absolute())
+                + ' not found')
+        raise FileNotFoundError(str(anonym_path.absolute()) + ' not found')
+
+    release = Release.load(anonym_path)
+
+    batch = data if isinstance(data, Dataset) else load_dataset(data)
+
+    append_batch(release, batch, algorithm.lower(), K_value, P_value, paa_value, l_value, rng)
+
+    release.save(anonym_path)
+
+    logger.info('Saved anonymized dataset at: ' + str(anonym_path))
+
+    return release
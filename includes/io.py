@@ -1,3 +1,5 @@
+import os
+import numpy as np
 import pandas as pd
 
 from loguru import logger
@@ -5,44 +7,24 @@ from pathlib import Path
 
 # Custom imports #
 from .anonymized_dataset import AnonymizedDataset
+from .binary_io import generate_sidecar_path
+from .binary_io import load_binary_dataset
+from .binary_io import load_npz_dataset
+from .binary_io import save_npz_dataset
+from .dataset import Dataset
 
 DOWNSAMPLED_DIR = 'downsampled'
 ANONYMIZED_DIR = 'anonymized'
 
-def usage():
-    print("[*] Usage: python k_P_anonymity.py <algorithm> <k_value>"
-            + " <P_value> <paa_value> <l_value> <dataset>")
-    exit(1)
-
-def get_min_max_QI_values_from_table(df, QI_cols):
-    """
-    Extract min and max values for each QI attribute in the table.
-    
-    Parameters
-    ----------
-    :param df: pd.DataFrame
-        Time series data DF
-
-    :param QI_cols: list of str
-        QI attributes-only column names
-
-    Returns
-    -------
-    :return QI_min_values: list of int
-        List of min values for each QI attribute
-
-    :return QI_max_values: list of int
-        List of max values for each QI attribute
-    """
-
-    QI_max_values = list()
-    QI_min_values = list()
+CSV_CHUNK_BYTES = 1 << 23 # Size of the values in each chunk of a streamed CSV dataset, whatever its # of columns
 
-    for col in QI_cols:
-        QI_max_values.append(df[col].max())
-        QI_min_values.append(df[col].min())
+RESULTS_COLUMNS = [ 'eta', 'tot_pattern_loss', 'avg_pattern_loss',
+        'tot_value_loss', 'avg_value_loss' ]
 
-    return QI_min_values, QI_max_values
+def usage():
+    print("[*] Usage: python k_P_anonymity.py <algorithm> <k_value>[,<k_value>...]"
+            + " <P_value> <paa_value> <l_value>[,<l_value>...] <dataset> [<seed>]")
+    exit(1)
 
 def generate_output_path(data_path, algorithm):
     """
@@ -62,8 +44,9 @@ def generate_output_path(data_path, algorithm):
     
     abs_data_path = Path(data_path).absolute()
 
-    # Compute output file path with '_anon' suffix
-    outfilename = abs_data_path.parts[-1].replace('.csv', '_' + algorithm + '_anon.csv')
+    # Compute output file path with '_anon' suffix, always as CSV,
+    # whatever the format of the original dataset
+    outfilename = abs_data_path.stem + '_' + algorithm + '_anon.csv'
 
     # Handle datasets coming from downsampled dir
     if abs_data_path.parent.parts[-1] == DOWNSAMPLED_DIR:
@@ -76,83 +59,299 @@ def generate_output_path(data_path, algorithm):
 
     return outpath 
 
-def load_dataset(path: str, anonym=False):
+def generate_results_path(results_dir, data_path, algorithm,
+        k_value, P_value, paa_value, l_value):
+    """
+    Generate the path of the results of a (k, P)-anonymity run, named after the dataset and all parameters
+    """
+
+    abs_data_path = Path(data_path).absolute()
+
+    outfilename = abs_data_path.stem \
+            + '_' + algorithm + '_k' + str(k_value)           \
+            + '_P' + str(P_value) + '_paa' + str(paa_value)   \
+            + '_l' + str(l_value) + '.csv'
+
+    return Path(results_dir) / outfilename
+
+def save_results(results_dir, data_path, algorithm,
+        k_value, P_value, paa_value, l_value, results):
+    """
+    Save the results of a (k, P)-anonymity run as a single-row CSV file, see `RESULTS_COLUMNS`
+
+    Returns
+    -------
+    :return outpath: Path
+        Path of the results file, see `generate_results_path()`
+    """
+
+    results_df = pd.DataFrame(columns = RESULTS_COLUMNS)
+    results_df.loc[0] = results
+
+    os.makedirs(results_dir, exist_ok=True)
+
+    outpath = generate_results_path(results_dir, data_path, algorithm,
+            k_value, P_value, paa_value, l_value)
+    results_df.to_csv(outpath, sep =',', index=False)
+
+    return outpath
+
+def load_dataset(path: str, anonym=False, sidecar=True):
     """
     Load original/anonymized dataset
 
     Parameters
     ----------
     path : str
-        Dataset path.
+        Dataset path. Original datasets can also be in any of the binary
+        formats, .npy, .npz, Parquet or Arrow, see `load_binary_dataset()`.
     anonym : boolean, optional
         Set True if loading an anonymized dataset. The default is False.
+    sidecar : boolean, optional
+        Set True to load original CSV datasets from their binary sidecar,
+        which is written on their first load, see `generate_sidecar_path()`.
+        The default is True.
 
     Returns
     -------
-    QI_min_vals : TYPE
-        DESCRIPTION.
-    QI_max_vals : TYPE
-        DESCRIPTION.
-    QI_dict : dict
-        dictionary containing time series
-    A_s_dict : dict
-        dictionary containing sensitive attributes for each time series
-    col_names_QI : list
-        column names of QI_dict time series
+    dataset : Dataset
+        Columnar dataset, holding the QI matrix, the sensitive attribute
+        vector, the Id -> row index, the QI column names and the per-column
+        min and max QI values. On anonymized datasets the QI matrix holds the
+        raw envelope, sax and group strings, and no boundaries are computed.
 
     """
 
     data_path = Path(path)
 
     if not data_path.is_file():
-        logger.error(str(path.absolute())
+        logger.error(str(data_path.absolute())
                 + ' not found')
-        exit(1)
+        raise FileNotFoundError(str(data_path.absolute()) + ' not found')
 
     logger.info('Loading dataset...')
 
-    df = pd.read_csv(data_path) # Time series data DF
-    
+    # Anonymized datasets hold strings,
+    # which cannot be streamed into a numeric QI matrix
+    if anonym:
+        return dataframe_to_dataset(pd.read_csv(data_path), anonym)
+
+    dataset = load_binary_dataset(data_path)
+
+    if dataset is not None:
+        logger.info('Loaded binary dataset')
+        return dataset
+
+    if not sidecar:
+        return stream_csv_dataset(data_path)
+
+    sidecar_path = generate_sidecar_path(data_path)
+
+    if sidecar_path.is_file():
+        dataset = load_npz_dataset(sidecar_path)
+
+        logger.info('Loaded dataset from its binary sidecar ' + str(sidecar_path))
+        return dataset
+
+    dataset = stream_csv_dataset(data_path)
+
+    # A read-only data dir only costs
+    # parsing the dataset again next time
+    try:
+        save_npz_dataset(dataset, sidecar_path)
+    except OSError as e:
+        logger.warning('Cannot save the binary sidecar of the dataset: ' + str(e))
+
+    return dataset
+
+def count_csv_rows(data_path, block_size=1 << 20):
+    """
+    Count the records of a CSV dataset from its line breaks, reading it in fixed-size blocks.
+    Blank lines are counted as well, hence the count is an upper bound.
+    """
+
+    num_lines = 0
+    last = b'\n'
+
+    with open(data_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            num_lines += block.count(b'\n')
+            last = block[-1:]
+
+    # Last record with no trailing line break
+    if last != b'\n':
+        num_lines += 1
+
+    return max(num_lines - 1, 0) # Header left out
+
+def promote_rows(QI, num_rows, dtype, chunk_size):
+    """
+    Promote the first `num_rows` rows of a QI matrix to `dtype`. If both types have the same size, e.g., from
+    integers to floats, rows are converted in place, one chunk of rows at a time, so that no second QI matrix is
+    ever allocated.
+    """
+
+    if np.dtype(dtype).itemsize != QI.dtype.itemsize:
+        return QI.astype(dtype)
+
+    promoted = QI.view(dtype)
+
+    # Overlapping source and target rows are buffered chunk by chunk
+    for start in range(0, num_rows, chunk_size):
+        stop = min(start + chunk_size, num_rows)
+        promoted[start:stop] = QI[start:stop]
+
+    return promoted
+
+def iter_csv_chunks(data_path, chunk_size=None):
+    """
+    Read an original CSV dataset in fixed-size chunks of rows
+
+    Parameters
+    ----------
+    :param data_path: Path
+        Path of the original CSV dataset
+
+    :param chunk_size: int - None
+        # of rows in each chunk. If None, as many rows as fit `CSV_CHUNK_BYTES` worth of 8-byte values.
+
+    Returns
+    -------
+    :return chunks: generator of (list of str, np.ndarray, np.ndarray, np.ndarray)
+        Column names (the Id column followed by the QI attributes), Ids, QI matrix and sensitive data of each
+        non-empty chunk. Each chunk's types are inferred from the chunk alone.
+    """
+
+    if chunk_size is None:
+        num_cols = len(pd.read_csv(data_path, nrows=0).columns)
+        chunk_size = max(CSV_CHUNK_BYTES // (8*num_cols), 1)
+
+    col_names = None
+
+    for chunk in pd.read_csv(data_path, chunksize=chunk_size):
+        if len(chunk) == 0:
+            continue
+
+        if col_names is None:
+            # Extract column names
+            cols = list(chunk.columns)[1:] # Leave column 0 out, as it contains Ids
+            A_s_col = cols.pop(-1)
+
+            # Extract sensitive data (A_s)
+            logger.info('Extracted attribute ' + A_s_col +
+                    ' as sensitive data')
+
+            col_names = [ chunk.columns[0] ] + cols
+
+        # Copied, as views would keep the whole chunk alive
+        yield col_names, chunk.iloc[:, 0].to_numpy(copy=True), chunk[cols].to_numpy(), \
+                chunk[A_s_col].to_numpy(copy=True)
+
+def stream_csv_dataset(data_path, chunk_size=None):
+    """
+    Load an original CSV dataset in fixed-size chunks of rows, see `iter_csv_chunks()`, each one appended straight
+    into a QI matrix preallocated from the # of records, see `count_csv_rows()`, while the min and max value of each
+    QI attribute are kept up to date. Hence at peak only the QI matrix and a single chunk are held in memory, rather
+    than the whole DF along with its QI matrix.
+
+    Parameters
+    ----------
+    :param data_path: Path
+        Path of the original CSV dataset
+
+    :param chunk_size: int - None
+        # of rows in each chunk, see `iter_csv_chunks()`
+
+    Returns
+    -------
+    :return dataset: Dataset
+        Columnar dataset, the same as `dataframe_to_dataset()` would build from the whole DF
+    """
+
+    capacity = count_csv_rows(data_path)
+
+    QI = None # QI matrix, filled in chunk by chunk
+    num_rows = 0
+
+    ids = list() # Ids and sensitive data of each chunk
+    A_s = list()
+
+    for col_names, chunk_ids, block, chunk_A_s in iter_csv_chunks(data_path, chunk_size):
+        if QI is None:
+            QI = np.empty((max(capacity, len(block)), block.shape[1]), dtype=block.dtype)
+
+            QI_min_vals = block.min(axis=0)
+            QI_max_vals = block.max(axis=0)
+        else:
+            # Types of the chunk columns are inferred from the chunk alone,
+            # e.g., a later chunk may turn integer columns into float ones
+            if block.dtype != QI.dtype:
+                dtype = np.result_type(QI.dtype, block.dtype)
+
+                QI = promote_rows(QI, num_rows, dtype, len(block))
+                QI_min_vals = QI_min_vals.astype(dtype)
+                QI_max_vals = QI_max_vals.astype(dtype)
+
+            np.minimum(QI_min_vals, block.min(axis=0), out=QI_min_vals)
+            np.maximum(QI_max_vals, block.max(axis=0), out=QI_max_vals)
+
+        # Quoted line breaks make for more rows than counted
+        if num_rows + len(block) > len(QI):
+            grown = np.empty((max(2*len(QI), num_rows + len(block)), QI.shape[1]), dtype=QI.dtype)
+            grown[:num_rows] = QI[:num_rows]
+
+            QI = grown
+
+        QI[num_rows:num_rows + len(block)] = block
+        num_rows += len(block)
+
+        ids.append(chunk_ids)
+        A_s.append(chunk_A_s)
+
+    # No records at all
+    if QI is None:
+        return dataframe_to_dataset(pd.read_csv(data_path))
+
+    # Blank lines make for fewer rows than counted
+    QI = QI[:num_rows]
+
+    dataset = Dataset(np.concatenate(ids), QI, np.concatenate(A_s), col_names,
+            QI_min_vals, QI_max_vals)
+
+    logger.info('Loaded dataset')
+
+    return dataset
+
+def dataframe_to_dataset(df, anonym=False):
+    """
+    Convert a time series data DF, as read from a CSV dataset, to a columnar dataset, see `load_dataset()`
+    """
+
     # Extract column names
     cols = list(df.columns)[1:] # Leave column 0 out, as it contains Ids
 
     # Remove sensitive attribute from original dataset only
     if anonym:
-        
-        # Extract sensitive data (A_s) DF
-        logger.info('Extracted attribute ' + cols[-2] +
-                ' as sensitive data')
-        A_s_df = df.pop(cols[-2])
-        cols.pop(-2)        
-        
+        A_s_col = cols.pop(-2)
     else:
-    
-        # Extract sensitive data (A_s) DF
-        logger.info('Extracted attribute ' + cols[-1] +
-                ' as sensitive data')
-        A_s_df = df.pop(cols[-1])
-        cols.pop(-1)
-
-    # Convert DFs to dicts
-    QI_dict = dict()  # Quasi-identifier attributes
-    A_s_dict = dict() # Sensitive data
-
-    for i, row in df.iterrows():
-        A_s_dict[row[0]] = A_s_df[i]
-        QI_dict[row[0]]  = list(row[cols])
-  
-    QI_min_vals, QI_max_vals = get_min_max_QI_values_from_table(df, cols)
+        A_s_col = cols.pop(-1)
+
+    # Extract sensitive data (A_s)
+    logger.info('Extracted attribute ' + A_s_col +
+            ' as sensitive data')
+
+    # Convert DF columns to a contiguous QI matrix
+    # and a sensitive data vector
+    dataset = Dataset(df.iloc[:, 0].to_numpy(), df[cols].to_numpy(),
+            df[A_s_col].to_numpy(), [ df.columns[0] ] + cols)
 
     logger.info('Loaded dataset')
-    
-    col_names_QI = list(df.columns)
 
-    return QI_min_vals, QI_max_vals, QI_dict, A_s_dict, col_names_QI
+    return dataset
 
-def save_anonymized_dataset(data_path, algorithm,
+def save_anonymized_dataset(data_path, algorithm, dataset,
         prs = dict(), anonymized = list(), 
-        sensitive = dict(), suppressed = list(), 
-        col_names=list()):
+        suppressed = list(), normalized = False):
     """
     Aggregate all separate k- and P- groups into a single anonymized dataset and save it to file.
 
@@ -163,26 +362,97 @@ def save_anonymized_dataset(data_path, algorithm,
 
     :param algorithm: str
         "naive" or "kapra", will be added to anonymized file name
+
+    :param dataset: Dataset
+        Original dataset, whose rows the groups index into
         
     :param prs: dict of str - {}
-        Dict of per-P-group SAX pattern representations
+        Dict of per-record SAX pattern representations, keyed by row
 
-    :param anonymized: list of dict - []
-        List of anonymized P-groups of records
+    :param anonymized: list of np.ndarray - []
+        List of anonymized k-groups, as index arrays of rows
 
-    :param sensitive: dict of int - {}
-        Dict of sensitive attributes (A_s)
+    :param suppressed: list of np.ndarray - []
+        List of P-groups of records to suppress (KAPRA-only), as index arrays of rows
 
-    :param suppressed: list of dict - []
-        List of P-groups of records to suppress (KAPRA-only)
+    :param normalized: bool - False
+        Save the release as a normalized pair of group and record tables, see `generate_release_paths()`,
+        rather than as a single flat table repeating the group envelope on every record
+
+    Returns
+    -------
+    :return outpath: Path
+        Path of the flat anonymized dataset, which also locates the normalized release
     """
 
     outpath = generate_output_path(data_path, algorithm)
+    groups_path, records_path = generate_release_paths(outpath)
+
+    os.makedirs(outpath.parent, exist_ok=True)
 
-    anonymized_dataset = AnonymizedDataset(anonymized,
-            prs, suppressed, sensitive)
+    anonymized_dataset = AnonymizedDataset(dataset, anonymized,
+            prs, suppressed)
 
-    anonymized_dataset.construct()
-    anonymized_dataset.save(outpath, col_names)
+    # Remove any stale release in the other format,
+    # so that the metrics never read it back
+    if normalized:
+        anonymized_dataset.save_normalized(groups_path, records_path, dataset.col_names)
+        stale_paths = [ outpath ]
+    else:
+        anonymized_dataset.save(outpath, dataset.col_names)
+        stale_paths = [ groups_path, records_path ]
+
+    for stale_path in stale_paths:
+        if stale_path.is_file():
+            stale_path.unlink()
 
     return outpath
+
+def generate_release_paths(anonym_path):
+    """
+    Generate the paths of the group table and of the record table of a normalized anonymized release,
+    next to the flat anonymized dataset at `anonym_path`, with '_groups' and '_records' suffixes
+    """
+
+    anonym_path = Path(anonym_path)
+
+    groups_path  = anonym_path.with_name(anonym_path.stem + '_groups.csv')
+    records_path = anonym_path.with_name(anonym_path.stem + '_records.csv')
+
+    return groups_path, records_path
+
+def is_normalized_release(anonym_path):
+    """
+    Whether the anonymized dataset at `anonym_path` has been saved as a normalized release
+    """
+
+    groups_path, records_path = generate_release_paths(anonym_path)
+
+    return groups_path.is_file() and records_path.is_file()
+
+def load_normalized_release(anonym_path):
+    """
+    Load the normalized release of the anonymized dataset at `anonym_path`
+
+    Returns
+    -------
+    :return groups: pd.DataFrame
+        Group table, with one row per k-group: group, size, and min and max of each QI attribute
+
+    :return records: pd.DataFrame
+        Record table, with one row per record: Id, group, sax, as, and suppressed flag.
+        Suppressed records have no group, and an empty sax and as.
+    """
+
+    groups_path, records_path = generate_release_paths(anonym_path)
+
+    if not groups_path.is_file() or not records_path.is_file():
+        logger.error(str(Path(anonym_path).absolute())
+                + ' normalized release not found')
+        raise FileNotFoundError(str(Path(anonym_path).absolute()) + ' normalized release not found')
+
+    groups  = pd.read_csv(groups_path)
+    records = pd.read_csv(records_path, dtype={ 'group': 'Int64', 'sax': str, 'as': str,
+            'suppressed': bool }, keep_default_na=False, na_values={ 'group': [ '' ] })
+
+    return groups, records
@@ -1,37 +1,61 @@
+import heapq
+import numpy as np
+
 from loguru import logger
 
 # Custom imports #
 from .common import top_down_greedy_clustering
 from .common import postprocessing
-from .common import find_group_with_min_vl
 
-def k_anonymity_top_down(QI_dict, k, QI_k_anonymized,
-        QI_max_vals, QI_min_vals):
+from .group_envelope import EnvelopeIndex
+from .group_envelope import GroupEnvelope
+from .group_envelope import envelope_matrices
+from .group_envelope import value_loss
+
+def k_anonymity_top_down(QI, T, k, QI_k_anonymized,
+        QI_max_vals, QI_min_vals, max_workers=1, seed=None):
     """
     Top down greedy k-anonymity implementation, from Xu et al. 2006,
     Utility-based Anonymization for Privacy Preservation with Less Information Loss, 4.2
+
+    Parameters
+    ----------
+    :param QI: np.ndarray
+        2-D matrix of time-series records on QI attributes
+
+    :param T: np.ndarray of int
+        Index array of the rows of `QI` to anonymize
+
+    :param QI_k_anonymized: list of np.ndarray of int
+        Resulting list of k-groups, as index arrays of rows
+
+    :param max_workers: int - 1
+        # of worker processes clustering subtrees in parallel, see `top_down_greedy_clustering()`
+
+    :param seed: int - None
+        Seed of the per-split generators, see `top_down_greedy_clustering()`
     """
 
-    if QI_max_vals == None or QI_min_vals == None:
+    if QI_max_vals is None or QI_min_vals is None:
         logger.error('No QI attribute boundaries are available, but they are required by the top down'
                 + ' greedy k-anonymity algorithm to compute the NPC metric')
-        exit(1)
+        raise ValueError('No QI attribute boundaries are available')
 
     # 1. Top down greedy clustering
     QI_tree_structure = list()
 
-    top_down_greedy_clustering('naive', QI_dict, k, QI_k_anonymized,
-            QI_tree_structure, 'o', QI_max_vals, QI_min_vals)
+    top_down_greedy_clustering('naive', QI, T, k, QI_k_anonymized,
+            QI_tree_structure, 'o', QI_max_vals, QI_min_vals, seed=seed, max_workers=max_workers)
 
     # 2. Postprocess bad leaves
     QI_postprocessed = list()
     
-    postprocessing('naive', k, QI_k_anonymized,
+    postprocessing('naive', QI, k, QI_k_anonymized,
             QI_tree_structure, QI_postprocessed, QI_max_vals, QI_min_vals) 
     
-    QI_k_anonymized = QI_postprocessed # Return to correct data structure
+    QI_k_anonymized[:] = QI_postprocessed # Return to correct data structure
 
-def k_anonymity_bottom_up(p_subgroups, p, k, GL):
+def k_anonymity_bottom_up(QI, p_subgroups, p, k, GL):
 
     """
     Bottom up group formation procedure, from Shou et al. 2013,
@@ -39,8 +63,11 @@ def k_anonymity_bottom_up(p_subgroups, p, k, GL):
 
     Parameters
     ----------
-    :param p_subgroups: List of dicts
-        Each dict contained in list p_subgroups is formed by pairs (ts_id, ts_values)
+    :param QI: np.ndarray
+        2-D matrix of time-series records on QI attributes, which the groups index into
+
+    :param p_subgroups: List of np.ndarray
+        Each index array contained in list p_subgroups holds the rows of a P-subgroup
 
     :param p: int
         P-requirement for (k, P) anonymity
@@ -48,12 +75,12 @@ def k_anonymity_bottom_up(p_subgroups, p, k, GL):
     :param k: int
         K-requirement for (k, P) anonymity
 
-    :param GL: List of dicts
+    :param GL: List of np.ndarray
         Resulting list of K-groups produced by k_anonymity_bottom_up. Filled after executing this procedure.
     """
 
-    PGL = list() # PGL list described in the paper, implemented as a list of dictionaries, each having mappings
-    # (time series identifier, pattern representation). Each dictionary represents a group.
+    PGL = list() # PGL list described in the paper, implemented as a list of index arrays of rows.
+    # Each index array represents a group.
 
     # List containing all the resulting subgroups produced by splitting a subgroup
     splitted_p_subgroups = list()
@@ -66,7 +93,7 @@ def k_anonymity_bottom_up(p_subgroups, p, k, GL):
         PGL.append(p_subgroup)
 
     # Loop over the time series of each p-subgroup. Implements the preprocessing stage.
-    # Each group contains associations (time series identifier, time series values)
+    # Each group contains the rows of its time series
     for p_subgroup_idx, p_subgroup in enumerate(PGL): 
 
         # if a p-subgroup can be splitted
@@ -78,11 +105,8 @@ def k_anonymity_bottom_up(p_subgroups, p, k, GL):
 
             temp_splitted_p_subgroup = list()
 
-            # p_subgroup_to_be_splitted is set to the current p-subgroup, which will be splitted because of its size (>=2*p)
-            p_subgroup_to_be_splitted = p_subgroup.copy()
-
             # Start top down greedy clustering (as reported in the paper): split the current group in subgroups having size p
-            top_down_greedy_clustering("kapra", p_subgroup_to_be_splitted, p, temp_splitted_p_subgroup, postprocessing_clustering_tree)
+            top_down_greedy_clustering("kapra", QI, p_subgroup, p, temp_splitted_p_subgroup, postprocessing_clustering_tree)
 
             # Initialize list containing postprocessed subgroups
             postprocessed_p_subgroups = list()
@@ -90,7 +114,7 @@ def k_anonymity_bottom_up(p_subgroups, p, k, GL):
             # The top down greedy search method includes a post-processing phase, whose objective is to 
             # adjust the groups so that each group has at least k tuples; in this case, the partition size is chosen to
             # be p, which is the P requirement for (k, P) anonymity
-            postprocessing('kapra',p,temp_splitted_p_subgroup,postprocessing_clustering_tree,postprocessed_p_subgroups) 
+            postprocessing('kapra',QI,p,temp_splitted_p_subgroup,postprocessing_clustering_tree,postprocessed_p_subgroups) 
                                                             
             # Concatenate the list of all the postprocessed groups generated from the current p_subgroup to list splitted_p_subgroup
             # Splitted_p_subgroup will contain multiple groups, splitted according to top_down_greedy_clustering and postprocessed by
@@ -99,7 +123,7 @@ def k_anonymity_bottom_up(p_subgroups, p, k, GL):
             p_subgroups_splitted_idxs.append(p_subgroup_idx) # add the index of the old group p_subgroup to index_to_remove
 
     # remove from PGL all the p-subgroups whose indexes are included in p_subgroups_splitted_idxs
-    # we recall that PGL contains dictionaries formed by associations (time series identifier, time series values)
+    # we recall that PGL contains index arrays of rows
     PGL = [p_subgroup for (p_subgroup_idx, p_subgroup) in enumerate(PGL) if p_subgroup_idx not in p_subgroups_splitted_idxs]
 
     # add to the PGL list newly formed subgroups contained in splitted_p_subgroup, 
@@ -114,7 +138,7 @@ def k_anonymity_bottom_up(p_subgroups, p, k, GL):
     for p_subgroup_idx, p_subgroup in enumerate(PGL):
         # All P-subgroups in PGL containing no fewer than k time series are taken as k-groups and simply moved into GL (they are
         # deleted from PGL).
-        # we recall that node.group is a dictionary containing mappings (time series id, time series values)
+        # we recall that node.group is an index array of rows
         # len(group): number of time series inside a group
         if len(p_subgroup) >= k:
             p_subgroups_k_promoted_idxs.append(p_subgroup_idx)
@@ -123,18 +147,34 @@ def k_anonymity_bottom_up(p_subgroups, p, k, GL):
     # Delete newly found k-groups from PGL (which contains the "old" p_subgroups)
     PGL = [p_subgroup for (p_subgroup_idx, p_subgroup) in enumerate(PGL) if p_subgroup_idx not in p_subgroups_k_promoted_idxs]
 
-    p_subgroups_k_merged_idxs = list()
+    # cached envelopes of the p-subgroups left in PGL, so that each what-if merge costs O(d)
+    PGL_r_plus, PGL_r_minus, PGL_sizes = envelope_matrices(QI, PGL)
+
+    # nearest-neighbour index of the p-subgroups not yet merged into k-groups, shared by all k-groups,
+    # so that the p-subgroup merging with G at the least VL is found without evaluating all of them
+    PGL_index = EnvelopeIndex(PGL_r_plus, PGL_r_minus, PGL_sizes)
+
     # compute the length of all the p-subgroups left in PGL
-    card_PGL = sum([len(p_subgroup) for p_subgroup in PGL])
+    card_PGL = int(PGL_sizes.sum())
+
+    # priority queue of the p-subgroups by their own instant value loss, which never changes,
+    # ties broken by the lower index
+    PGL_heap = list(zip(value_loss(PGL_sizes, PGL_r_plus, PGL_r_minus).tolist(), range(len(PGL))))
+    heapq.heapify(PGL_heap)
 
     # paper while loop: while |PGL| >= k_value
     while card_PGL >= k:
         # find the P-subgroup s1 with the minimum instant value loss, and then create a new group G = s1.
         # Group G in paper and corresponding index (a k-group)
-        G, G_idx = find_group_with_min_vl(group_to_search=PGL, 
-                                                            index_ignored=p_subgroups_k_merged_idxs)
-        # flag the previously found s_1 to be later removed from PGL list
-        p_subgroups_k_merged_idxs.append(G_idx)
+        _, G_idx = heapq.heappop(PGL_heap)
+
+        if not PGL_index.alive[G_idx]:
+            continue # already merged into another k-group
+
+        G = PGL[G_idx]
+        G_envelope = GroupEnvelope.from_bounds(PGL_r_plus[G_idx], PGL_r_minus[G_idx], len(G))
+        # remove the previously found s_1 from the p-subgroups left
+        PGL_index.remove(G_idx)
         # decrease the p-subgroup list size by the length of the previously found k-group G
         # note that each subgroup used to generate the final G should be deleted from the subgroup list after the completion
         # of the merging operation
@@ -142,26 +182,41 @@ def k_anonymity_bottom_up(p_subgroups, p, k, GL):
 
         while len(G) < k:
             # Find another P-subgroup which if merged with G, produces the minimal value loss of the union of the two groups
-            S_min, S_min_idx = find_group_with_min_vl(PGL,G,p_subgroups_k_merged_idxs)
-            # again, flag the corresponding group in PGL to be later removed
-            p_subgroups_k_merged_idxs.append(S_min_idx)
+            S_min_idx = PGL_index.best_merge(G_envelope)
+
+            S_min_envelope = GroupEnvelope.from_bounds(PGL_r_plus[S_min_idx], PGL_r_minus[S_min_idx],
+                    PGL_sizes[S_min_idx])
+
+            S_min = PGL[S_min_idx]
+            # again, remove the corresponding group from the p-subgroups left
+            PGL_index.remove(S_min_idx)
             # merge the time series of the two k-groups
-            G.update(S_min) 
+            G = np.concatenate((G, S_min))
+            G_envelope.merge(S_min_envelope)
             # decrease the size of the PGL list
             card_PGL -= len(S_min)
         # put group G into list GL
         GL.append(G) 
 
-    # remove all the p-subgroups which have been added to k-groups, by using the index list built before
-    p_subgroups_left = [p_subgroup for (p_subgroup_idx, p_subgroup) in enumerate(PGL) if p_subgroup_idx not in p_subgroups_k_merged_idxs]
+    # remove all the p-subgroups which have been added to k-groups, as removed from the index before
+    p_subgroups_left = [ p_subgroup for (p_subgroup_idx, p_subgroup) in enumerate(PGL) if PGL_index.alive[p_subgroup_idx] ]
+
+    # cached envelopes of the k-groups, updated in place as p-subgroups join them
+    GL_r_plus, GL_r_minus, GL_sizes = envelope_matrices(QI, GL)
 
     # for each remaining p-subgroup
     for p_subgroup in p_subgroups_left:
         # from paper: Each remaining P-subgroup in PGL will choose to join a k-group which again 
         # minimizes the total instant value loss
-        G_prime, G_prime_idx = find_group_with_min_vl(GL,p_subgroup)
-        # remove the k-group G_prime from list GL (the k-group list)
-        GL.pop(G_prime_idx)
-        # add the same k_group G_prime to the list again, this time with the time series of the added p-subgroup
-        G_prime.update(p_subgroup)
-        GL.append(G_prime)
\ No newline at end of file
+        p_subgroup_envelope = GroupEnvelope(QI[p_subgroup])
+
+        G_prime_vls = value_loss(GL_sizes + p_subgroup_envelope.size,
+                np.maximum(GL_r_plus, p_subgroup_envelope.r_plus), np.minimum(GL_r_minus, p_subgroup_envelope.r_minus))
+        G_prime_idx = int(np.argmin(G_prime_vls))
+
+        # add the time series of the p-subgroup to the k-group G_prime
+        GL[G_prime_idx] = np.concatenate((GL[G_prime_idx], p_subgroup))
+
+        np.maximum(GL_r_plus[G_prime_idx], p_subgroup_envelope.r_plus, out=GL_r_plus[G_prime_idx])
+        np.minimum(GL_r_minus[G_prime_idx], p_subgroup_envelope.r_minus, out=GL_r_minus[G_prime_idx])
+        GL_sizes[G_prime_idx] += p_subgroup_envelope.size
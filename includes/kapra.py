@@ -3,18 +3,22 @@
 Supporting Pattern-preserving Anonymization for Time-series Data, 5.3
 """
 
+import pandas as pd
+
 from loguru import logger
 
 # Custom imports #
 from .k_anonymity import k_anonymity_bottom_up
 from .l_diversity import enforce_l_diversity
 from .common import create_tree
+from .common import MAX_LEVEL
 from .io import load_dataset
 from .io import save_anonymized_dataset
-from .l_diversity import enforce_l_diversity
-from .common import create_tree
+from .io import save_results
+from .io import RESULTS_COLUMNS
+from .sax_codes import sax_code_matrix
 
-def KAPRA(K_value, P_value, paa_value, l_value, data_path):
+def KAPRA(K_value, P_value, paa_value, l_value, data_path, normalized=False, max_workers=1):
     """
     k-P anonymity based on work of Shou et al. 2013,
     Supporting Pattern-Preserving Anonymization for Time-Series Data
@@ -42,31 +46,135 @@ def KAPRA(K_value, P_value, paa_value, l_value, data_path):
 
     :param data_path: string
         Path of the dataset to be anonymized on disk
+
+    :param normalized: bool
+        Save the anonymized dataset as a normalized pair of group and record tables, see `save_anonymized_dataset()`
+
+    :param max_workers: int
+        Number of worker processes growing the create-tree partitions, see `grow_tree()`, and enforcing
+        l-diversity, see `enforce_l_diversity()`
+    """
+    dataset = load_dataset(data_path)
+
+    P_subgroups, suppressed_groups, PR = kapra_create_tree(dataset, P_value, paa_value, max_workers)
+
+    A_s = dataset.A_s # Perturbed in place
+
+    K_groups, _ = kapra_group_formation(dataset, P_subgroups, PR, A_s, K_value, P_value, l_value,
+            max_workers=max_workers)
+
+    outpath = save_anonymized_dataset(data_path, "kapra", dataset, PR , K_groups, 
+        suppressed=suppressed_groups, normalized=normalized)
+
+    logger.info('Saved anonymized dataset at: ' + str(outpath))
+
+def kapra_create_tree(dataset, P_value, paa_value, max_workers=1):
     """
-    _, _, QI_time_series, A_s_dict, col_names = load_dataset(data_path)
+    KAPRA create-tree phase, which only depends on the P-requirement and on the PAA size
+
+    Returns
+    -------
+    :return P_subgroups: list of np.ndarray of int
+        P-subgroups, as index arrays of rows
 
+    :return suppressed_groups: list of np.ndarray of int
+        Groups of records to suppress, as index arrays of rows
+
+    :return PR: dict
+        Dict of per-record pattern representations, keyed by row
+    """
     # create-tree phase
     logger.info("Start KAPRA create-tree phase ... ")
 
     PR = dict() # All pattern representations
                 # from QI records
 
-    P_subgroups, suppressed_groups = create_tree('kapra', QI_time_series, PR, P_value, paa_value)
+    # SAX pattern representations of every record at every level, computed once
+    words = sax_code_matrix(dataset.QI, paa_value, MAX_LEVEL)
+
+    P_subgroups, suppressed_groups = create_tree('kapra', words, dataset.rows(), PR, P_value, paa_value,
+            max_workers=max_workers)
 
-    
     logger.info('End KAPRA create-tree phase')
 
+    return P_subgroups, suppressed_groups, PR
+
+def kapra_group_formation(dataset, P_subgroups, PR, A_s, K_value, P_value, l_value, rng=None, max_workers=1):
+    """
+    KAPRA group formation phase, followed by l-diversity enforcement, which are the only ones depending on the
+    k- and l-requirements. P-subgroups are left untouched, so that they can be reused across k and l values.
+
+    Parameters
+    ----------
+    :param A_s: np.ndarray
+        Vector of sensitive attribute values, indexed by record row (perturbed in place)
+
+    :param rng: np.random.Generator - None
+        Random generator of l-diversity, see `enforce_l_diversity()`
+
+    :param max_workers: int
+        Number of worker processes of l-diversity, see `enforce_l_diversity()`
+
+    Returns
+    -------
+    :return K_groups: list of np.ndarray of int
+        k-groups, as index arrays of rows
+
+    :return perturbated: dict
+        Rounds of the +/- 1 increment fallback of l-diversity, keyed by row, see `enforce_l_diversity()`
+    """
+
     logger.info("Start group formation phase ... ")
 
-    # List containing K-groups, each expressed as a dictionary of pairs (time series identifier, time series values)
+    # List containing K-groups, each expressed as an index array of rows of the QI matrix
     K_groups = list()
 
     # Call group formation algorithm 
-    k_anonymity_bottom_up(P_subgroups, P_value, K_value, K_groups)
+    k_anonymity_bottom_up(dataset.QI, P_subgroups, P_value, K_value, K_groups)
 
-    enforce_l_diversity(PR, A_s_dict, K_groups, l_value)
+    perturbated = enforce_l_diversity(PR, A_s, K_groups, l_value, rng=rng, max_workers=max_workers)
 
-    outpath = save_anonymized_dataset(data_path, "kapra", PR , K_groups, A_s_dict, 
-        suppressed=suppressed_groups, col_names=col_names)
+    return K_groups, perturbated
 
-    logger.info('Saved anonymized dataset at: ' + str(outpath))
+def KAPRA_sweep(K_values, P_value, paa_value, l_values, data_path, results_dir=None, max_workers=1, seed=None):
+    """
+    Sweep KAPRA over many k- and l-requirements for the same P-requirement and PAA size, building the P-subgroup
+    forest only once, see `anonymize_kapra_sweep()`
+
+    Parameters
+    ----------
+    :param K_values: list of int
+        K-requirements for (k, P) anonymity, each no less than `P_value`
+
+    :param l_values: list of int
+        l-requirements for l-diversity
+
+    :param results_dir: str - None
+        Directory to save the results of each (k, l) pair into, with the same file names and format as
+        `k_P_anonymity.py`. Nothing is saved if None.
+
+    :param seed: int - None
+        Seed of all random draws, see `anonymize()`
+
+    Returns
+    -------
+    :return results_df: pd.DataFrame
+        Results of each (k, l) pair, with k, P, paa and l columns followed by the same metrics as `k_P_anonymity.py`.
+        The ETA of each pair includes the shared create-tree phase.
+    """
+
+    from .anonymize import anonymize_kapra_sweep # Circular import, as anonymize builds on this module
+
+    K_l_values = [ (K_value, l_value) for K_value in K_values for l_value in l_values ]
+
+    results = list()
+
+    for (K_value, l_value), result in zip(K_l_values, anonymize_kapra_sweep(data_path, K_l_values, P_value,
+            paa_value, max_workers, seed)):
+        results.append([ K_value, P_value, paa_value, l_value ] + result.results())
+
+        if results_dir is not None:
+            save_results(results_dir, data_path, 'kapra', K_value, P_value, paa_value, l_value,
+                    results[-1][4:])
+
+    return pd.DataFrame(results, columns=[ 'k', 'P', 'paa', 'l' ] + RESULTS_COLUMNS)
@@ -1,107 +1,221 @@
 import math
-import numpy as np 
-import random
+import numpy as np
 
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from loguru import logger
 
-def enforce_l_diversity(pattern_dict: dict, A_s_dict: dict, k_group_list: list, l: int, epsilon: int = 3):
-    """enforces the l-diversity on the records whose keys are inside A_s_dict
+def l_diversity_buckets(pattern_dict: dict, num_records: int, k_group_list: list):
+    """indexes each record by its (k-group, pattern) bucket, i.e. its PS(Q), once for all records
 
     Parameters
     ----------
     pattern_dict: dict
-        dictionary with records keys as keys and pattern representations as values
-    
-    A_s_dict: dict
-        dictionary with records keys as keys and sensitive attribute values as values
+        dictionary with records rows as keys and pattern representations as values
+
+    num_records: int
+        number of records in the table
 
     k_group_list: list
-        list of k-groups
-    
+        list of k-groups, as index arrays of rows
+
+    Returns
+    -------
+    buckets: list of np.ndarray
+        rows of each bucket, in increasing order. Records outside any k-group (suppressed) belong to no bucket.
+    """
+    # k-group of each record, the first one containing it
+    group_of = np.full(num_records, -1, dtype=np.int64)
+
+    for group_idx in reversed(range(len(k_group_list))):
+        group_of[k_group_list[group_idx]] = group_idx
+
+    rows = np.flatnonzero(group_of >= 0)
+
+    if len(rows) == 0:
+        return list()
+
+    _, pattern_of = np.unique(np.array([ pattern_dict[row] for row in rows.tolist() ], dtype=str),
+            return_inverse=True)
+
+    # one key per (k-group, pattern) pair
+    _, bucket_of = np.unique(group_of[rows]*(pattern_of.max() + 1) + pattern_of, return_inverse=True)
+
+    order = np.argsort(bucket_of, kind='stable')
+    bounds = np.flatnonzero(np.diff(bucket_of[order])) + 1
+
+    return np.split(rows[order], bounds)
+
+def enforce_bucket_l_diversity(values: np.ndarray, l: int, epsilon: int, seed):
+    """enforces the l-diversity within a single PS(Q) bucket
+
+    Parameters
+    ----------
+    values: np.ndarray
+        sensitive attribute values of the bucket records, in increasing row order
+
     l: int
         l-value for l-diversity
 
     epsilon: int
         how much to potentially perturbate data (data will be perturbed of a value in range [-epsilon, epsilon])
+
+    seed: np.random.SeedSequence
+        seed of the bucket's own random generator, so that results do not depend on how buckets are scheduled
+
+    Returns
+    -------
+    values: np.ndarray
+        perturbed sensitive attribute values of the bucket records
+
+    perturbated_dict: dict
+        rounds of the +/- 1 increment fallback, keyed by position within the bucket
     """
+    rng = np.random.default_rng(seed)
+
+    values = values.copy()
     perturbated_dict = {}
-    PS_R = None
-    keyset = set()
 
-    for key in A_s_dict:  # loop over record keys. A_s_dict[key] is sensitive data of that record
-        if key in keyset: continue  # already dealt with that record
-        
-        keyset.add(key)
+    # sensitive value counters, kept up to date while perturbing
+    counts = Counter(values.tolist())
 
-        # find PS(Q)
-        for k_group in k_group_list:
-            # derive the right p-group
-            if key in k_group.keys():
-                PS_R = [k for k in k_group if pattern_dict[k] == pattern_dict[key]]
-                break
+    # equivalence classes EC_v, i.e. records in PS_R having same sensitive attribute,
+    # dealt with in order of their first record
+    classes, first_pos, class_of = np.unique(values, return_index=True, return_inverse=True)
+    class_order = np.argsort(first_pos, kind='stable')
+    EC_positions = np.split(np.argsort(class_of, kind='stable'), np.cumsum(np.bincount(class_of))[:-1])
 
-        # find equivalence class, i.e. records in PS_R having same sensitive attribute
-        EC_v = [k for k in PS_R if A_s_dict[k] == A_s_dict[key]]
-        keyset.update(EC_v)
+    PS_R_size = len(values)
 
-        PS_s_values = {A_s_dict[k] for k in PS_R}
-        # some tuples can be suppressed after (k,p)-anonymity, so PS_R and EC_v might be
-        # empty - in which case we'll just skip this remaining step.
-        if PS_R and EC_v:
-            # l-diversity is satisfied, no need to take action
-            if len(EC_v) / len(PS_R) <= 1/l: continue
+    for class_idx in class_order:
+        EC_v = EC_positions[class_idx]
 
-            # data needs to be perturbed.
-            x_i = len(EC_v) - math.floor(len(PS_R)/l)
+        # l-diversity is satisfied, no need to take action
+        if len(EC_v) / PS_R_size <= 1/l: continue
 
-            for key_ec in np.random.default_rng().choice(EC_v, size=x_i, replace=False):
-                orig = A_s_dict[key_ec]
+        PS_s_values = { value for value, count in counts.items() if count > 0 }
 
-                noises = [ x - epsilon for x in range(2*epsilon + 1) ]
-                random.shuffle(noises)
+        # data needs to be perturbed.
+        x_i = len(EC_v) - math.floor(PS_R_size/l)
 
-                perturbated = False
+        for pos_ec in rng.choice(EC_v, size=x_i, replace=False):
+            orig = values[pos_ec]
 
-                for noise in noises:
-                    A_s_dict[key_ec] = orig + noise
+            noises = rng.permutation([ x - epsilon for x in range(2*epsilon + 1) ])
 
-                    if A_s_dict[key_ec] not in PS_s_values:
-                        perturbated = True
-                        break
-                
-                if perturbated:
-                    PS_s_values.add(A_s_dict[key_ec])
-                else:
-                    # No valid perturbative noise was found, where valid means that it did not previosuly exist inside the P-group.
-                    # In order not to falsify the frequency of the existing sensitive attributes inside the P-group, we discard the
-                    # random procedure, and operate with an iterative +/- 1 increment of the perturbative noise.
-                    # By doing so we favour the satisfaction of the l-diversity constraint at the expenses of larger information loss;
-                    # hence we improved the privacy capability, but degraded the utility in return.
-                    rnd = 1
-                    increment = 1
-                    while True:
-                        # Iteratively extend the +/- boundary
-                        # of the perturbative noise
-                        pos_noise = epsilon  + (increment*rnd)
-                        neg_noise = -epsilon - (increment*rnd)
-
-                        noises = [pos_noise, neg_noise]
-
-                        perturbated = False
-
-                        for noise in noises:
-                            A_s_dict[key_ec] = orig + noise
-
-                            if A_s_dict[key_ec] not in PS_s_values:
-                                perturbated = True
-                                break
-
-                        if perturbated:
-                            PS_s_values.add(A_s_dict[key_ec])
-                            logger.error('Perturbated record ' + str(key_ec)
-                                    + ' only at round #' + str(rnd))
-                            perturbated_dict[key_ec] = rnd
+            perturbated = False
+
+            for noise in noises:
+                values[pos_ec] = orig + noise
+
+                if values[pos_ec] not in PS_s_values:
+                    perturbated = True
+                    break
+
+            if not perturbated:
+                # No valid perturbative noise was found, where valid means that it did not previosuly exist inside the P-group.
+                # In order not to falsify the frequency of the existing sensitive attributes inside the P-group, we discard the
+                # random procedure, and operate with an iterative +/- 1 increment of the perturbative noise.
+                # By doing so we favour the satisfaction of the l-diversity constraint at the expenses of larger information loss;
+                # hence we improved the privacy capability, but degraded the utility in return.
+                rnd = 1
+                increment = 1
+                while True:
+                    # Iteratively extend the +/- boundary
+                    # of the perturbative noise
+                    pos_noise = epsilon  + (increment*rnd)
+                    neg_noise = -epsilon - (increment*rnd)
+
+                    noises = [pos_noise, neg_noise]
+
+                    perturbated = False
+
+                    for noise in noises:
+                        values[pos_ec] = orig + noise
+
+                        if values[pos_ec] not in PS_s_values:
+                            perturbated = True
                             break
-                        else:
-                            rnd += 1
-    return perturbated_dict
\ No newline at end of file
+
+                    if perturbated:
+                        perturbated_dict[int(pos_ec)] = rnd
+                        break
+                    else:
+                        rnd += 1
+
+            PS_s_values.add(values[pos_ec])
+
+            counts[orig] -= 1
+            counts[values[pos_ec]] += 1
+
+    return values, perturbated_dict
+
+def enforce_l_diversity(pattern_dict: dict, A_s: np.ndarray, k_group_list: list, l: int, epsilon: int = 3,
+        rng: np.random.Generator = None, max_workers: int = 1):
+    """enforces the l-diversity on the records whose rows are inside A_s
+
+    Parameters
+    ----------
+    pattern_dict: dict
+        dictionary with records rows as keys and pattern representations as values
+
+    A_s: np.ndarray
+        vector of sensitive attribute values, indexed by record row (perturbed in place)
+
+    k_group_list: list
+        list of k-groups, as index arrays of rows
+
+    l: int
+        l-value for l-diversity
+
+    epsilon: int
+        how much to potentially perturbate data (data will be perturbed of a value in range [-epsilon, epsilon])
+
+    rng: np.random.Generator
+        random generator seeding each bucket's own generator. A fresh unseeded one if None.
+
+    max_workers: int
+        number of worker processes over which buckets are spread. Buckets are processed serially if 1.
+
+    Returns
+    -------
+    perturbated_dict: dict
+        rounds of the +/- 1 increment fallback, keyed by the row of the perturbed record
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    buckets = l_diversity_buckets(pattern_dict, len(A_s), k_group_list)
+
+    # one independent seed per bucket, whether it needs perturbing or not,
+    # so that results do not depend on the buckets left out
+    seeds = np.random.SeedSequence(rng.integers(2**63)).spawn(len(buckets))
+
+    # only buckets whose most frequent sensitive value exceeds a 1/l share need perturbing
+    todo = [ bucket_idx for bucket_idx, bucket in enumerate(buckets)
+            if max(Counter(A_s[bucket].tolist()).values())*l > len(bucket) ]
+
+    logger.info('Perturbing {} out of {} PS(Q) buckets'.format(len(todo), len(buckets)))
+
+    args = ( [ A_s[buckets[bucket_idx]] for bucket_idx in todo ], [ l ]*len(todo),
+            [ epsilon ]*len(todo), [ seeds[bucket_idx] for bucket_idx in todo ] )
+
+    if max_workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(enforce_bucket_l_diversity, *args,
+                    chunksize=max(1, len(todo) // (4*max_workers))))
+    else:
+        results = list(map(enforce_bucket_l_diversity, *args))
+
+    perturbated_dict = {}
+
+    for bucket_idx, (values, bucket_perturbated) in zip(todo, results):
+        bucket = buckets[bucket_idx]
+        A_s[bucket] = values
+
+        for pos, rnd in bucket_perturbated.items():
+            logger.error('Perturbated record ' + str(bucket[pos])
+                    + ' only at round #' + str(rnd))
+            perturbated_dict[int(bucket[pos])] = rnd
+
+    return perturbated_dict
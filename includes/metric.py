@@ -2,122 +2,138 @@ import numpy as np
 import pandas as pd 
 from loguru import logger
 
+# Custom imports #
+from .group_envelope import GroupEnvelope
+from .group_envelope import value_loss
+from .io import is_normalized_release
+from .io import load_normalized_release
+
 def normalized_certainty_penalty(T, T_max_vals, T_min_vals):
     """
     Compute the normalized certainty penalty, NCP(T), from Xu et al. 2006,
     Utility-based Anonymization for Privacy Preservation with Less Information Loss, 3.2.1
     """
 
-    z = list()
-    y = list()
-    A = list()
+    return GroupEnvelope(T).ncp(T_max_vals, T_min_vals)
 
-    n = len(T[0]) # # of QI attributes in T
+def instant_value_loss(T, r_plus=None, r_minus=None):
+    """
+    Compute the instant value loss, VL(T), from Shou et al. 2011,
+    Supporting Pattern-preserving Anonymization for Time-series Data, 4.2.2
+    """ 
 
-    # 1. Loop over all QI attributes
-    # to fill z, y, and A
-    for i in range(n):
-        A.append(abs(T_max_vals[i] - T_min_vals[i]))
+    if r_plus is None or r_minus is None:
+        return GroupEnvelope(T).vl()
 
-        z_i = 0
-        y_i = float('inf')
-        
-        # Find the best z_i and y_i values
-        # across all records in T
-        for row in T:
-            if row[i] >= z_i:
-                z_i = row[i]
+    # Envelope known in advance, e.g., from an anonymized table
+    return value_loss(len(T), np.asarray(r_plus, dtype=float),
+            np.asarray(r_minus, dtype=float))
 
-            if row[i] < y_i:
-                y_i = row[i]
+def normalize_QI(QI, T_max_vals, T_min_vals):
+    """
+    Scale each QI attribute by its range across the whole table, so that the NCP between two
+    records boils down to the L1 distance between their normalized rows. Attributes spanning
+    a single value (|A_i| = 0) are zeroed out, as they carry no penalty.
+    """
 
-        z.append(z_i) 
-        y.append(y_i)
+    A = np.abs(np.asarray(T_max_vals, dtype=float) - np.asarray(T_min_vals, dtype=float))
+    A_inv = np.divide(1., A, out=np.zeros_like(A), where=A != 0)
 
-    # 2. Compute NCP(t) and then NCP(T)
-    ncp_t = 0
+    return np.asarray(QI, dtype=float)*A_inv
 
-    for i in range(n):
-        if A[i] == 0:
-            ncp_t += 0
-        else:
-            ncp_t += (z[i] - y[i]) / A[i]
+def pairwise_normalized_certainty_penalty(base, T_norm):
+    """
+    Compute NCP({base, t}) for every record t in T at once, with both `base` and `T_norm`
+    normalized by `normalize_QI()`
+    """
 
-    ncp_T = len(T)*ncp_t 
-    return ncp_T
+    return 2*np.abs(T_norm - base).sum(axis=1)
 
-def instant_value_loss(T, r_plus=None, r_minus=None):
+def pairwise_instant_value_loss(base, T):
     """
-    Compute the instant value loss, VL(T), from Shou et al. 2011,
-    Supporting Pattern-preserving Anonymization for Time-series Data, 4.2.2
-    """ 
+    Compute VL({base, t}) for every record t in T at once
+    """
+
+    n = T.shape[1] # # of QI attributes in T
 
-    n = len(T[0])  # # of QI attributes in T
+    return 2*np.sqrt(((T - base)**2).sum(axis=1) / n)
 
-    if not r_plus or not r_minus:
-        r_plus  = list()
-        r_minus = list()
+def global_value_loss(envelopes, num_records):
+    """
+    Compute the instant value loss for a whole anonymized table, straight from the envelopes
+    and sizes of its k-groups. Suppressed records belong to no k-group, hence carry no value loss,
+    but they are still accounted for in the average.
+
+    Parameters
+    ----------
+    :param envelopes: list of GroupEnvelope
+        Envelopes of all k-groups in the table
+
+    :param num_records: int
+        Total # of records in the table
+
+    Returns
+    -------
+    :return glob_vl: float
+        Global value loss
+
+    :return mean_vl: float
+        Average value loss per record
+    """
+
+    glob_vl = sum(envelope.vl() for envelope in envelopes)
+
+    return glob_vl, glob_vl/num_records
 
+def read_anonymized_envelopes(anonym_path):
+    """
+    Parse the k-group envelopes back from an anonymized dataset on disk. All records in a k-group
+    share the same "[min|max]" envelope, so only the first record of each group is parsed, in one
+    vectorized pass over all its QI columns.
+    Normalized releases, see `save_anonymized_dataset()`, are read straight from their group table.
+
+    Returns
+    -------
+    :return envelopes: list of GroupEnvelope
+        Envelopes of all k-groups in the table
+
+    :return num_records: int
+        Total # of records in the table
+    """
+
+    if is_normalized_release(anonym_path):
+        groups, records = load_normalized_release(anonym_path)
+
+        # QI attributes (min and max) alternate after group and size
+        bounds = groups.iloc[:, 2:].to_numpy().reshape(len(groups), -1, 2)
 
-        for i in range(n): 
-            r_plus_i  = 0
-            r_minus_i = float('inf')
+        envelopes = [ GroupEnvelope.from_bounds(bounds[i, :, 1], bounds[i, :, 0], size)
+                for i, size in enumerate(groups["size"].tolist()) ]
 
-            for row in T:
-                if row[i] > r_plus_i:
-                    r_plus_i = row[i]
+        return envelopes, len(records)
 
-                if row[i] < r_minus_i:
-                    r_minus_i = row[i]
+    df = pd.read_csv(anonym_path, dtype=str)
 
-            r_plus.append(r_plus_i) 
-            r_minus.append(r_minus_i)
-    
-    # Compute VL(t) and then VL(T)
-    vl_t = 0
+    # remove Ids, and sensitive data, sax and group (last three columns)
+    QI_cols = list(df.columns)[1:-3]
 
-    for i in range(n):
-        vl_t += pow((r_plus[i] - r_minus[i]), 2) / n
+    groups = df["group"].dropna() # Suppressed records belong to no group
+    sizes  = groups.value_counts(sort=False)
 
-    vl_T = len(T)*np.sqrt(vl_t)
-    return vl_T
+    heads = df.loc[groups.drop_duplicates().index]
+
+    # remove "[" and "]", then get min and max
+    bounds = pd.Series(heads[QI_cols].to_numpy().ravel()).str[1:-1] \
+            .str.split("|", expand=True).apply(pd.to_numeric).to_numpy()
+    bounds = bounds.reshape(len(heads), len(QI_cols), 2)
+
+    envelopes = [ GroupEnvelope.from_bounds(bounds[i, :, 1], bounds[i, :, 0], sizes[group])
+            for i, group in enumerate(heads["group"]) ]
+
+    return envelopes, len(df)
 
 def global_anon_value_loss(anonym_path):
-    """given the nae of an anonymized dataset, loads it and computes
+    """given the name of an anonymized dataset, loads it and computes
     instant value loss for whole table"""
-    glob_vl = 0
-
-    # loaf dataframe, group by last column
-    df = pd.read_csv(anonym_path)
-    g_df = df.groupby(["group"])
-    for key, _ in g_df:
-        # g is a dataframe with all the anon rows belonging to group key
-        g = g_df.get_group(key)
-
-        # remove Ids
-        cols = list(g.columns)
-        g.pop(cols[0])
-        cols = cols[1:]
-
-        # remove sensitive data, sax and group (last three columns)
-        for _ in range(3):
-            g.pop(cols[-1])
-            cols.pop(-1)
-
-        QI_list = [list(g.iloc[i]) for i in range(len(g))]  # Quasi-identifier attributes
-
-        fst_row = list(g.iloc[0])
-
-        r_plus  = [0 for _ in range(len(fst_row))]
-        r_minus = [0 for _ in range(len(fst_row))]
-        
-        for i in range(len(fst_row)):  # max and min will be the same for all this anon envelope
-            # remove "[" and "]"
-            rng = fst_row[i]
-            # get min and max
-            mn, mx = rng[1:-1].split("|")
-            r_minus[i] = int(mn)
-            r_plus[i] = int(mx)
-
-        glob_vl += instant_value_loss(QI_list, r_plus=r_plus, r_minus=r_minus)
-    return glob_vl, glob_vl/len(df)
+
+    return global_value_loss(*read_anonymized_envelopes(anonym_path))
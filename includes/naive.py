@@ -10,19 +10,50 @@ import numpy as np
 from .k_anonymity import k_anonymity_top_down
 from .l_diversity import enforce_l_diversity
 
-from .common import create_tree
+from .common import create_tree_forest
+from .common import MAX_LEVEL
 
 from .io import load_dataset
 from .io import save_anonymized_dataset
+from .sax_codes import sax_code_matrix
+
+def Naive(k_value, P_value, paa_value, l_value, data_path, normalized=False, max_workers=1):
+    dataset = load_dataset(data_path)
+
+    QI_k_anonymized, PR, perturbated = naive_anonymize(dataset, k_value, P_value, paa_value, l_value,
+            max_workers)
+
+    outpath = save_anonymized_dataset(data_path, "naive", dataset, PR, QI_k_anonymized,
+            normalized=normalized)
+
+    logger.info('Saved anonymized dataset at: ' + str(outpath))
+    return perturbated
+
+def naive_anonymize(dataset, k_value, P_value, paa_value, l_value, max_workers=1, rng=None, seed=None):
+    """
+    Naive (k, P)-anonymity on a dataset already in memory, whose sensitive attribute is perturbed in place.
+    l-diversity draws from `rng`, see `enforce_l_diversity()`, and each split of the top-down clustering from its
+    own generator seeded by `seed`, so that k-groups do not depend on `max_workers`, see
+    `top_down_greedy_clustering()`.
+
+    Returns
+    -------
+    :return QI_k_anonymized: list of np.ndarray of int
+        k-groups, as index arrays of rows
+
+    :return PR: dict
+        Dict of per-record pattern representations, keyed by row
+
+    :return perturbated: dict
+        Rounds of the +/- 1 increment fallback of l-diversity, keyed by row, see `enforce_l_diversity()`
+    """
 
-def Naive(k_value, P_value, paa_value, l_value, data_path):
-    QI_min_vals, QI_max_vals, QI_time_series, A_s_dict, col_names = load_dataset(data_path)
-    
     # If k greater than the available QI data
-    if k_value > len(A_s_dict):
+    if k_value > len(dataset):
         logger.error('<k_value> cannot be greater than the'
                 + ' available QI time series data')
-        exit(1)
+        raise ValueError('<k_value> cannot be greater than the'
+                + ' available QI time series data')
 
     logger.info('Launching naive (k, P)-anonymity algorithm...')
 
@@ -31,8 +62,8 @@ def Naive(k_value, P_value, paa_value, l_value, data_path):
 
     QI_k_anonymized = list() # All k-groups from QI records
 
-    k_anonymity_top_down(QI_time_series.copy(), k_value, # Copy QI_time_series because top down k-anonymity                                  
-           QI_k_anonymized, QI_max_vals, QI_min_vals)    # will delete its entries while forming groups
+    k_anonymity_top_down(dataset.QI, dataset.rows(), k_value,
+           QI_k_anonymized, dataset.QI_max_vals, dataset.QI_min_vals, max_workers, seed)
 
     logger.info('Ended top down k-anonymity')
 
@@ -42,21 +73,20 @@ def Naive(k_value, P_value, paa_value, l_value, data_path):
     PR = dict() # All pattern representations
                 # from QI records
 
-    for idx, k_group in enumerate(QI_k_anonymized):
-        logger.info('Create-tree phase k-group #' + str(idx) + '...')
-        create_tree('naive', k_group, PR, P_value, paa_value)
-        logger.info('Ended Create-tree k-group #' + str(idx))
+    # SAX pattern representations of every record at every level, computed once
+    words = sax_code_matrix(dataset.QI, paa_value, MAX_LEVEL)
+
+    create_tree_forest('naive', words, QI_k_anonymized, PR, P_value, paa_value,
+            max_workers=max_workers)
 
     logger.info('Split all P-subgroups')
 
     # 3. Enforce l-diversity
     logger.info('Enforcing l-diversity...')
 
-    perturbated = enforce_l_diversity(PR, A_s_dict, QI_k_anonymized, l_value)
+    perturbated = enforce_l_diversity(PR, dataset.A_s, QI_k_anonymized, l_value, rng=rng,
+            max_workers=max_workers)
 
     logger.info('Enforced l-diversity')
 
-    outpath = save_anonymized_dataset(data_path, "naive", PR, QI_k_anonymized, A_s_dict, col_names=col_names)
-
-    logger.info('Saved anonymized dataset at: ' + str(outpath))
-    return perturbated
\ No newline at end of file
+    return QI_k_anonymized, PR, perturbated
@@ -1,15 +1,10 @@
 import numpy as np
-from saxpy.znorm import znorm
-from saxpy.sax import ts_to_string
-from saxpy.alphabet import cuts_for_asize
 from loguru import logger
-from saxpy.paa import paa
-from saxpy.sax import sax_by_chunking
 
 class Node:
 
     def __init__(self, level: int = 1, pattern_representation: str = "", label: str = "intermediate",
-                 group: dict = None, paa_value: int = 3):
+                 group: np.ndarray = None, paa_value: int = 3, words: np.ndarray = None):
         self.level = level
         self.paa_value = paa_value
         if pattern_representation == "":
@@ -19,7 +14,8 @@ class Node:
             self.pattern_representation = pattern_representation
         self.size = len(group)  # numbers of time series contained
         self.label = label  # each node has tree possible labels: bad-leaf, good-leaf or intermediate
-        self.group = group  # group obtained from k-anonymity top-down
+        self.group = group  # group obtained from k-anonymity top-down, as an index array of record rows
+        self.words = words  # per-level SAX code matrix shared by all nodes of the tree, see sax_code_matrix()
         # TODO: Remove below attributes
 
     def start_splitting(self, p_value: int, max_level: int, good_leaf_nodes: list(), bad_leaf_nodes: list()):
@@ -30,25 +26,34 @@ class Node:
         :param paa_value
         :return:
         """
+        for node in self.split_children(p_value, max_level, good_leaf_nodes, bad_leaf_nodes):
+            node.start_splitting(p_value, max_level, good_leaf_nodes, bad_leaf_nodes)
+
+    def split_children(self, p_value: int, max_level: int, good_leaf_nodes: list(), bad_leaf_nodes: list()):
+        """
+        Single step of the node splitting procedure: label the node as a leaf, or really split it into children,
+        which are then independent of each other
+        :return: list of children nodes still to be split, in order
+        """
 
         if self.size < p_value: # Case base 1
             #logger.info("size:{}, p_value:{} == bad-leaf".format(self.size, p_value))
             self.label = "bad-leaf"
             bad_leaf_nodes.append(self)
-            return
+            return list()
 
         if self.level == max_level: # Case base 2
             #logger.info("size:{}, p_value:{} == good-leaf".format(self.size, p_value))
             self.label = "good-leaf"
             good_leaf_nodes.append(self)
-            return
+            return list()
 
         if p_value <= self.size < 2*p_value: # Case base 3
             #logger.info("Maximize-level, size:{}, p_value:{} == good-leaf".format(self.size, p_value))
             self.maximize_level_node(max_level)
             self.label = "good-leaf"
             good_leaf_nodes.append(self)
-            return
+            return list()
         """
         Otherwise, we need to check if node N has to be split. The checking relies on a tentative split performed on N. 
         Suppose that, by increasing the level of N, N is tentatively split into a number of child nodes. 
@@ -61,16 +66,19 @@ class Node:
         child nodes (including TB and TG) and nc >= 2, N will really be split into nc children and then the node 
         splitting procedure will be recursively invoked on each of them 
         """
-        tentative_child_node = dict()  # key: pattern, value: [RECORD_KEYS]
+        tentative_child_node = dict()  # key: pattern, value: RECORD_ROWS
         temp_level = self.level + 1
-        for key, value in self.group.items():
-            # to reduce dimensionality
-            data = np.array(value)
-            pr = sax_by_chunking(data, self.paa_value, temp_level)
-            if pr in tentative_child_node.keys():
-                tentative_child_node[pr].append(key)
-            else:
-                tentative_child_node[pr] = [key]
+
+        # Look up the pattern of each record at the tentative level,
+        # and bucket records by pattern in order of first appearance
+        prs, first, inverse = np.unique(self.words[temp_level, self.group],
+                return_index=True, return_inverse=True)
+
+        by_pattern = np.argsort(inverse.ravel(), kind='stable')
+        buckets = np.split(self.group[by_pattern], np.cumsum(np.bincount(inverse.ravel()))[:-1])
+
+        for index in np.argsort(first):
+            tentative_child_node[str(prs[index])] = buckets[index]
 
         length_all_tentative_child = [len(x) for x in list(tentative_child_node.values())] 
         good_leaf = np.all(np.array(length_all_tentative_child) < p_value)
@@ -79,7 +87,7 @@ class Node:
             #logger.info("Good-leaf, all_tentative_child are < {}".format(p_value))
             self.label = "good-leaf"
             good_leaf_nodes.append(self)
-            return
+            return list()
         else:
             #logger.info("N can be split")
             #logger.info("Compute tentative good nodes and tentative bad nodes")
@@ -91,11 +99,7 @@ class Node:
             # logger.info(pr_keys)
             tg_nodes = list()
             for index in tg_nodes_index:
-                keys_elements = tentative_child_node[pr_children[index]]
-                dict_temp = dict()
-                for key in keys_elements:
-                    dict_temp[key] = self.group[key]
-                tg_nodes.append(dict_temp)
+                tg_nodes.append(tentative_child_node[pr_children[index]])
                 pattern_representation_tg.append(pr_children[index])
 
             # tentative bad nodes
@@ -104,26 +108,20 @@ class Node:
             pattern_representation_tb = list()
 
             for index in tb_nodes_index:
-                keys_elements = tentative_child_node[pr_children[index]]
-                dict_temp = dict()
-                for key in keys_elements:
-                    dict_temp[key] = self.group[key]
-                tb_nodes.append(dict_temp)
+                tb_nodes.append(tentative_child_node[pr_children[index]])
                 pattern_representation_tb.append(pr_children[index])
 
             total_size_tb_nodes = sum(len(tb_node) for tb_node in tb_nodes)
 
             if total_size_tb_nodes >= p_value:
                 #logger.info("Merge all bad nodes in a single node, and label it as good-leaf")
-                child_merge_node_group = dict()
-                for tb_node in tb_nodes:
-                    child_merge_node_group.update(tb_node)
+                child_merge_node_group = np.concatenate(tb_nodes)
 
                 
                 # The merged child's pattern is obliged to be the parent's as by construction each record would be reprocessed
                 # at self.level, and at that level it would have the same pattern that put it in the parent in the first place.
                 node_merge = Node(level=self.level, pattern_representation=self.pattern_representation,
-                                  label="intermediate", group=child_merge_node_group, paa_value=self.paa_value)
+                                  label="intermediate", group=child_merge_node_group, paa_value=self.paa_value, words=self.words)
 
                 # There's no need to split again because the each record in the merged child would generate the very same patterns 
                 # that it just generated at this splitting iteration; hence, it would lead to the very same bad leaves that had to 
@@ -132,29 +130,33 @@ class Node:
 
                 # Here you are guaranteed two have at least 2 bad nodes (otherwise no splitting) and 1 good node (otherwise
                 # exit ad case base 4). There's no need to compute nc
+                children = list()
                 for index in range(len(tg_nodes)):
                     node = Node(level=self.level + 1, pattern_representation=pattern_representation_tg[index],
-                                label="intermediate", group=tg_nodes[index], paa_value=self.paa_value)
-                    node.start_splitting(p_value, max_level, good_leaf_nodes, bad_leaf_nodes)
+                                label="intermediate", group=tg_nodes[index], paa_value=self.paa_value, words=self.words)
+                    children.append(node)
+                return children
 
             else:  # can't merge bad nodes
                 # Here we are guarantered to ahve at least 1 good node (otherwise case base 4)
                 nc = len(tg_nodes) + len(tb_nodes)                 
+                children = list()
                 if nc >= 2:
                     # Either we have at least 2 good nodes, or at least 1 bad node
                     for index in range(len(tb_nodes)):
                         node = Node(level=self.level + 1, pattern_representation=pattern_representation_tb[index], label="bad-leaf",
-                                    group=tb_nodes[index], paa_value=self.paa_value)
-                        node.start_splitting(p_value, max_level, good_leaf_nodes, bad_leaf_nodes)  # will make it bad leaf
+                                    group=tb_nodes[index], paa_value=self.paa_value, words=self.words)
+                        children.append(node)  # will make it bad leaf
 
                     for index in range(len(tg_nodes)):
                         node = Node(level=self.level + 1, pattern_representation=pattern_representation_tg[index],
-                                    label="intermediate", group=tg_nodes[index], paa_value=self.paa_value)
-                        node.start_splitting(p_value, max_level, good_leaf_nodes, bad_leaf_nodes) 
+                                    label="intermediate", group=tg_nodes[index], paa_value=self.paa_value, words=self.words)
+                        children.append(node)
                 else:
                     node = Node(level=self.level + 1, pattern_representation=pattern_representation_tg[0],
-                            label="intermediate", group=tg_nodes[0], paa_value=self.paa_value)
-                    node.start_splitting(p_value, max_level, good_leaf_nodes, bad_leaf_nodes) 
+                            label="intermediate", group=tg_nodes[0], paa_value=self.paa_value, words=self.words)
+                    children.append(node)
+                return children
 
     @staticmethod
     def postprocessing(good_leaf_nodes, bad_leaf_nodes):
@@ -190,8 +192,7 @@ class Node:
         :param node_to_add:
         :return:
         """
-        for key, value in node_to_add.group.items():
-            node_original.group[key] = value
+        node_original.group = np.concatenate((node_original.group, node_to_add.group))
         node_original.size = len(node_original.group)
 
     def maximize_level_node(self, max_level):
@@ -200,26 +201,18 @@ class Node:
         :param p_value:
         :return:
         """
-        values_group = list(self.group.values())
         original_level = self.level
         equal = True
 
-        while equal and self.level <= max_level:
+        while equal and self.level < max_level:
             temp_level = self.level + 1
-            data = np.array(values_group[0])
-            pr = sax_by_chunking(data, self.paa_value, temp_level)
-            for index in range(1, len(values_group)):
-                data = np.array(values_group[index])
-                pr_2 = sax_by_chunking(data, self.paa_value, temp_level)
-                if pr_2 != pr:
-                    equal = False
-                    break
+            prs = self.words[temp_level, self.group]
+            equal = bool(np.all(prs == prs[0]))
             if equal:
                 self.level = temp_level 
         if original_level != self.level: # The level has been maximized of at least 1 unit
             #logger.info("New level for node: {}".format(self.level))
-            data = np.array(values_group[0])
-            self.pattern_representation = sax_by_chunking(data, self.paa_value, self.level)
+            self.pattern_representation = str(self.words[self.level, self.group[0]])
 
     @staticmethod
     def recycle_bad_leaves(p, good_leaf_nodes, bad_leaf_nodes, suppressed_nodes, paa_value):
@@ -256,7 +249,8 @@ class Node:
         #   self.pattern_representation: SAX encoding for this p-subgroup
         #   self.size: numbers of time series contained in self.group (see below)
         #   self.label: either bad-leaf, good-leaf or intermediate
-        #   self.group: dict of pairs (time series identifier, time series values), which are the contents of a p-subgroup
+        #   self.group: index array of record rows, which are the contents of a p-subgroup
+        #   self.words: per-level SAX code matrix shared by all nodes of the tree
         
         bad_leaf_nodes_dict = dict()
         # create a dictionary formed by pairs (level, node_list_for_level)
@@ -317,14 +311,15 @@ class Node:
                         for pr, node_list in merge_dict.items():
                             # create a new dictionary, which will contain all the time series associated with the merged
                             # node
-                            group = dict()
+                            group = list()
                             # for each node having the same pattern representation
                             for node in node_list:
                                 # remove the node from the dictionary of bad_leaf_nodes (having associations (level, nodes))
                                 bad_leaf_nodes_dict[current_level].remove(node)
-                                # insert all the items contained in node.group into the temporary dictionary group
+                                # collect all the rows contained in node.group into the temporary list group
                                 # (used to merge the time series of the nodes associated with the same level and pattern representation)
-                                group.update(node.group)
+                                group.append(node.group)
+                            group = np.concatenate(group)
                             # check the current level
                             if current_level > 1:
                                 level = current_level
@@ -332,7 +327,7 @@ class Node:
                                 level = 1
                             # create the merged node, with the same level and pattern representation of the merged bad leaf nodes
                             leaf_merge = Node(level=level, pattern_representation=pr,
-                                group=group, paa_value=paa_value)
+                                group=group, paa_value=paa_value, words=node_list[0].words)
 
                             # if the size of the merged node is no less than P
                             if leaf_merge.size >= p:
@@ -358,16 +353,8 @@ class Node:
                 for node in bad_leaf_nodes_dict[current_level]: 
                     # if the newly computed level is > 1
                     if temp_level > 1:
-                        # retrieve all the time series associated with the node 
-                        values_group = list(node.group.values())
-                        # take the first time series associated with the node
-                        data = np.array(values_group[0])
-                        # normalize the time series
-                        data_znorm = znorm(data)
-                        # compress the time series using paa
-                        data_paa = paa(data_znorm, paa_value)
-                        # encode the compressed time series using sax
-                        pr = ts_to_string(data_paa, cuts_for_asize(temp_level))
+                        # look up the sax encoding at the coarser level of the first time series associated with the node
+                        pr = str(node.words[temp_level, node.group[0]])
                     else:
                         # if level equal to 1, use the standard encoding reported in the paper (only 'a' paa_value characters)
                         pr = "a"*paa_value
@@ -0,0 +1,461 @@
+"""
+Out-of-core KAPRA, for datasets larger than memory. Records are spilled into on-disk partitions by their coarse SAX
+word, i.e., by the first real split of the KAPRA tree, so that each partition's subtree can be grown, and its P-subgroups
+formed into k-groups, with only that partition in memory. What is left over across partitions, i.e., bad leaves, small
+partitions and P-subgroups too few to form a k-group, is handled in a final pass.
+"""
+
+import os
+import random
+import tempfile
+
+import numpy as np
+
+from loguru import logger
+from pathlib import Path
+
+# Custom imports #
+from .anonymized_dataset import AnonymizedDataset
+from .common import MAX_LEVEL
+from .dataset import Dataset
+from .group_envelope import envelope_matrices
+from .group_envelope import GroupEnvelope
+from .group_envelope import value_loss
+from .io import generate_output_path
+from .io import iter_csv_chunks
+from .k_anonymity import k_anonymity_bottom_up
+from .metric import global_value_loss
+from .l_diversity import enforce_l_diversity
+from .node import Node
+from .pattern_loss import cosine_distances
+from .pattern_loss import reconstruct_fv_matrix
+from .sax_codes import sequential_paa_matrix
+from .sax_codes import sax_code_matrix
+
+PARTITION_LEVEL = 2 # Level of the coarse SAX words records are partitioned by, i.e., of the root's children
+
+class Partitions:
+    """
+    On-disk partitions of the records of a dataset, by their coarse SAX word. Each partition is made of three files,
+    appended to chunk by chunk: the Ids, the QI attributes and the sensitive data. Numeric columns are stored as raw
+    values of their own type, promoted as later chunks require, see `np.result_type()`, and any other column as text.
+    Each column is cast to the type promoted over all chunks when a partition is loaded, so that partitions hold the
+    same values and types as the whole dataset would.
+
+    Parameters
+    ----------
+    :param work_dir: Path
+        Directory of the partition files
+    """
+
+    def __init__(self, work_dir):
+        self.work_dir = Path(work_dir)
+        self.sizes = dict() # # of records of each partition, by coarse SAX word
+        self.col_names = None
+        self.dtypes = dict() # Type of each column, promoted over all chunks, by name
+        self.stored = dict() # Type each column of each partition is stored as, by (word, name)
+
+    def paths(self, word):
+        return [ self.work_dir / '{}.{}'.format(word, ext) for ext in ('ids', 'QI', 'A_s') ]
+
+    @staticmethod
+    def write_column(path, values, dtype):
+        """
+        Append values to a column file, as raw values of a numeric type, or as text lines
+        """
+
+        if dtype == object:
+            with open(path, 'a') as file:
+                file.write("".join("{}\n".format(value) for value in values.tolist()))
+        else:
+            with open(path, 'ab') as file:
+                file.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+
+    @staticmethod
+    def read_column(path, dtype):
+        if dtype == object:
+            with open(path) as file:
+                return np.array(file.read().splitlines(), dtype=object)
+
+        return np.fromfile(path, dtype=dtype)
+
+    def append(self, word, name, path, values):
+        """
+        Append values to a column of a partition, whose file is rewritten first
+        if their type promotes the one it is stored as
+        """
+
+        dtype = np.dtype(object) if values.dtype.kind not in 'biuf' else values.dtype
+        stored = self.stored.get((word, name))
+
+        if stored is not None and np.result_type(stored, dtype) != stored:
+            promoted = np.result_type(stored, dtype)
+            previous = self.read_column(path, stored)
+
+            os.remove(path)
+            self.write_column(path, previous, promoted)
+
+            stored = promoted
+
+        if stored is None:
+            stored = dtype
+
+        self.write_column(path, values, stored)
+
+        self.stored[word, name] = stored
+        self.dtypes[name] = np.result_type(self.dtypes.get(name, dtype), dtype)
+
+    def spill(self, data_path, paa_value, chunk_size=None):
+        """
+        Stream a CSV dataset into partitions, see `iter_csv_chunks()`
+        """
+
+        for col_names, ids, block, A_s in iter_csv_chunks(data_path, chunk_size):
+            self.col_names = col_names
+
+            # SAX words are computed record by record, hence
+            # chunks get the same words as the whole dataset
+            words = sax_code_matrix(block, paa_value, PARTITION_LEVEL)[PARTITION_LEVEL]
+
+            patterns, first, inverse = np.unique(words, return_index=True, return_inverse=True)
+            by_pattern = np.argsort(inverse, kind='stable')
+
+            for word, rows in zip(patterns.tolist(), np.split(by_pattern, np.cumsum(np.bincount(inverse))[:-1])):
+                for name, path, values in zip(('ids', 'QI', 'A_s'), self.paths(word), (ids, block, A_s)):
+                    self.append(word, name, path, values[rows])
+
+                self.sizes[word] = self.sizes.get(word, 0) + len(rows)
+
+        logger.info('Spilled {} records into {} partitions'.format(sum(self.sizes.values()), len(self.sizes)))
+
+    def load(self, word):
+        """
+        Load a whole partition as a dataset
+        """
+
+        ids, QI, A_s = [ self.read_column(path, self.stored[word, name]).astype(self.dtypes[name], copy=False)
+                for name, path in zip(('ids', 'QI', 'A_s'), self.paths(word)) ]
+
+        return Dataset(ids, QI.reshape(len(ids), len(self.col_names) - 1), A_s, self.col_names)
+
+class Leftovers:
+    """
+    In-memory store of the records left over by all partitions: bad leaves, whole partitions smaller than P, and
+    P-subgroups of partitions too small to form a k-group. Rows of the leftover records index into `dataset()`.
+    """
+
+    def __init__(self):
+        self.ids = list()
+        self.QI  = list()
+        self.A_s = list()
+        self.size = 0
+
+        self.bad_leaves = list() # (level, pattern representation, rows) of each bad leaf
+        self.P_subgroups = list() # (pattern representation, rows) of each P-subgroup
+
+    def add(self, dataset, rows):
+        """
+        Copy some rows of a partition, and return their rows among the leftover records
+        """
+
+        self.ids.append(dataset.ids[rows])
+        self.QI.append(dataset.QI[rows])
+        self.A_s.append(dataset.A_s[rows])
+
+        self.size += len(rows)
+
+        return np.arange(self.size - len(rows), self.size, dtype=np.int64)
+
+    def dataset(self, col_names):
+        if self.size == 0:
+            return None
+
+        return Dataset(np.concatenate(self.ids), np.concatenate(self.QI), np.concatenate(self.A_s), col_names)
+
+def pattern_losses(QI, prs, paa_value):
+    """
+    Pattern loss of each record, see `global_pattern_loss()`. Records with no pattern (suppressed) reconstruct
+    to the zero vector.
+    """
+
+    if len(QI) == 0:
+        return np.zeros(0)
+
+    return cosine_distances(sequential_paa_matrix(QI, paa_value), reconstruct_fv_matrix(prs, paa_value))
+
+def KAPRA_out_of_core(K_value, P_value, paa_value, l_value, data_path, work_dir=None, chunk_size=None, seed=None):
+    """
+    Out-of-core KAPRA, see `KAPRA()`, which only ever holds a single partition of records in memory, along with
+    the leftover records across partitions.
+
+    1. The CSV dataset is streamed into on-disk partitions, by the coarse SAX word of each record, see `Partitions`.
+       Partitions are the children of the root of the KAPRA tree, hence they are labelled the same way: partitions of
+       at least P records are grown into subtrees, while the others are merged into a single good leaf, if they are at
+       least P records in total, or left as bad leaves otherwise.
+    2. Each partition is grown into its subtree; its good leaves, i.e., P-subgroups, are formed into k-groups, and their
+       envelopes kept on disk. Its bad leaves, and its P-subgroups if too few to form a k-group, are left over.
+    3. Bad leaves left over by all partitions are recycled, see `Node.recycle_bad_leaves()`, then leftover P-subgroups
+       are formed into k-groups. If they are too few, each one joins the k-group of any partition which minimizes the
+       instant value loss instead, envelopes being loaded from disk once.
+    4. Each partition is loaded once more, along with the leftover records joining its k-groups, to enforce the
+       l-diversity and write its k-groups to the anonymized dataset; then leftover k-groups and suppressed records
+       are written.
+
+    Unlike `KAPRA()`, P-subgroups are only formed into k-groups with P-subgroups of the same partition, while
+    leftover ones are formed into k-groups of their own.
+
+    Parameters
+    ----------
+    :param data_path: str
+        Path of the CSV dataset to be anonymized on disk
+
+    :param work_dir: str - None
+        Directory the partitions are spilled into, within a temporary directory removed when done.
+        The system's temporary directory if None.
+
+    :param chunk_size: int - None
+        # of rows in each chunk of the dataset, see `iter_csv_chunks()`
+
+    :param seed: int - None
+        Seed of all random draws, see `anonymize()`
+
+    Returns
+    -------
+    :return outpath: Path
+        Path of the anonymized dataset
+
+    :return pattern_loss: (float, float)
+        Global and average pattern loss
+
+    :return value_loss: (float, float)
+        Global and average instant value loss
+    """
+
+    if K_value < P_value:
+        raise ValueError('<k_value> must be greater or equal than <P_value>')
+
+    rng = None # l-diversity generator
+
+    if seed is not None:
+        random.seed(seed)
+        rng = np.random.default_rng(seed)
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        partitions = Partitions(tmp_dir)
+        partitions.spill(data_path, paa_value, chunk_size)
+
+        num_records = sum(partitions.sizes.values())
+
+        if K_value > num_records:
+            raise ValueError('<k_value> cannot be greater than the'
+                    + ' available QI time series data')
+
+        leftovers = Leftovers()
+        grown = list() # Partitions which formed k-groups of their own
+
+        # 1. Label partitions as the children of the root
+        small = { word for word, size in partitions.sizes.items() if size < P_value }
+        small_size = sum(partitions.sizes[word] for word in small)
+
+        merged_rows = list()
+
+        for word in small:
+            dataset = partitions.load(word)
+            rows = leftovers.add(dataset, dataset.rows())
+
+            if small_size >= P_value:
+                merged_rows.append(rows)
+            else:
+                leftovers.bad_leaves.append((PARTITION_LEVEL, word, rows))
+
+        # Merged into a single good leaf at the root's level, which
+        # is the whole dataset if all partitions are smaller than P
+        if len(merged_rows) > 0:
+            leftovers.P_subgroups.append(("a"*paa_value, np.concatenate(merged_rows)))
+
+        # 2. Grow each partition, and form its k-groups
+        for word in partitions.sizes:
+            if word in small:
+                continue
+
+            dataset = partitions.load(word)
+            words = sax_code_matrix(dataset.QI, paa_value, MAX_LEVEL)
+
+            good_leaf_nodes = list()
+            bad_leaf_nodes  = list()
+
+            node = Node(level=PARTITION_LEVEL, pattern_representation=word, group=dataset.rows(),
+                    paa_value=paa_value, words=words)
+            node.start_splitting(P_value, MAX_LEVEL, good_leaf_nodes, bad_leaf_nodes)
+
+            for leaf in bad_leaf_nodes:
+                leftovers.bad_leaves.append((leaf.level, leaf.pattern_representation,
+                        leftovers.add(dataset, leaf.group)))
+
+            if sum(leaf.size for leaf in good_leaf_nodes) < K_value:
+                for leaf in good_leaf_nodes:
+                    leftovers.P_subgroups.append((leaf.pattern_representation, leftovers.add(dataset, leaf.group)))
+
+                continue
+
+            PR = np.full(len(dataset), '', dtype='U{}'.format(paa_value))
+
+            for leaf in good_leaf_nodes:
+                PR[leaf.group] = leaf.pattern_representation
+
+            K_groups = list()
+            k_anonymity_bottom_up(dataset.QI, [ leaf.group for leaf in good_leaf_nodes ], P_value, K_value, K_groups)
+
+            r_plus, r_minus, sizes = envelope_matrices(dataset.QI, K_groups)
+
+            np.savez(Path(tmp_dir) / '{}.groups.npz'.format(word), k_rows=np.concatenate(K_groups),
+                    k_offsets=np.cumsum([ len(K_group) for K_group in K_groups[:-1] ], dtype=np.int64),
+                    PR=PR, r_plus=r_plus, r_minus=r_minus, sizes=sizes)
+
+            grown.append(word)
+
+        logger.info('Grew {} partitions, leaving over {} records'.format(len(grown), leftovers.size))
+
+        # 3. Recycle leftover bad leaves, and form leftover k-groups
+        leftover_dataset = leftovers.dataset(partitions.col_names)
+        leftover_PR = dict()
+        leftover_K_groups = list()
+        suppressed_groups = list()
+        attached = dict() # Leftover P-subgroups joining the k-groups of each partition, by group
+
+        if leftover_dataset is not None:
+            words = sax_code_matrix(leftover_dataset.QI, paa_value, MAX_LEVEL)
+
+            good_leaf_nodes = [ Node(level=1, pattern_representation=pr, group=rows, paa_value=paa_value,
+                    words=words) for pr, rows in leftovers.P_subgroups ]
+            bad_leaf_nodes = [ Node(level=level, pattern_representation=pr, label="bad-leaf", group=rows,
+                    paa_value=paa_value, words=words) for level, pr, rows in leftovers.bad_leaves ]
+
+            suppressed_nodes = list()
+
+            if len(bad_leaf_nodes) > 0:
+                Node.recycle_bad_leaves(P_value, good_leaf_nodes, bad_leaf_nodes, suppressed_nodes, paa_value)
+
+            suppressed_groups = [ node.group for node in suppressed_nodes ]
+
+            for node in good_leaf_nodes:
+                leftover_PR.update(dict.fromkeys(node.group.tolist(), node.pattern_representation))
+
+            P_subgroups = [ node.group for node in good_leaf_nodes ]
+
+            if sum(len(P_subgroup) for P_subgroup in P_subgroups) >= K_value:
+                k_anonymity_bottom_up(leftover_dataset.QI, P_subgroups, P_value, K_value, leftover_K_groups)
+            elif len(P_subgroups) > 0 and len(grown) == 0:
+                raise ValueError('Too few records left after suppression to form any k-group')
+            elif len(P_subgroups) > 0:
+                # Envelopes of the k-groups of all partitions, loaded once and stacked,
+                # along with the partition and index of each k-group
+                grown_envelopes = list()
+
+                for word in grown:
+                    with np.load(Path(tmp_dir) / '{}.groups.npz'.format(word)) as groups:
+                        grown_envelopes.append((groups['r_plus'], groups['r_minus'], groups['sizes']))
+
+                r_plus, r_minus, sizes = [ np.concatenate(matrices) for matrices in zip(*grown_envelopes) ]
+
+                num_groups = [ len(group_sizes) for _, _, group_sizes in grown_envelopes ]
+                partition_of = np.repeat(np.arange(len(grown)), num_groups)
+                group_idxs = np.concatenate([ np.arange(num) for num in num_groups ])
+
+                # Each one joins the k-group of any partition which minimizes the instant value loss,
+                # whose envelope is updated in place for the next ones
+                for P_subgroup in P_subgroups:
+                    envelope = GroupEnvelope(leftover_dataset.QI[P_subgroup])
+
+                    vls = value_loss(sizes + envelope.size, np.maximum(r_plus, envelope.r_plus),
+                            np.minimum(r_minus, envelope.r_minus))
+                    best = int(np.argmin(vls))
+
+                    np.maximum(r_plus[best], envelope.r_plus, out=r_plus[best])
+                    np.minimum(r_minus[best], envelope.r_minus, out=r_minus[best])
+                    sizes[best] += envelope.size
+
+                    attached.setdefault(grown[partition_of[best]], dict()).setdefault(int(group_idxs[best]),
+                            list()).append(P_subgroup)
+
+                logger.info('{} leftover P-subgroups joined the k-groups of partitions'.format(len(P_subgroups)))
+
+        # 4. Enforce l-diversity, and write the anonymized dataset
+        outpath = generate_output_path(data_path, 'kapra')
+        os.makedirs(outpath.parent, exist_ok=True)
+
+        tot_pattern_loss = 0.
+        envelopes = list()
+        index = 0
+
+        with open(outpath, "w") as file_to_write:
+            file_to_write.write(",".join(partitions.col_names) + ',sax,as,group' + "\n")
+
+            for word in grown:
+                dataset = partitions.load(word)
+
+                with np.load(Path(tmp_dir) / '{}.groups.npz'.format(word)) as groups:
+                    K_groups = np.split(groups['k_rows'], groups['k_offsets'])
+                    PR = groups['PR']
+
+                # Leftover records joining the k-groups of the partition follow its own records
+                joined = attached.get(word, dict())
+
+                if len(joined) > 0:
+                    joined_rows = np.concatenate([ P_subgroup for P_subgroups in joined.values()
+                            for P_subgroup in P_subgroups ])
+
+                    dataset = Dataset(np.concatenate((dataset.ids, leftover_dataset.ids[joined_rows])),
+                            np.concatenate((dataset.QI, leftover_dataset.QI[joined_rows])),
+                            np.concatenate((dataset.A_s, leftover_dataset.A_s[joined_rows])), dataset.col_names)
+
+                    PR = np.concatenate((PR, [ leftover_PR[row] for row in joined_rows.tolist() ]))
+
+                    offset = len(PR) - len(joined_rows)
+
+                    for group_idx, P_subgroups in joined.items():
+                        size = sum(len(P_subgroup) for P_subgroup in P_subgroups)
+
+                        K_groups[group_idx] = np.concatenate((K_groups[group_idx],
+                                np.arange(offset, offset + size, dtype=np.int64)))
+                        offset += size
+
+                PR = dict(enumerate(PR.tolist()))
+
+                enforce_l_diversity(PR, dataset.A_s, K_groups, l_value, rng=rng)
+
+                anonymized_dataset = AnonymizedDataset(dataset, K_groups, PR)
+
+                for K_group in K_groups:
+                    anonymized_dataset.write_group(file_to_write, index, K_group)
+                    index += 1
+
+                envelopes += anonymized_dataset.envelopes
+
+                rows = np.concatenate(K_groups)
+                tot_pattern_loss += pattern_losses(dataset.QI[rows], [ PR[row] for row in rows.tolist() ],
+                        paa_value).sum()
+
+            if leftover_dataset is not None:
+                enforce_l_diversity(leftover_PR, leftover_dataset.A_s, leftover_K_groups, l_value, rng=rng)
+
+                anonymized_dataset = AnonymizedDataset(leftover_dataset, leftover_K_groups, leftover_PR)
+
+                for K_group in leftover_K_groups:
+                    anonymized_dataset.write_group(file_to_write, index, K_group)
+                    index += 1
+
+                for group in suppressed_groups:
+                    anonymized_dataset.write_suppressed(file_to_write, group)
+
+                envelopes += anonymized_dataset.envelopes
+
+                # Suppressed records have no pattern
+                rows = np.concatenate(leftover_K_groups + suppressed_groups) \
+                        if len(leftover_K_groups) + len(suppressed_groups) > 0 else np.zeros(0, dtype=np.int64)
+                tot_pattern_loss += pattern_losses(leftover_dataset.QI[rows],
+                        [ leftover_PR.get(row, '') for row in rows.tolist() ], paa_value).sum()
+
+    logger.info('Saved anonymized dataset at: ' + str(outpath))
+
+    return outpath, (tot_pattern_loss, tot_pattern_loss/num_records), global_value_loss(envelopes, num_records)
@@ -0,0 +1,85 @@
+"""
+Process pool helpers, which share large read-only matrices (e.g., the QI matrix) with worker processes through
+shared memory, instead of pickling them along with each task
+"""
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+WORKER_ARRAYS = dict() # Shared matrices attached by the current worker process, by name
+WORKER_CONSTANTS = dict() # Small read-only values shared with the current worker process, by name
+
+class SharedArrays:
+    """
+    Copy a set of matrices into shared memory once, so that worker processes can attach to them without copying.
+    Meant to be used as a context manager, which releases the shared memory on exit.
+
+    Parameters
+    ----------
+    :param arrays: dict of np.ndarray
+        Matrices to share, by name. None values are shared as None.
+    """
+
+    def __init__(self, arrays):
+        self.handles = dict()
+        self.blocks = list()
+
+        for name, array in arrays.items():
+            if array is None:
+                self.handles[name] = None
+                continue
+
+            array = np.ascontiguousarray(array)
+
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+
+            self.blocks.append(block)
+            self.handles[name] = (block.name, array.shape, array.dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+    def pool(self, max_workers, constants=dict()):
+        """
+        Create a process pool whose workers attach to the shared matrices, see `worker_array()`,
+        and to the given small `constants`, see `worker_constant()`
+        """
+
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                initargs=(self.handles, constants))
+
+def init_worker(handles, constants):
+    """
+    Attach the current worker process to the shared matrices
+    """
+
+    for name, handle in handles.items():
+        if handle is None:
+            WORKER_ARRAYS[name] = None
+            continue
+
+        block_name, shape, dtype = handle
+        block = shared_memory.SharedMemory(name=block_name)
+
+        array = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+        array.setflags(write=False)
+
+        # Keep the block referenced as long as the view
+        WORKER_ARRAYS[name] = array
+        WORKER_ARRAYS[name + '/block'] = block
+
+    WORKER_CONSTANTS.update(constants)
+
+def worker_array(name):
+    return WORKER_ARRAYS[name]
+
+def worker_constant(name):
+    return WORKER_CONSTANTS[name]
@@ -6,15 +6,19 @@ Created on Mon Feb 22 18:26:06 2021
 """
 
 import numpy as np
+from functools import lru_cache
 from loguru import logger
 from scipy.spatial.distance import cosine
+from scipy.stats import norm
 
 from .io import load_dataset, generate_output_path
+from .io import is_normalized_release, load_normalized_release
+from .sax_codes import sequential_paa_matrix
 from saxpy.paa import paa
 from saxpy.znorm import znorm 
 from saxpy.alphabet import cuts_for_asize
-from saxpy.strfunc import idx2letter
-from saxpy.sax import ts_to_string, sax_by_chunking
+
+MAX_ALPHABET_SIZE = 20 # Largest alphabet supported by saxpy
 
 def letter2idx(letter):    
     return ord(letter) - 97
@@ -46,67 +50,81 @@ def compute_fv(series, paa_size, znorm_threshold=0.01):
     return fv
 
 
-def empirical_median(paa_idx, seed=23, size=1000000):
+def interval_median_table(max_level=MAX_ALPHABET_SIZE):
+    """
+    Compute the exact median of the standard normal distribution restricted to
+    each interval [beta_lo; beta_up) denoted by a breakpoint index, for every
+    alphabet size (level) up to `max_level`. For a Gaussian, the median of an
+    interval is the inverse CDF at the midpoint of the CDF over the interval.
+
+    Parameters
+    ----------
+    max_level : int, optional
+        Maximum alphabet size. The default is the maximum supported by saxpy.
+
+    Returns
+    -------
+    medians : np.ndarray
+        (max_level + 1, max_level) lookup table, where medians[level, idx]
+        is the median of the idx-th interval at the given level. Entries
+        with idx >= level, or for levels 0 and 1, are 0.
+
     """
-    Get the empirical median for each interval denoted by a breakpoint
+    
+    medians = np.zeros((max_level + 1, max_level))
+    
+    for level in range(2, max_level + 1):
+        
+        # due to how breakpoints are stored: [beta_0, ... , beta_{l-1}],
+        # with beta_0 = -inf, and beta_l = +inf
+        breakpoints = np.append(cuts_for_asize(level), np.inf)
+        cdf = norm.cdf(breakpoints)
+        
+        medians[level, :level] = norm.ppf((cdf[:-1] + cdf[1:]) / 2)
+    
+    medians.setflags(write=False)
+    
+    return medians
+
+
+MEDIANS = interval_median_table() # Shared (level, letter) lookup table
+
+
+def interval_median(paa_idx):
+    """
+    Get the median for each interval denoted by a breakpoint
     index
 
     Parameters
     ----------
     paa_idx : np.ndarray
         Array of (reconstructed) breakpoint indexes
-    seed : int, optional
-        Seed for gaussian random generation. The default is 23.
-    size : int, optional
-        Number of samples used to approximate the probabilistic medians
-        of the intervals. The default is 1000000.
 
     Returns
     -------
     paa_reco : np.ndarray
-        Array of empirical medians
+        Array of interval medians
 
     """
     
-    # Init
-    paa_reco = np.zeros(paa_idx.shape)
-    
     # Estimate number of levels based on the given string
     level = np.max(paa_idx) + 1
     
     # if the string is composed by only a, skip the reconstruction and
     # simply return the zero vector
     if level > 1:
-        
-        # Get corresponding breakpoints
-        breakpoints = cuts_for_asize(level)
-        
-        # Empirical probabilistic median
-        np.random.seed(seed)
-        pts = np.random.normal(size=size)
-        
-        
-        # Get interval endpoints [beta_lo; beta_up)
-        for i in range(len(paa_idx)):
-            
-            # due to how breakpoints are stored: [beta_0, ... , beta_{l-1}]
-            start_idx = paa_idx[i]
-            beta_lo = breakpoints[start_idx]
-            if start_idx < level-1:
-                beta_up = breakpoints[paa_idx[i]+1]
-            else:
-                beta_up = np.inf
-            
-            paa_reco[i] = np.median(pts[(pts >= beta_lo) & (pts < beta_up)])
+        paa_reco = MEDIANS[level, paa_idx]
+    else:
+        paa_reco = np.zeros(paa_idx.shape)
     
     return paa_reco
 
 
-
-
+@lru_cache(maxsize=None)
 def reconstruct_fv(pr):
     """
-    Reconstruct the feature vector (PAA) given a pattern representation (SAX)
+    Reconstruct the feature vector (PAA) given a pattern representation (SAX).
+    Results are memoized per pattern, as whole P-groups share the same one.
 
     Parameters
     ----------
@@ -116,7 +134,7 @@ def reconstruct_fv(pr):
     Returns
     -------
     paa_reco : np.ndarray
-        Reconstructed feature vector (PAA)
+        Reconstructed feature vector (PAA), read-only
 
     """
     
@@ -124,7 +142,8 @@ def reconstruct_fv(pr):
     paa_idx = np.array([letter2idx(x) for x in pr])
     
     # Reconstruct
-    paa_reco = empirical_median(paa_idx)
+    paa_reco = interval_median(paa_idx)
+    paa_reco.setflags(write=False)
     
     return paa_reco
 
@@ -164,6 +183,46 @@ def cosine_distance(u, v):
     return cd
 
 
+def cosine_distances(U, V):
+    """
+    Batched version of `cosine_distance()`, with the same zero-vector
+    conventions, computed row by row in a single vectorized call
+
+    Parameters
+    ----------
+    U : np.ndarray
+        array 2D, (n x paa)
+    V : np.ndarray
+        array 2D, (n x paa)
+
+    Returns
+    -------
+    cd : np.ndarray
+        1 - cos(theta) for each pair of rows
+
+    """
+    
+    U = np.asarray(U, dtype=float)
+    V = np.asarray(V, dtype=float)
+    
+    u_sum = np.sum(U, axis=1)
+    v_sum = np.sum(V, axis=1)
+    
+    # If one of the two vectors is 0 but the other one is not return 1
+    cd = np.ones(len(U))
+    
+    # If both vectors are zero vectors the distance is 0 
+    cd[(u_sum == 0) & (v_sum == 0)] = 0.
+    
+    # If both vectors are different from zero compute cosine distance
+    both = (u_sum > 0) & (v_sum > 0)
+    
+    cd[both] = 1. - np.einsum('ij,ij->i', U[both], V[both]) \
+            / (np.linalg.norm(U[both], axis=1) * np.linalg.norm(V[both], axis=1))
+    
+    return cd
+
+
 def pattern_loss(series, pr, paa_size, znorm_threshold=0.01):
     """
     Pattern loss 
@@ -197,7 +256,39 @@ def pattern_loss(series, pr, paa_size, znorm_threshold=0.01):
     return pl, p, p_star
 
 
-def global_pattern_loss(data_path, algorithm):
+def reconstruct_fv_matrix(prs, paa_size):
+    """
+    Reconstruct the feature vectors (PAA) of many pattern representations
+    at once, decoding each distinct pattern a single time
+
+    Parameters
+    ----------
+    prs : list of str
+        pattern representations (SAX). Empty or malformed ones, e.g., the
+        " - " placeholders of suppressed records, reconstruct to the zero
+        vector
+    paa_size : int
+        size of the word w
+
+    Returns
+    -------
+    P_star : np.ndarray
+        (n x paa_size) matrix of reconstructed feature vectors
+
+    """
+    
+    words, inverse = np.unique(np.asarray(prs, dtype=str), return_inverse=True)
+    
+    table = np.zeros((len(words), paa_size))
+    
+    for idx, pr in enumerate(words):
+        if len(pr) == paa_size and pr.isalpha() and pr.islower():
+            table[idx] = reconstruct_fv(pr)
+    
+    return table[inverse.ravel()]
+
+
+def global_pattern_loss(data_path, algorithm, dataset=None, PR=None, paa_size=None):
     """
     Compute global pattern loss on a given dataset and its anonymized version
 
@@ -205,61 +296,75 @@ def global_pattern_loss(data_path, algorithm):
     ----------
     data_path : string
         path of the original dataset
-    avg : boolean, optional
-        Set true if you want an average loss instead of a simple sum.
-        The default is False.
+    algorithm : string
+        "naive" or "kapra", used to infer the path of the anonymized dataset
+    dataset : Dataset, optional
+        Original dataset already in memory. Loaded from `data_path` if None.
+    PR : dict, optional
+        Per-record pattern representations (SAX) keyed by row, as produced
+        by the anonymization. Read from the anonymized dataset on disk, flat
+        or normalized, if None. Records without a pattern (suppressed) reconstruct to the zero
+        vector, as their " - " placeholders on disk do.
+    paa_size : int, optional
+        size of the word w of the run. Inferred from the longest pattern
+        representation if None, or 1 if every record is suppressed, as all
+        reconstructions are then the zero vector.
 
     Returns
     -------
     global_ploss : float
         Global pattern loss
+    global_ploss_avg : float
+        Average pattern loss per time series
 
     """
     
     # Load original time QI attributes
-    _, _, QI_ts, _, _ = load_dataset(data_path)
-    
-    # Infer path of the anonymized dataset
-    anonym_path = generate_output_path(data_path, algorithm)
-    if not anonym_path.is_file():
-        logger.error(str(anonym_path.absolute())
-                + ' not found')
-        exit(1)
-      
-    # Load QI attributes of the anonymized dataset
-    _, _, QI_ts_anonym, _, _ = load_dataset(anonym_path, anonym=True)
+    if dataset is None:
+        dataset = load_dataset(data_path)
     
-    
-    # Compute pattern loss for each time series
-    num_series = len(QI_ts)
-    plosses = np.zeros((num_series,))
-    
-    for idx, k in enumerate(QI_ts.keys()):
-        
-        if k in QI_ts_anonym.keys():
-            
-            series = QI_ts[k]
-            pr = QI_ts_anonym[k][-2] # sax
-            paa_size = len(pr)
-            
-            pl, _, _  = pattern_loss(series,pr,paa_size)
-            
-            plosses[idx] = pl
+    if PR is None:
+        # Infer path of the anonymized dataset
+        anonym_path = generate_output_path(data_path, algorithm)
+        if is_normalized_release(anonym_path):
+            _, records = load_normalized_release(anonym_path)
             
+            # Look up the pattern of each original record by Id
+            prs = records.set_index(records.columns[0])['sax'] \
+                    .reindex(dataset.ids).fillna('').tolist()
+        elif not anonym_path.is_file():
+            logger.error(str(anonym_path.absolute())
+                    + ' not found')
+            raise FileNotFoundError(str(anonym_path.absolute()) + ' not found')
+          
         else:
-            logger.info('Key {} missing'.format(k))
+            # Load QI attributes of the anonymized dataset
+            anonymized = load_dataset(anonym_path, anonym=True)
             
-    global_ploss = np.sum(plosses)
-    
-    global_ploss_avg = global_ploss / num_series
-    
-    return global_ploss, global_ploss_avg
-    
-
+            prs = list()
+            
+            for k in dataset.ids.tolist():
+                if k in anonymized.id_to_row:
+                    prs.append(anonymized.QI[anonymized.id_to_row[k], -2]) # sax
+                else:
+                    logger.info('Key {} missing'.format(k))
+                    prs.append('')
+    else:
+        prs = [ PR.get(row, '') for row in range(len(dataset)) ]
     
+    # Compute pattern loss for all time series at once
+    if paa_size is None:
+        paa_size = max((len(pr) for pr in prs if isinstance(pr, str) and pr.isalpha()), default=1)
     
+    P = sequential_paa_matrix(dataset.QI, paa_size)
+    P_star = reconstruct_fv_matrix(prs, paa_size)
     
+    plosses = cosine_distances(P, P_star)
     
+    num_series = len(dataset)
+            
+    global_ploss = np.sum(plosses)
     
+    global_ploss_avg = global_ploss / num_series
     
-    
\ No newline at end of file
+    return global_ploss, global_ploss_avg
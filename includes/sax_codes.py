@@ -0,0 +1,179 @@
+"""
+Vectorized SAX encoding of a whole QI matrix at every alphabet size (level) at once, from Lin et al. 2003,
+A symbolic representation of time series, with implications for streaming algorithms
+"""
+
+import math
+import numpy as np
+
+from saxpy.alphabet import cuts_for_asize
+
+FV_DECIMALS = 10 # Precision of the PAA feature vectors before quantization
+
+def znorm_rows(QI, znorm_threshold=0.01):
+    """
+    Z-normalize each row of `QI`. Rows whose standard deviation is below `znorm_threshold` are only centered,
+    as in `saxpy.znorm.znorm`.
+    """
+
+    QI = np.asarray(QI, dtype=float)
+
+    mu  = QI.mean(axis=1, keepdims=True)
+    centered = QI - mu
+    var = np.mean(centered**2, axis=1, keepdims=True)
+
+    std = np.sqrt(var)
+    std[var < znorm_threshold**2] = 1. # Leave flat rows centered only
+
+    return centered / std
+
+def paa_weights(n, paa_size):
+    """
+    Weight matrix W, shaped (n, paa_size), such that `series @ W` is the PAA representation of a length-`n` series.
+    Segment boundaries may fall within a point, which then contributes to both segments proportionally,
+    as in `saxpy.paa.paa`.
+    """
+
+    points_per_segment = n / paa_size
+
+    seg_start = np.arange(paa_size) * points_per_segment
+    seg_end   = seg_start + points_per_segment
+    seg_end[-1] = n
+
+    point_start = np.arange(n)[:, None]
+
+    # Overlap of point [j, j + 1) with segment [start_i, end_i)
+    overlap = np.minimum(point_start + 1, seg_end) - np.maximum(point_start, seg_start)
+
+    return np.clip(overlap, 0, None) / points_per_segment
+
+def paa_matrix(QI, paa_value, znorm_threshold=0.01):
+    """
+    Compute the PAA feature vector of every z-normalized record in `QI` at once, shaped (# of records, `paa_value`)
+    """
+
+    QI = np.asarray(QI)
+
+    return znorm_rows(QI, znorm_threshold) @ paa_weights(QI.shape[1], paa_value)
+
+def sequential_paa_matrix(QI, paa_value, znorm_threshold=0.01):
+    """
+    Same as `paa_matrix`, but bit for bit equal to `pattern_loss.compute_fv` on each record: sums are accumulated
+    left to right, one column at a time for all records at once, as `saxpy.znorm.znorm` and `saxpy.paa.paa` do.
+    Pattern loss needs it, as the sign of a near-zero segment mean decides its zero-vector convention.
+    """
+
+    QI = np.asarray(QI, dtype=float)
+    n = QI.shape[1]
+
+    # 1. Z-normalization
+    total = np.zeros(len(QI))
+    for j in range(n):
+        total += QI[:, j]
+    mu = total / n
+
+    sq_sum = np.zeros(len(QI))
+    for j in range(n):
+        d = QI[:, j] - mu
+        sq_sum += d * d
+    var = sq_sum / n
+
+    series = QI - mu[:, None]
+    scaled = var >= znorm_threshold**2 # Leave flat rows centered only
+
+    # One scalar per record: Python's float power rounds differently from both np.sqrt and np.power
+    inv_std = np.array([ 1. / (v**0.5) for v in var[scaled].tolist() ])
+    series[scaled] *= inv_std[:, None]
+
+    # 2. PAA
+    if n == paa_value:
+        return series
+
+    points_per_segment = n / paa_value
+    breaks = [ i * points_per_segment for i in range(paa_value + 1) ]
+    breaks[paa_value] = float(n)
+
+    fv = np.empty((len(QI), paa_value))
+
+    for i in range(paa_value):
+        frac_begin = math.ceil(breaks[i]) - breaks[i]
+        frac_end   = breaks[i + 1] - math.floor(breaks[i + 1])
+
+        full_begin = int(math.floor(breaks[i]))
+        full_end   = min(int(math.ceil(breaks[i + 1])), n)
+
+        segment_sum = np.zeros(len(QI))
+        for j in range(full_begin, full_end):
+            v = series[:, j]
+            if j == full_begin and frac_begin > 0:
+                v = v * frac_begin
+            if j == full_end - 1 and frac_end > 0:
+                v = v * frac_end
+            segment_sum += v
+
+        fv[:, i] = segment_sum / points_per_segment
+
+    return fv
+
+def sax_code_matrix(QI, paa_value, max_level, znorm_threshold=0.01):
+    """
+    Compute the SAX pattern representation of every record in `QI` at every level from 1 to `max_level`.
+    Z-normalization and PAA are performed once, in a single pass over the matrix; then the PAA representation
+    is quantized against the breakpoints of each level.
+
+    Parameters
+    ----------
+    :param QI: np.ndarray
+        2-D matrix of time-series records on QI attributes
+
+    :param paa_value: int
+        Number of PAA segments, i.e., length of each SAX word
+
+    :param max_level: int
+        Maximum alphabet size
+
+    Returns
+    -------
+    :return words: np.ndarray of str
+        Matrix shaped (`max_level` + 1, # of records), where `words[level, row]` is the SAX word of `row`
+        at alphabet size `level`. Level 0 is unused, and level 1 is the all-'a' word.
+    """
+
+    fv = paa_matrix(QI, paa_value, znorm_threshold) # PAA feature vectors
+
+    return sax_words(fv, paa_value, max_level)
+
+def sax_words(fv, paa_value, max_level):
+    """
+    Quantize the PAA feature vectors of z-normalized records, shaped (# of records, `paa_value`), into their SAX
+    pattern representations at every level from 1 to `max_level`, see `sax_code_matrix()`
+    """
+
+    num_records = len(fv)
+
+    # Wipe out round-off noise, so that segments whose exact mean sits on a
+    # breakpoint (typically 0) are consistently assigned the symbol above it
+    fv = np.round(fv, FV_DECIMALS)
+
+    codes = np.zeros((max_level + 1, num_records, paa_value), dtype=np.uint8)
+
+    for level in range(2, max_level + 1):
+        cuts = cuts_for_asize(level)
+
+        # Largest breakpoint index i such that cuts[i] <= value
+        codes[level] = np.searchsorted(cuts, fv, side='right') - 1
+
+    # Map breakpoint indexes to letters, and
+    # view each record's letters as a single word
+    letters = np.ascontiguousarray(codes + ord('a'))
+    words = letters.view('S{}'.format(paa_value))[..., 0].astype('U{}'.format(paa_value))
+
+    return words
+
+def pattern_level(pr):
+    """
+    Level a pattern representation is read at, i.e., the alphabet size of its greatest letter, as in
+    `interval_median()`, or 0 if empty
+    """
+
+    return ord(max(pr)) - ord('a') + 1 if len(pr) > 0 else 0
@@ -0,0 +1,432 @@
+"""
+Sliding-window KAPRA, for time series tables which gain a new column at each time step, e.g., weekly sales. Rather than
+anonymizing each window from scratch, the window is shifted one time step at a time: the PAA representation of each
+record, and the envelope of each k-group, are updated from the column leaving the window and the one entering it; then
+only the P-subgroups whose pattern no longer holds are split again, and only their k-groups formed again.
+"""
+
+import random
+import time
+
+import numpy as np
+import pandas as pd
+
+from loguru import logger
+
+# Custom imports #
+from .anonymize import AnonymizationResult
+from .common import create_tree
+from .common import MAX_LEVEL
+from .dataset import Dataset
+from .group_envelope import envelope_matrices
+from .group_envelope import GroupEnvelope
+from .incremental import join_P_subgroups
+from .incremental import min_value_loss_increase
+from .incremental import P_subgroup_index
+from .io import load_dataset
+from .io import RESULTS_COLUMNS
+from .k_anonymity import k_anonymity_bottom_up
+from .kapra import kapra_create_tree
+from .kapra import kapra_group_formation
+from .l_diversity import enforce_l_diversity
+from .sax_codes import paa_weights
+from .sax_codes import sax_code_matrix
+from .sax_codes import sax_words
+
+def shift_weights(width, paa_value):
+    """
+    Sparse update of the PAA representation of a window of `width` points when shifted by one point, such that
+    `paa + values @ weights` is the PAA representation of the shifted window, where `values` are the points at
+    `positions` in the window extended with the new point, i.e., at position `width`. Only the points at the
+    boundaries of a segment change its weights, hence the update costs O(`paa_value`) per record.
+
+    Returns
+    -------
+    :return positions: np.ndarray of int
+        Positions of the points whose weights change, in the window extended with the new point
+
+    :return weights: np.ndarray
+        Change of their weights in each segment, shaped (# of positions, `paa_value`)
+    """
+
+    weights = paa_weights(width, paa_value)
+    zeros = np.zeros((1, paa_value))
+
+    # Point at position j of the shifted window is at position j + 1 of the old one
+    delta = np.vstack((zeros, weights)) - np.vstack((weights, zeros))
+    positions = np.flatnonzero(np.abs(delta).max(axis=1) > 1e-12)
+
+    return positions, delta[positions]
+
+class SlidingWindow:
+    """
+    State of sliding-window KAPRA over the records of a dataset, see `shift()`: the window of QI attributes, as a ring
+    buffer of columns, the running sums of each record's window and the PAA representation of its raw values, its SAX
+    words, and the k-group, pattern representation and released sensitive value of each record, along with the
+    envelope of each k-group.
+
+    Parameters
+    ----------
+    :param dataset: Dataset
+        Original dataset, whose first `width` QI attributes are the first window
+
+    :param width: int
+        # of time steps in the window
+
+    :param seed: int - None
+        Seed of all random draws, see `anonymize()`
+    """
+
+    def __init__(self, dataset, width, K_value, P_value, paa_value, l_value, seed=None):
+        if K_value < P_value:
+            raise ValueError('<k_value> must be greater or equal than <P_value>')
+
+        if not paa_value <= width <= dataset.QI.shape[1]:
+            raise ValueError('<width> must be between <paa_value> and the # of QI attributes')
+
+        self.K_value, self.P_value, self.paa_value, self.l_value = K_value, P_value, paa_value, l_value
+        self.seed = seed
+        self.rng = None # l-diversity generator
+
+        if seed is not None:
+            random.seed(seed)
+            self.rng = np.random.default_rng(seed)
+
+        QI = np.array(dataset.QI[:, :width])
+
+        self.ids = dataset.ids
+        self.A_s = dataset.A_s.copy() # Original sensitive values, perturbed anew whenever a k-group is formed again
+        self.col_names = dataset.col_names[:width + 1]
+
+        self.ring = QI # Window columns, the oldest at `head`
+        self.head = 0
+        self.width = width
+
+        # Running sums of each record's window, and PAA representation of its raw values
+        self.total = QI.sum(axis=1, dtype=float)
+        self.total_sq = np.square(QI, dtype=float).sum(axis=1)
+        self.paa = QI @ paa_weights(width, paa_value)
+
+        self.positions, self.weights = shift_weights(width, paa_value)
+
+        self.words = sax_code_matrix(QI, paa_value, MAX_LEVEL)
+
+        window = Dataset(self.ids, QI, self.A_s.copy(), self.col_names)
+
+        P_subgroups, suppressed_groups, PR = kapra_create_tree(window, P_value, paa_value)
+        K_groups, self.perturbated = kapra_group_formation(window, P_subgroups, PR, window.A_s, K_value, P_value,
+                l_value, self.rng)
+
+        self.released_A_s = window.A_s
+
+        self.group_of = np.full(len(self.ids), -1, dtype=np.int64)
+
+        for group_idx, K_group in enumerate(K_groups):
+            self.group_of[K_group] = group_idx
+
+        self.patterns = np.array([ PR.get(row, '') for row in range(len(self.ids)) ], dtype='U{}'.format(paa_value))
+
+        self.r_plus, self.r_minus, self.sizes = envelope_matrices(QI, K_groups)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def window(self, rows=None):
+        """
+        QI attributes of the current window, in time order, of the given rows or of all of them
+        """
+
+        columns = (self.head + np.arange(self.width)) % self.width
+
+        if rows is None:
+            return self.ring[:, columns]
+
+        return self.ring[rows][:, columns]
+
+    def fv(self, znorm_threshold=0.01):
+        """
+        PAA feature vectors of the z-normalized windows, straight from the running sums, as each segment's weights
+        add up to 1, see `paa_matrix()`
+        """
+
+        mu = self.total / self.width
+        var = np.maximum(self.total_sq / self.width - mu**2, 0.)
+
+        std = np.sqrt(var)
+        std[var < znorm_threshold**2] = 1. # Leave flat rows centered only
+
+        return (self.paa - mu[:, None]) / std[:, None]
+
+    def shift(self, column, col_name):
+        """
+        Shift the window by one time step, and update the anonymization accordingly
+
+        1. The running sums, PAA representations and SAX words of all records are updated from the column leaving
+           the window and the one entering it, see `shift_weights()`, and so are the envelopes of all k-groups.
+        2. P-subgroups, i.e., the records of a k-group sharing a pattern representation, whose records no longer share
+           it at any level, are split again, along with suppressed records, see `create_tree()`. The k-groups holding
+           them are dissolved into their other P-subgroups, which are formed into k-groups again along with the new
+           ones, see `k_anonymity_bottom_up()`, or, if too few, join the k-groups left which minimize the instant
+           value loss.
+        3. l-diversity is enforced again on k-groups formed again, from the original sensitive values.
+
+        Parameters
+        ----------
+        :param column: np.ndarray
+            Values of the new time step, indexed by record row
+
+        :param col_name: str
+            Name of the new QI attribute
+        """
+
+        column = np.asarray(column)
+
+        # Integer windows may turn into float ones
+        dtype = np.result_type(self.ring.dtype, column.dtype)
+        self.ring = self.ring.astype(dtype, copy=False)
+        self.r_plus = self.r_plus.astype(dtype, copy=False)
+        self.r_minus = self.r_minus.astype(dtype, copy=False)
+
+        # 1. Update running sums, PAA representations and SAX words
+        values = np.column_stack([ column if position == self.width else self.ring[:, (self.head + position) % self.width]
+                for position in self.positions.tolist() ])
+
+        self.paa += values @ self.weights
+
+        leaving = self.ring[:, self.head].astype(float)
+
+        self.total += column - leaving
+        self.total_sq += np.square(column, dtype=float) - leaving**2
+
+        self.ring[:, self.head] = column
+        self.head = (self.head + 1) % self.width
+
+        self.col_names = self.col_names[:1] + self.col_names[2:] + [ col_name ]
+
+        self.words = sax_words(self.fv(), self.paa_value, MAX_LEVEL)
+
+        # Envelopes drop the attribute leaving the window, and gain the new one
+        grouped = np.flatnonzero(self.group_of >= 0)
+
+        new_r_plus = np.full(len(self.sizes), np.iinfo(dtype).min if dtype.kind in 'iu' else -np.inf, dtype=dtype)
+        new_r_minus = np.full(len(self.sizes), np.iinfo(dtype).max if dtype.kind in 'iu' else np.inf, dtype=dtype)
+
+        np.maximum.at(new_r_plus, self.group_of[grouped], column[grouped])
+        np.minimum.at(new_r_minus, self.group_of[grouped], column[grouped])
+
+        self.r_plus = np.column_stack((self.r_plus[:, 1:], new_r_plus))
+        self.r_minus = np.column_stack((self.r_minus[:, 1:], new_r_minus))
+
+        self.regroup()
+
+    def group_rows(self, group_idxs):
+        """
+        Rows of each of the given k-groups, in increasing order of k-group
+        """
+
+        group_idxs = np.unique(group_idxs)
+
+        rows = np.flatnonzero(np.isin(self.group_of, group_idxs))
+        rows = rows[np.argsort(self.group_of[rows], kind='stable')]
+
+        return np.split(rows, np.cumsum(self.sizes[group_idxs])[:-1]) if len(group_idxs) > 0 else list()
+
+    def regroup(self):
+        """
+        Move the records whose pattern representation no longer holds, and form their k-groups again, see `shift()`
+        """
+
+        grouped = np.flatnonzero(self.group_of >= 0)
+
+        # Records still matching their pattern at some level, as the tree may label a P-subgroup with a word lacking
+        # the greatest letter of its level. The level-1 pattern, which every record matches, is only held by records
+        # which could not be split any further, hence they are moved at every step
+        holds = np.zeros(len(grouped), dtype=bool)
+
+        for level in range(2, MAX_LEVEL + 1):
+            holds |= self.words[level, grouped] == self.patterns[grouped]
+
+        # P-subgroups left with fewer than P records are moved whole
+        _, pattern_of = np.unique(self.patterns[grouped], return_inverse=True)
+        _, bucket_of = np.unique(self.group_of[grouped]*(pattern_of.max(initial=0) + 1) + pattern_of,
+                return_inverse=True)
+
+        holds &= np.bincount(bucket_of, weights=holds)[bucket_of] >= self.P_value
+
+        left = np.unique(self.group_of[grouped[~holds]]) # k-groups which lost records
+        moved = np.concatenate((grouped[~holds], np.flatnonzero(self.group_of < 0)))
+
+        if len(moved) == 0:
+            return
+
+        self.group_of[moved] = -1
+        self.patterns[moved] = ''
+        self.sizes = np.bincount(self.group_of[self.group_of >= 0], minlength=len(self.sizes))
+
+        # Envelopes of the k-groups which lost records shrink
+        left = left[self.sizes[left] > 0]
+
+        for group_idx, rows in zip(left.tolist(), self.group_rows(left)):
+            envelope = GroupEnvelope(self.window(rows))
+            self.r_plus[group_idx], self.r_minus[group_idx] = envelope.r_plus, envelope.r_minus
+
+        # Join P-subgroups left by their pattern, other than the level-1 one, see `join_P_subgroups()`
+        group_of, patterns = join_P_subgroups(self.words[:, moved], self.window(moved), np.arange(len(moved)),
+                P_subgroup_index(self.group_of, self.patterns), self.r_plus, self.r_minus, self.sizes, min_level=2)
+
+        self.group_of[moved] = group_of
+        self.patterns[moved] = patterns
+
+        touched = np.zeros(len(self.sizes), dtype=bool) # k-groups whose records changed
+        touched[left] = True
+        touched[group_of[group_of >= 0]] = True
+
+        # k-groups left with fewer than k records, or grown to 2k records or more, are dissolved into their
+        # P-subgroups, which are formed into k-groups again, as by the bottom-up group formation
+        # k-groups which lost all of their records are only dropped
+        dissolved = np.flatnonzero((self.sizes > 0) & ((self.sizes < self.K_value) | (self.sizes >= 2*self.K_value)))
+        P_subgroups = list()
+
+        for rows in self.group_rows(dissolved):
+            _, pattern_of = np.unique(self.patterns[rows], return_inverse=True)
+            P_subgroups += np.split(rows[np.argsort(pattern_of, kind='stable')],
+                    np.cumsum(np.bincount(pattern_of))[:-1])
+
+        keep = self.sizes > 0
+        keep[dissolved] = False
+
+        remap = np.full(len(self.sizes) + 1, -1, dtype=np.int64)
+        remap[np.flatnonzero(keep)] = np.arange(keep.sum())
+
+        self.group_of = remap[self.group_of] # -1 maps to the last entry, i.e., still -1
+        self.r_plus, self.r_minus, self.sizes = self.r_plus[keep], self.r_minus[keep], self.sizes[keep]
+
+        touched = set(remap[np.flatnonzero(touched & keep)].tolist())
+
+        # Split the rest again
+        unmatched = moved[group_of < 0]
+
+        if len(unmatched) > 0:
+            PR = dict()
+            new_P_subgroups, suppressed_groups = create_tree('kapra', self.words, unmatched, PR, self.P_value,
+                    self.paa_value)
+
+            for row, pr in PR.items():
+                self.patterns[row] = pr
+
+            P_subgroups += new_P_subgroups
+
+        logger.info('Moved {} records, {} of which joined P-subgroups, and dissolved {} k-groups'.format(len(moved),
+                int((group_of >= 0).sum()), len(dissolved)))
+
+        num_groups = len(self.sizes)
+        pool = np.concatenate(P_subgroups) if len(P_subgroups) > 0 else np.zeros(0, dtype=np.int64)
+
+        if len(pool) >= self.K_value:
+            local_QI = self.window(pool)
+
+            local_offsets = np.cumsum([ len(P_subgroup) for P_subgroup in P_subgroups ])[:-1]
+            local_P_subgroups = np.split(np.arange(len(pool)), local_offsets)
+
+            local_K_groups = list()
+            k_anonymity_bottom_up(local_QI, local_P_subgroups, self.P_value, self.K_value, local_K_groups)
+
+            r_plus, r_minus, sizes = envelope_matrices(local_QI, local_K_groups)
+
+            self.r_plus = np.concatenate((self.r_plus, r_plus))
+            self.r_minus = np.concatenate((self.r_minus, r_minus))
+            self.sizes = np.concatenate((self.sizes, sizes))
+
+            for group_idx, local_K_group in enumerate(local_K_groups, start=num_groups):
+                self.group_of[pool[local_K_group]] = group_idx
+                touched.add(group_idx)
+        elif len(P_subgroups) > 0:
+            if num_groups == 0:
+                raise ValueError('Too few records left after suppression to form any k-group')
+
+            # Each one joins the k-group which minimizes the instant value loss
+            for P_subgroup in P_subgroups:
+                group_idx, r_plus, r_minus = min_value_loss_increase(self.r_plus, self.r_minus, self.sizes,
+                        self.window(P_subgroup))
+
+                self.r_plus[group_idx], self.r_minus[group_idx] = r_plus, r_minus
+                self.sizes[group_idx] += len(P_subgroup)
+
+                self.group_of[P_subgroup] = group_idx
+                touched.add(group_idx)
+
+        # 3. Enforce l-diversity on the k-groups whose records changed only
+        local_K_groups = self.group_rows(sorted(touched))
+        rows = np.concatenate(local_K_groups) if len(local_K_groups) > 0 else np.zeros(0, dtype=np.int64)
+
+        self.released_A_s[rows] = self.A_s[rows]
+
+        for row in rows.tolist():
+            self.perturbated.pop(row, None)
+
+        local_K_groups = np.split(np.arange(len(rows)), np.cumsum([ len(K_group) for K_group in local_K_groups ])[:-1])
+
+        A_s = self.released_A_s[rows]
+
+        perturbated = enforce_l_diversity(dict(enumerate(self.patterns[rows].tolist())), A_s, local_K_groups,
+                self.l_value, rng=self.rng)
+
+        self.released_A_s[rows] = A_s
+        self.perturbated.update({ int(rows[row]): rnd for row, rnd in perturbated.items() })
+
+    def result(self, timings=None):
+        """
+        Anonymization of the current window, see `AnonymizationResult`
+        """
+
+        grouped = np.flatnonzero(self.group_of >= 0)
+        grouped = grouped[np.argsort(self.group_of[grouped], kind='stable')]
+
+        K_groups = np.split(grouped, np.cumsum(self.sizes)[:-1]) if len(self.sizes) > 0 else list()
+
+        suppressed = np.flatnonzero(self.group_of < 0)
+
+        patterns = dict(zip(grouped.tolist(), self.patterns[grouped].tolist()))
+
+        dataset = Dataset(self.ids, self.window(), self.released_A_s.copy(), self.col_names)
+
+        result = AnonymizationResult('kapra', { 'k': self.K_value, 'P': self.P_value, 'paa': self.paa_value,
+                'l': self.l_value, 'seed': self.seed, 'width': self.width }, dataset, K_groups, patterns,
+                [ suppressed ] if len(suppressed) > 0 else list(), dict(self.perturbated), timings or dict())
+
+        # Kept up to date along with the window
+        result.envelopes = [ GroupEnvelope.from_bounds(r_plus, r_minus, size)
+                for r_plus, r_minus, size in zip(self.r_plus, self.r_minus, self.sizes.tolist()) ]
+
+        return result
+
+def sliding_window_anonymize(data_path, width, K_value, P_value, paa_value, l_value, seed=None):
+    """
+    Run sliding-window KAPRA over all windows of `width` time steps of a dataset, from its first QI attributes
+    onwards, one time step at a time, see `SlidingWindow`
+
+    Returns
+    -------
+    :return results_df: pd.DataFrame
+        Results of each window, with its first and last QI attributes, followed by the same metrics as
+        `k_P_anonymity.py`. The ETA of each window is the time to shift to it, and the first one to anonymize it.
+    """
+
+    dataset = load_dataset(data_path)
+
+    start = time.time()
+
+    window = SlidingWindow(dataset, width, K_value, P_value, paa_value, l_value, seed)
+
+    results = list()
+
+    for col in range(width, dataset.QI.shape[1] + 1):
+        if col > width:
+            start = time.time()
+            window.shift(dataset.QI[:, col - 1], dataset.col_names[col])
+
+        result = window.result({ 'anonymize': time.time() - start })
+
+        results.append([ window.col_names[1], window.col_names[-1] ] + result.results())
+
+    return pd.DataFrame(results, columns=[ 'first', 'last' ] + RESULTS_COLUMNS)
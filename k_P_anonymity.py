@@ -4,102 +4,83 @@ Supporting Pattern-preserving Anonymization for Time-series Data
 """
 
 import sys
-import time
 import os
 
-import pandas as pd
-
 from loguru import logger
 from pathlib import Path
 
 # Custom imports #
-from includes.naive import Naive
-from includes.kapra import KAPRA
+from includes.cache import CACHE_DIR
+from includes.cache import ResultCache
 
 from includes.io import usage
-
-from includes.metric import global_anon_value_loss
-
-from includes.pattern_loss import global_pattern_loss
-from includes.pattern_loss import generate_output_path
+from includes.io import save_results
 
 RES_DIR = 'results'
 
 if __name__ == "__main__":
-    if not len(sys.argv) == 7:
+    if not len(sys.argv) in [ 7, 8 ]:
         usage()
 
     # 1. Parse arguments
     algorithm = sys.argv[1].lower()
 
-    k_value = int(sys.argv[2])
+    # Comma-separated k and l values are swept over
+    k_values = list(map(int, sys.argv[2].split(',')))
     P_value = int(sys.argv[3])
     paa_value = int(sys.argv[4])
-    l_value = int(sys.argv[5])
+    l_values = list(map(int, sys.argv[5].split(',')))
 
     data_path = sys.argv[6]
 
-    if k_value < P_value:
-        logger.error('<k_value> must be greater or equal than <P_value>')
-        usage()
-    
-    # 2. Execute (k, P) algorithm
-    start = time.time()
-
-    if algorithm == 'naive':
-        Naive(k_value, P_value, paa_value, l_value, data_path)
-    elif algorithm == 'kapra':
-        KAPRA(k_value, P_value, paa_value, l_value, data_path)
-    else:
-        logger.error('Cannot interpret ' + algorithm
-                + ' as a (k, P)-anonymity algorithm: only naive and KAPRA are supported')
-        usage()
+    # Only seeded runs are reproducible, hence cached
+    seed = int(sys.argv[7]) if len(sys.argv) == 8 else None
 
-    end = time.time()
-    eta = round(float(end - start), 3) # Elapsed time
+    k_l_values = [ (k_value, l_value) for k_value in k_values for l_value in l_values ]
 
-    # 3. Create results dir, if non-existent
+    # 2. Create results dir, if non-existent
     abs_root_path = Path(__file__).absolute().parent
     os.makedirs(abs_root_path / RES_DIR, exist_ok=True) 
 
-    # 4. Compute pattern loss (PL)
-    logger.info('Computing pattern loss...')
-
-    global_ploss, global_ploss_avg = global_pattern_loss(data_path, algorithm)
-
-    tot_pattern_loss = round(float(global_ploss), 3)
-    avg_pattern_loss = round(float(global_ploss_avg), 3)
-
-    logger.info('Computed pattern loss of ' + str(avg_pattern_loss))
-
-    # 5. Compute instant value loss (VL)
-    logger.info('Computing instant value loss...')
+    # 3. Execute (k, P) algorithm, unless already cached. KAPRA builds its
+    # P-subgroup forest only once for all (k, l) pairs
+    cache = ResultCache(abs_root_path / RES_DIR / CACHE_DIR)
+
+    try:
+        if algorithm == 'kapra':
+            outcomes = cache.anonymize_kapra_sweep(data_path, k_l_values, P_value, paa_value, seed=seed)
+        else:
+            outcomes = [ cache.anonymize(data_path, algorithm, k_value, P_value, paa_value, l_value, seed=seed)
+                    for k_value, l_value in k_l_values ]
+    except (ValueError, FileNotFoundError) as e:
+        logger.error(str(e))
+        usage()
 
-    anonym_path = generate_output_path(data_path, algorithm)
-    glob_vl, mean_vl = global_anon_value_loss(anonym_path)
+    # The anonymized dataset is only saved for a single (k, l) pair,
+    # as all pairs share the same output path
+    if len(outcomes) == 1:
+        outcomes[0][0].save(data_path)
 
-    tot_value_loss = round(float(glob_vl), 3)
-    avg_value_loss = round(float(mean_vl), 3)
+    for (k_value, l_value), (result, cached) in zip(k_l_values, outcomes):
+        eta = round(float(result.eta), 3) # Elapsed time
 
-    logger.info('Computed instant value loss of ' + str(avg_value_loss))
+        # 4. Compute pattern loss (PL) and instant value loss (VL),
+        # straight from the groups and patterns in memory, or from cache
+        logger.info('Computing pattern loss and instant value loss...')
 
-    # 6. Save results as CSV file
-    results_df = pd.DataFrame(columns = [ 'eta',
-            'tot_pattern_loss', 'avg_pattern_loss',
-            'tot_value_loss', 'avg_value_loss' ]) 
-  
-    results_df.loc[0] = [ eta,
-            tot_pattern_loss, avg_pattern_loss,
-            tot_value_loss, avg_value_loss ]
+        results = result.results()
 
-    abs_data_path = Path(data_path).absolute()
+        _, tot_pattern_loss, avg_pattern_loss, \
+                tot_value_loss, avg_value_loss = results
 
-    outfilename = abs_data_path.parts[-1].replace('.csv', '') \
-            + '_' + algorithm + '_k' + str(k_value)           \
-            + '_P' + str(P_value) + '_paa' + str(paa_value)   \
-            + '_l' + str(l_value) + '.csv'
+        logger.info('Computed pattern loss of ' + str(avg_pattern_loss))
+        logger.info('Computed instant value loss of ' + str(avg_value_loss))
 
-    outfilepath = abs_root_path / RES_DIR / outfilename
-    results_df.to_csv(outfilepath, sep =',', index=False) 
+        # 5. Save results as CSV file
+        save_results(abs_root_path / RES_DIR, data_path, algorithm,
+                k_value, P_value, paa_value, l_value, [ eta,
+                tot_pattern_loss, avg_pattern_loss,
+                tot_value_loss, avg_value_loss ])
 
-    print('\nFinalized (k, P) algorithm - ETA: ' + str(eta) + ' sec')
+        print('\nFinalized (k, P) algorithm with k=' + str(k_value) + ', l=' + str(l_value)
+                + ' - ETA: ' + str(eta) + ' sec')
@@ -0,0 +1,53 @@
+"""
+Regression check of the batched pattern loss against the original per-record one, i.e., `compute_fv()` and
+`cosine_distance()` on every time series. Exits with status 1 if their totals differ.
+
+python utils/check_pattern_loss.py <algorithm> <k> <P> <paa> <l> <dataset> [<seed>]
+"""
+
+import os
+import sys
+
+import numpy as np
+
+from loguru import logger
+from pathlib import Path
+
+sys.path.append(str(Path(os.path.abspath(__file__)).parent.parent))
+
+from includes.anonymize import anonymize
+from includes.pattern_loss import compute_fv, cosine_distance, reconstruct_fv
+
+# 1. Parse arguments
+algorithm = sys.argv[1].lower()
+
+k_value = int(sys.argv[2])
+P_value = int(sys.argv[3])
+paa_value = int(sys.argv[4])
+l_value = int(sys.argv[5])
+
+data_path = sys.argv[6]
+
+seed = int(sys.argv[7]) if len(sys.argv) == 8 else 0
+
+# 2. Anonymize in memory
+result = anonymize(data_path, algorithm, k_value, P_value, paa_value, l_value, seed=seed)
+
+tot_pattern_loss, _ = result.pattern_loss
+
+# 3. Original pattern loss, one time series at a time. Suppressed
+# records reconstruct to the zero vector
+baseline = 0.
+
+for row, series in enumerate(result.dataset.QI):
+    pr = result.patterns.get(row)
+    p_star = reconstruct_fv(pr) if pr else np.zeros(paa_value)
+
+    baseline += cosine_distance(compute_fv(series, paa_value), p_star)
+
+logger.info('Batched pattern loss: ' + str(tot_pattern_loss))
+logger.info('Original pattern loss: ' + str(baseline))
+
+if not np.isclose(tot_pattern_loss, baseline, rtol=1e-9, atol=1e-9):
+    logger.error('Batched pattern loss differs from the original one')
+    sys.exit(1)